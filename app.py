@@ -1,44 +1,131 @@
+import json
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+import click
+from flask import (Blueprint, Flask, Response, render_template, request,
+                   flash, redirect, session, g, jsonify, abort, current_app,
+                   stream_with_context, url_for)
+from flask.cli import with_appcontext
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import joinedload, lazyload
 
 
 from forms import UserAddForm, LoginForm, MessageForm, EditProfile
-from models import db, connect_db, User, Message, Likes, Follows
+from models import db, connect_db, User, Message, Likes, Follows, FollowState
+from assets import build_assets, send_asset, static_url
+from conditional import add_cache_headers, check, page_etag, viewer_version
+from counters import (increment, forget_message, forget_user, recount,
+                      recount_likes)
+import like_counts
+from likes import liked_message_ids, forget_liked
+import benchmark
+from explain import index_report
+from fragments import message_fragment, forget_message_fragment
+from loader import CHUNK_SIZE, load
+from migrations import upgrade, stamp, applied_versions, MIGRATIONS
+from message_search import (index_message, unindex_message, reindex_messages,
+                            search_messages, decode_rank_cursor, parse_time)
+from pagination import decode_cursor, keyset, paginate_messages, Pager
+from search import decode_search_cursor, search_pager
+from session_user import load_current_user, forget_current_user
+from thumbnails import send_thumbnail, thumb_url
+from timeline import (fan_out, backfill, retract, remove_message, remove_user,
+                      home_timeline, newest_message_id, rebuild_timelines)
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
+def create_app(config=None):
+    """Create and configure a Warbler app.
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-# toolbar = DebugToolbarExtension(app)
+    Creating the app does no I/O, so it is cheap to import, preload in a
+    server's master process and fork. The schema is created explicitly with
+    `flask create-db`. Settings in `config` override the defaults.
+    """
+
+    app = Flask(__name__)
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        os.environ.get('DATABASE_URL', 'postgres:///warbler'))
+
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ECHO'] = False
+
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Authors with more followers than this are pulled into home timelines
+    # at read time instead of being fanned out on write.
+    app.config['TIMELINE_FANOUT_LIMIT'] = int(
+        os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+
+    app.config['MESSAGES_PER_PAGE'] = 100
+    app.config['USERS_PER_PAGE'] = 100
+
+    # Send long listing pages as they render, rows fetched as they're
+    # reached, rather than rendering the whole page first. Rows are read
+    # STREAM_BATCH_SIZE at a time.
+    app.config['STREAM_TEMPLATES'] = True
+    app.config['STREAM_BATCH_SIZE'] = 100
+
+    # Page ETags change at least this often (seconds), bounding how long
+    # changes they don't track go unseen; see conditional.
+    app.config['ETAG_LIFETIME'] = 60
+
+    # Pending like count deltas are written after this many seconds, or
+    # once this many messages have them.
+    app.config['LIKE_COUNT_FLUSH_INTERVAL'] = 5
+    app.config['LIKE_COUNT_FLUSH_SIZE'] = 1000
+
+    # Where `flask build-assets` puts fingerprinted static files.
+    app.config['ASSETS_FOLDER'] = os.path.join(app.static_folder, 'dist')
 
-connect_db(app)
+    # Thumbnails of users' pictures; see thumbnails.
+    app.config['IMAGE_CACHE_FOLDER'] = os.path.join(app.instance_path,
+                                                    'thumbnails')
+    app.config['IMAGE_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+    app.config['IMAGE_PROXY_SCHEMES'] = ('http', 'https')
+    app.config['IMAGE_PROXY_MAX_BYTES'] = 10 * 1024 * 1024
+    app.config['IMAGE_PROXY_TIMEOUT'] = 5
+    # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    # toolbar = DebugToolbarExtension(app)
 
-db.create_all()
+    if config:
+        app.config.update(config)
+
+    connect_db(app)
+    app.register_blueprint(bp)
+
+    app.cli.add_command(benchmark_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(create_db_command)
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(db_status_command)
+    app.cli.add_command(explain_indexes_command)
+    app.cli.add_command(load_command)
+    app.cli.add_command(rebuild_timelines_command)
+    app.cli.add_command(recount_users_command)
+    app.cli.add_command(recount_likes_command)
+    app.cli.add_command(reindex_messages_command)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -57,7 +144,112 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def follow_state():
+    """Which users g.user follows, memoized for this request."""
+
+    if 'follow_state' not in g:
+        g.follow_state = FollowState(g.user.id if g.user else None)
+
+    return g.follow_state
+
+
+@bp.app_context_processor
+def add_follow_state():
+    """Let templates ask whether g.user follows a user."""
+
+    return dict(follow_state=follow_state())
+
+
+@bp.app_context_processor
+def add_message_fragment():
+    """Let templates use cached message list items."""
+
+    return dict(message_fragment=message_fragment)
+
+
+@bp.app_context_processor
+def add_static_url():
+    """Let templates link to fingerprinted static files."""
+
+    return dict(static_url=static_url)
+
+
+@bp.app_context_processor
+def add_thumb_url():
+    """Let templates show thumbnails of users' pictures."""
+
+    return dict(thumb_url=thumb_url)
+
+
+@bp.app_context_processor
+def add_like_count():
+    """Let templates show like counts including unwritten likes."""
+
+    return dict(like_count=like_counts.like_count)
+
+
+def stream_page(template_name, **context):
+    """Render a template while sending it, when STREAM_TEMPLATES is on.
+
+    The page's head goes out before its rows are fetched, and `Pager`s in
+    the context are read a batch at a time as the template reaches them,
+    so neither the response nor its rows are ever held whole.
+    """
+
+    app = current_app._get_current_object()
+    if not app.config['STREAM_TEMPLATES']:
+        return render_template(template_name, **context)
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    # Send a few dozen template chunks per write, not each tiny one.
+    stream.enable_buffering(40)
+    return Response(stream_with_context(stream))
+
+
+def pager(query, key, before=None, **options):
+    """A `Pager` over one page of `query` in descending order of `key`,
+    reading STREAM_BATCH_SIZE rows at a time."""
+
+    options.setdefault('batch_size', current_app.config['STREAM_BATCH_SIZE'])
+    return Pager(keyset(query, key, before), **options)
+
+
+def prime_follow_state(users):
+    """Look up follow state for a batch of users in one query."""
+
+    follow_state().prime(user.id for user in users)
+
+
+def follow_list_pager(query, key):
+    """A `pager` for one page of a following or followers list.
+
+    The page header shows the viewer's counters, so the viewer is loaded
+    in full first: if they are also on the page, their card's partial load
+    would otherwise leave the counters deferred.
+    """
+
+    g.user.model
+    return pager(query, key,
+                 before=page_cursor(),
+                 limit=current_app.config['USERS_PER_PAGE'],
+                 on_batch=prime_follow_state)
+
+
+def page_cursor():
+    """Decode the `before` cursor from the query string, if there is one."""
+
+    before = request.args.get('before')
+    if not before:
+        return None
+
+    try:
+        return decode_cursor(before)
+    except ValueError:
+        abort(400)
+
+
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -93,7 +285,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -113,7 +305,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     """Handle logout of user."""
     session.pop(CURR_USER_KEY)
@@ -123,7 +315,7 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@bp.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -132,32 +324,46 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    after = request.args.get('after')
+    try:
+        after = decode_search_cursor(after) if after else None
+    except ValueError:
+        abort(400)
 
-    return render_template('users/index.html', users=users)
+    users = search_pager(
+        search, after=after, limit=current_app.config['USERS_PER_PAGE'],
+        batch_size=current_app.config['STREAM_BATCH_SIZE'],
+        on_batch=prime_follow_state)
+    return stream_page('users/index.html', users=users, search=search)
 
 
-@app.route('/users/<int:user_id>')
+@bp.route('/users/<int:user_id>')
 def user_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
-
+    # Posting and deleting messages bump the user's stats_version.
+    before = page_cursor()
+    not_modified = check(page_etag(
+        'user', user.id, user.stats_version, user.profile_version, before,
+        *viewer_version()))
+    if not_modified:
+        return not_modified
 
-@app.route('/users/<int:user_id>/following')
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default. Every author here is
+    # `user`, already in the session, so plain lazy loading costs nothing.
+    messages, next_cursor = paginate_messages(
+        Message.query.options(lazyload(Message.user))
+                     .filter(Message.user_id == user_id),
+        before=before,
+        limit=current_app.config['MESSAGES_PER_PAGE'])
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
+
+
+@bp.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,10 +372,12 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users = follow_list_pager(User.followed_by(user_id),
+                              Follows.user_being_followed_id)
+    return stream_page('users/following.html', user=user, users=users)
 
 
-@app.route('/users/<int:user_id>/followers')
+@bp.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,10 +386,12 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users = follow_list_pager(User.followers_of(user_id),
+                              Follows.user_following_id)
+    return stream_page('users/followers.html', user=user, users=users)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -190,13 +400,18 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+
+    if Follows.add(g.user.id, followed_user.id):
+        increment(g.user.id, following_count=1)
+        increment(followed_user.id, followers_count=1)
+        backfill(g.user.id, followed_user.id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -204,39 +419,45 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if Follows.remove(g.user.id, follow_id):
+        increment(g.user.id, following_count=-1)
+        increment(follow_id, followers_count=-1)
+        retract(g.user.id, follow_id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
 def update_profile():
     """Update profile for current user."""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = EditProfile(obj=g.user)
+    user = g.user.model
+    form = EditProfile(obj=user)
 
     if form.validate_on_submit():
 
-        g.user.location = form.location.data or None
-        g.user.bio = form.bio.data or None
-        g.user.header_image_url = form.header_image_url.data or None
-        g.user.image_url = form.image_url.data or g.user.image_url
-        g.user.username = form.username.data
-        g.user.email = form.email.data
+        user.location = form.location.data or None
+        user.bio = form.bio.data or None
+        user.header_image_url = form.header_image_url.data or None
+        user.image_url = form.image_url.data or user.image_url
+        user.username = form.username.data
+        user.email = form.email.data
         password = form.password.data
 
-        user = User.authenticate(g.user.username, password)
-        if user:
+        if User.authenticate(user.username, password):
 
-            db.session.add(g.user)
+            # Cached message fragments show the old name and picture.
+            user.profile_version = User.profile_version + 1
+            db.session.add(user)
             db.session.commit()
+            forget_current_user(user.id)
 
-            return redirect(f"/users/{g.user.id}")
+            return redirect(f"/users/{user.id}")
 
         else:
             flash("Password Incorrect")
@@ -245,7 +466,7 @@ def update_profile():
 # IMPLEMENT THIS
 
 
-@app.route('/users/delete', methods=["POST"])
+@bp.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -255,8 +476,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    remove_user(g.user.id)
+    forget_user(g.user.id)
+    db.session.delete(g.user.model)
     db.session.commit()
+    forget_current_user(g.user.id)
 
     return redirect("/signup")
 
@@ -264,7 +488,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -278,8 +502,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        increment(g.user.id, messages_count=1)
+        index_message(msg)
+        fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -287,15 +515,85 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@bp.route('/messages/search')
+def messages_search():
+    """Search messages by text, most relevant first.
+
+    Takes the search terms in 'q', optional 'since' and 'until' ISO dates
+    bounding when the messages were posted, and an 'after' cursor for the
+    next page. Responds with JSON when the client asks for it.
+    """
+
+    terms = request.args.get('q', '').strip()
+    since = request.args.get('since')
+    until = request.args.get('until')
+
+    try:
+        after = request.args.get('after')
+        after = decode_rank_cursor(after) if after else None
+        bounds = dict(since=parse_time(since), until=parse_time(until))
+    except ValueError:
+        abort(400)
+
+    messages, next_cursor = [], None
+    if terms:
+        messages, next_cursor = search_messages(
+            terms, after=after, limit=current_app.config['MESSAGES_PER_PAGE'],
+            **bounds)
+
+    next_url = next_cursor and url_for(
+        'warbler.messages_search', q=terms, since=since, until=until,
+        after=next_cursor)
+
+    if wants_json():
+        return jsonify(messages=[message_json(msg) for msg in messages],
+                       next_cursor=next_cursor,
+                       next_url=next_url)
+
+    return render_template('messages/search.html', messages=messages,
+                           q=terms, since=since, until=until,
+                           next_url=next_url)
+
+
+def message_json(message):
+    """A message and its author as a JSON-serializable dict.
+
+    Message ids are sent as strings: they are 64-bit, and JavaScript numbers
+    lose precision past 53 bits.
+    """
+
+    return dict(id=str(message.id),
+                text=message.text,
+                timestamp=message.timestamp.isoformat(),
+                user=dict(id=message.user.id,
+                          username=message.user.username,
+                          image_url=message.user.image_url))
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
 def message_show(message_id):
     """Show a message."""
 
-    message = Message.query.get_or_404(message_id)
+    message = (Message
+               .query
+               .options(joinedload(Message.user)
+                        .load_only(*Message.AUTHOR_COLUMNS))
+               .get_or_404(message_id))
+
+    # Messages never change, but their author's name and picture and the
+    # viewer's follow button can. The page looks the button up anyway.
+    following = (g.user and g.user.id != message.user_id and
+                 follow_state().is_following(message.user_id))
+    not_modified = check(page_etag('message', message.id,
+                                   message.user.profile_version, following,
+                                   *viewer_version(counters=False)))
+    if not_modified:
+        return not_modified
+
     return render_template('messages/show.html', message=message)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@bp.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -304,8 +602,12 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    remove_message(msg.id)
+    unindex_message(msg)
+    forget_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    forget_message_fragment(msg.id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -314,7 +616,7 @@ def messages_destroy(message_id):
 # Homepage and error pages
 
 
-@app.route('/')
+@bp.route('/')
 def homepage():
     """Show homepage:
 
@@ -323,468 +625,367 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [
-            follower.id for follower in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query.filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        favorited_messages = [message.id for message in g.user.likes]
-
-        return render_template('home.html', messages=messages, favorited_messages=favorited_messages)
+        before = page_cursor()
+        not_modified = check(page_etag(
+            'home', *viewer_version(), before,
+            newest_message_id(g.user.id, before)))
+        if not_modified:
+            return not_modified
+
+        messages, next_cursor = home_timeline(
+            g.user.id,
+            before=before,
+            limit=current_app.config['MESSAGES_PER_PAGE'])
+        favorited_messages = liked_message_ids(
+            g.user.id, [message.id for message in messages])
+
+        return render_template('home.html', messages=messages, favorited_messages=favorited_messages,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Caching: browsers revalidate every page; see conditional.
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    """Serve a fingerprinted static file; see assets."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return send_asset(filename)
 
 
-@app.route("/users/add_like/<int:msg_id>", methods=["POST"])
-def like_post(msg_id):
-    """like a post"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+@bp.route('/images/<size>/<signature>/<path:token>')
+def thumbnail(size, signature, token):
+    """Serve a thumbnail of a user's picture; see thumbnails."""
 
-    like = Likes(user_id=g.user.id, message_id=msg_id)
-    db.session.add(like)
-    db.session.commit()
+    return send_thumbnail(size, signature, token)
 
-    return redirect("/")
 
+@bp.after_app_request
+def add_header(response):
+    """Add caching headers and validators to every response."""
 
-@app.route("/users/remove_like/<int:msg_id>", methods=["POST"])
-def unlike_post(msg_id):
-    """unlike a post"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    like = Likes.query.filter(
-        Likes.message_id == msg_id, Likes.user_id == g.user.id).first()
-
-    db.session.delete(like)
-    db.session.commit()
-
-    return redirect("/")
-
-
-@app.route("/users/<int:user_id>/likes")
-def show_liked_posts(user_id):
-    """show liked posts for user"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-    favorited_messages = [message.id for message in g.user.likes]
-
-    likes = Message.query.filter(Message.id.in_(favorited_messages)).order_by(
-        Message.timestamp.desc()).all()
-    return render_template("users/likes.html", messages=likes)
-
-
-CURR_USER_KEY = "curr_user"
-
-app = Flask(__name__)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
+    return add_cache_headers(response)
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-# toolbar = DebugToolbarExtension(app)
 
-connect_db(app)
+def wants_json():
+    """Did the client ask for JSON (script.js) rather than an HTML page?"""
 
-db.create_all()
+    accept = request.accept_mimetypes
+    return accept['application/json'] > accept['text/html']
 
 
-##############################################################################
-# User signup/login/logout
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-        g.user = None
+def like_response(msg_id, liked):
+    """Respond to a like/unlike.
 
-
-def do_login(user):
-    """Log in user."""
-
-    session[CURR_USER_KEY] = user.id
-
-
-def do_logout():
-    """Logout user."""
-
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-
-@app.route('/signup', methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
-
-    Create new user and add to DB. Redirect to home page.
-
-    If form not valid, present form.
-
-    If the there already is a user with that username: flash message
-    and re-present form.
+    script.js gets the new like state as a small JSON body; plain form
+    posts are redirected home as before.
     """
 
-    form = UserAddForm()
+    if wants_json():
+        stored = (db.session
+                  .query(Message.like_count)
+                  .filter(Message.id == msg_id)
+                  .scalar())
+        return jsonify(message_id=str(msg_id),
+                       liked=liked,
+                       likes=g.user.likes_count,
+                       like_count=(stored or 0) +
+                       like_counts.pending_likes.pending(msg_id))
 
-    if form.validate_on_submit():
-        try:
-            user = User.signup(
-                username=form.username.data,
-                password=form.password.data,
-                email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
-            )
-            db.session.commit()
-
-        except IntegrityError:
-            flash("Username already taken", 'danger')
-            return render_template('users/signup.html', form=form)
-
-        do_login(user)
-
-        return redirect("/")
-
-    else:
-        return render_template('users/signup.html', form=form)
-
-
-@app.route('/login', methods=["GET", "POST"])
-def login():
-    """Handle user login."""
-
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            return redirect("/")
-
-        flash("Invalid credentials.", 'danger')
-
-    return render_template('users/login.html', form=form)
-
-
-@app.route('/logout')
-def logout():
-    """Handle logout of user."""
-    session.pop(CURR_USER_KEY)
     return redirect("/")
 
 
-##############################################################################
-# General user routes:
-
-@app.route('/users')
-def list_users():
-    """Page with listing of users.
-
-    Can take a 'q' param in querystring to search by that username.
-    """
-
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
-
-
-@app.route('/users/<int:user_id>')
-def user_show(user_id):
-    """Show user profile."""
-
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
-
-
-@app.route('/users/<int:user_id>/following')
-def show_following(user_id):
-    """Show list of people this user is following."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
-
-
-@app.route('/users/<int:user_id>/followers')
-def users_followers(user_id):
-    """Show list of followers of this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
-
-
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-
+@bp.route("/users/add_like/<int:msg_id>", methods=["POST"])
+def like_post(msg_id):
+    """like a post"""
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
+    # Check first: liking a missing message would break the foreign key.
+    if (db.session.query(Message.id)
+            .filter(Message.id == msg_id)
+            .scalar()) is None:
+        if wants_json():
+            return jsonify(error="Message not found."), 404
+        abort(404)
 
+    if Likes.add(g.user.id, msg_id):
+        increment(g.user.id, likes_count=1)
+        db.session.commit()
+        like_counts.record(msg_id, 1)
+    else:
+        db.session.commit()
+    forget_liked(g.user.id)
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
-def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
+    return like_response(msg_id, liked=True)
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
-def update_profile():
-    """Update profile for current user."""
+@bp.route("/users/remove_like/<int:msg_id>", methods=["POST"])
+def unlike_post(msg_id):
+    """unlike a post"""
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = EditProfile(obj=g.user)
-
-    if form.validate_on_submit():
-
-        g.user.location = form.location.data or None
-        g.user.bio = form.bio.data or None
-        g.user.header_image_url = form.header_image_url.data or None
-        g.user.image_url = form.image_url.data or g.user.image_url
-        g.user.username = form.username.data
-        g.user.email = form.email.data
-        password = form.password.data
-
-        user = User.authenticate(g.user.username, password)
-        if user:
+    if Likes.remove(g.user.id, msg_id):
+        increment(g.user.id, likes_count=-1)
+        db.session.commit()
+        like_counts.record(msg_id, -1)
+    else:
+        db.session.commit()
+    forget_liked(g.user.id)
 
-            db.session.add(g.user)
-            db.session.commit()
+    return like_response(msg_id, liked=False)
 
-            return redirect(f"/users/{g.user.id}")
 
-        else:
-            flash("Password Incorrect")
+@bp.after_app_request
+def write_like_counts(response):
+    """Write like counts once enough likes or time have built up."""
 
-    return render_template("users/edit.html", form=form, user_id=g.user.id)
-# IMPLEMENT THIS
+    try:
+        like_counts.flush_if_due(current_app.config)
+    except SQLAlchemyError:
+        # The likes are kept for the next flush; don't fail this request.
+        current_app.logger.exception("Couldn't write like counts")
 
+    return response
 
-@app.route('/users/delete', methods=["POST"])
-def delete_user():
-    """Delete user."""
 
+@bp.route("/users/<int:user_id>/likes")
+def show_liked_posts(user_id):
+    """show liked posts for user"""
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    do_logout()
-
-    db.session.delete(g.user)
-    db.session.commit()
-
-    return redirect("/signup")
+    liked = (Message
+             .query
+             .options(Message.with_authors())
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == g.user.id))
+    likes = pager(liked,
+                  Message.id,
+                  before=page_cursor(),
+                  limit=current_app.config['MESSAGES_PER_PAGE'])
+    return stream_page("users/likes.html", messages=likes)
 
 
 ##############################################################################
-# Messages routes:
-
-@app.route('/messages/new', methods=["GET", "POST"])
-def messages_add():
-    """Add a message:
+# Command line maintenance tasks
 
-    Show form if GET. If valid, update message and redirect to user page.
-    """
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+@click.command('create-db')
+@with_appcontext
+def create_db_command():
+    """Create a new database from the models.
 
-    form = MessageForm()
-
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+    The models are always current, so every migration is marked applied.
+    Use db-upgrade to bring an existing database up to date instead.
+    """
 
-        return redirect(f"/users/{g.user.id}")
+    db.create_all()
+    stamp()
+    db.session.commit()
 
-    return render_template('messages/new.html', form=form)
 
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade_command():
+    """Apply pending schema migrations."""
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
-def message_show(message_id):
-    """Show a message."""
+    applied = upgrade(echo=lambda migration: click.echo(
+        f"Applying {migration.version}: {migration.description}"))
 
-    message = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=message)
+    if not applied:
+        click.echo("Database is up to date.")
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
-def messages_destroy(message_id):
-    """Delete a message."""
+@click.command('db-status')
+@with_appcontext
+def db_status_command():
+    """List schema migrations and when each was applied."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    applied = applied_versions()
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}")
-
-
-##############################################################################
-# Homepage and error pages
-
-
-@app.route('/')
-def homepage():
-    """Show homepage:
-
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    for migration in MIGRATIONS:
+        when = applied.get(migration.version)
+        status = f"applied {when:%Y-%m-%d %H:%M}" if when else "pending"
+        click.echo(f"{migration.version}  {status:<22}  "
+                   f"{migration.description}")
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Build fingerprinted, compressed copies of the static files."""
+
+    app = current_app._get_current_object()
+    manifest = build_assets(
+        app.static_folder, app.config['ASSETS_FOLDER'],
+        echo=lambda path, name: click.echo(f"{path} -> {name}"))
+    click.echo(f"Built {len(manifest['assets'])} assets in "
+               f"{app.config['ASSETS_FOLDER']}.")
+
+
+@click.command('explain-indexes')
+@click.option('--user-id', type=int,
+              help="View pages as this user (default: a busy one).")
+@click.option('--prefer-indexes', is_flag=True,
+              help="Discourage sequential scans (Postgres), to show which "
+                   "indexes queries can use on a small database.")
+@click.argument('urls', nargs=-1)
+@with_appcontext
+def explain_indexes_command(user_id, prefer_indexes, urls):
+    """Report the indexes used by each route's queries.
+
+    Checks a sample of the app's pages unless URLS are given.
     """
 
-    if g.user:
-        following_ids = [
-            follower.id for follower in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query.filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        favorited_messages = [message.id for message in g.user.likes]
-
-        return render_template('home.html', messages=messages, favorited_messages=favorited_messages)
+    report = index_report(current_app._get_current_object(),
+                          urls=list(urls) or None,
+                          user_id=user_id,
+                          prefer_indexes=prefer_indexes)
+
+    for url, plans in report.items():
+        click.echo(f"GET {url}")
+        for plan in plans:
+            used = ', '.join(plan.indexes) or "no index"
+            scans = ''.join(f"; full scan of {table}" for table in plan.scans)
+            click.echo(f"  {plan.statement[:70]}")
+            click.echo(f"    -> {used}{scans}")
+
+
+@click.command('load')
+@click.argument('paths', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--append', is_flag=True,
+              help="Add to the existing data instead of replacing it.")
+@click.option('--defer-indexes/--keep-indexes', default=None,
+              help="Drop secondary indexes until the rows are loaded "
+                   "(default: unless appending).")
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True,
+              help="Rows written and committed at a time.")
+@with_appcontext
+def load_command(paths, append, defer_indexes, chunk_size):
+    """Bulk load CSV or NDJSON files.
+
+    Each file is named after its table, e.g. users.csv or
+    messages.part-0001.ndjson. Without --append, every table is emptied
+    first.
+    """
 
-    else:
-        return render_template('home-anon.html')
+    def report(table, rows, rate):
+        click.echo(f"{table}: {rows:,} rows ({rate:,.0f} rows/s)")
+
+    started = time.monotonic()
+    loaded = load(paths, append=append, defer_indexes=defer_indexes,
+                  chunk_size=chunk_size, progress=report)
+    elapsed = time.monotonic() - started
+
+    click.echo(f"Loaded {sum(loaded.values()):,} rows in {elapsed:.1f}s.")
+
+
+@click.command('benchmark')
+@click.option('--dataset', type=click.Choice(['1k', '100k', '10m']),
+              help="First replace all data with a generated dataset.")
+@click.option('--requests', type=click.IntRange(min=1), default=200,
+              show_default=True, help="Requests per scenario and driver.")
+@click.option('--workers', type=click.IntRange(min=1), default=8,
+              show_default=True, help="Concurrent HTTP client threads.")
+@click.option('--driver', 'drivers', type=click.Choice(benchmark.DRIVERS),
+              multiple=True, help="Run only this driver (repeatable).")
+@click.option('--no-writes', is_flag=True,
+              help="Skip the scenarios that post, like and follow.")
+@click.option('--out', type=click.Path(dir_okay=False),
+              help="Save the results as JSON.")
+@click.option('--compare', type=click.File(),
+              help="Compare with results saved by an earlier run.")
+@with_appcontext
+def benchmark_command(dataset, requests, workers, drivers, no_writes, out,
+                      compare):
+    """Measure latency, throughput and queries per request by route."""
+
+    if dataset:
+        click.echo(f"Generating and loading the {dataset} dataset...")
+        benchmark.seed_dataset(dataset)
+
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI':
+            current_app.config['SQLALCHEMY_DATABASE_URI'],
+        'WTF_CSRF_ENABLED': False,
+    })
+    drivers = drivers or benchmark.DRIVERS
+
+    click.echo(f"{'driver':<6} {'scenario':<44} {'p50':>7} {'p95':>7} "
+               f"{'p99':>7} {'req/s':>7} {'queries':>7}")
+
+    def report(result):
+        click.echo(f"{result['driver']:<6} {result['scenario'][:44]:<44} "
+                   f"{result['p50_ms']:>7} {result['p95_ms']:>7} "
+                   f"{result['p99_ms']:>7} {result['rps']:>7} "
+                   f"{result['queries']!s:>7}")
+        if result['errors']:
+            click.echo(f"       {result['errors']} errors")
+
+    run = benchmark.describe_run(app, dataset=dataset, requests=requests,
+                                 workers=workers, drivers=list(drivers))
+    run['results'] = benchmark.run_benchmark(
+        app, requests=requests, workers=workers, drivers=drivers,
+        writes=not no_writes, progress=report)
+
+    if out:
+        with open(out, 'w') as file:
+            json.dump(run, file, indent=2)
+
+    if compare:
+        click.echo(f"\nChange since {compare.name}:")
+        for line in benchmark.compare(json.load(compare), run):
+            click.echo(line)
+
+
+@click.command('rebuild-timelines')
+@with_appcontext
+def rebuild_timelines_command():
+    """Rebuild every user's materialized home timeline."""
+
+    rebuild_timelines()
+    db.session.commit()
 
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+@click.command('reindex-messages')
+@with_appcontext
+def reindex_messages_command():
+    """Rebuild the full-text search index over messages."""
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+    reindex_messages()
+    db.session.commit()
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
 
+@click.command('recount-users')
+@with_appcontext
+def recount_users_command():
+    """Recompute every user's denormalized counters."""
 
-@app.route("/users/add_like/<int:msg_id>", methods=["POST"])
-def like_post(msg_id):
-    """like a post"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    like = Likes(user_id=g.user.id, message_id=msg_id)
-    db.session.add(like)
+    recount()
     db.session.commit()
 
-    return jsonify(message="Post Liked")
 
+@click.command('recount-likes')
+@with_appcontext
+def recount_likes_command():
+    """Recompute every message's like count from the likes table."""
 
-@app.route("/users/remove_like/<int:msg_id>", methods=["POST"])
-def unlike_post(msg_id):
-    """unlike a post"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    like = Likes.query.filter(
-        Likes.message_id == msg_id, Likes.user_id == g.user.id).first()
-
-    db.session.delete(like)
+    recount_likes()
     db.session.commit()
 
-    return jsonify(message="Removed Like")
-
-
-@app.route("/users/<int:user_id>/likes")
-def show_liked_posts(user_id):
-    """show liked posts for user"""
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-    favorited_messages = [message.id for message in g.user.likes]
 
-    likes = Message.query.filter(Message.id.in_(favorited_messages)).order_by(
-        Message.timestamp.desc()).all()
-    return render_template("users/likes.html", messages=likes)
+app = create_app()
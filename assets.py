@@ -0,0 +1,185 @@
+"""Fingerprinted, precompressed static assets.
+
+``flask build-assets`` copies every file under ``static/`` into
+``static/dist/`` with a hash of its contents in its name (``script.js``
+becomes e.g. ``script.3f9c2e1a7b4d.js``), pointing the ``/static/`` URLs in
+stylesheets at the copies. Text files also get gzip and, if the ``brotli``
+package is installed, brotli versions alongside, made once at the highest
+compression level rather than on every request. ``manifest.json`` records
+the names.
+
+Templates link to assets with ``static_url('script.js')``. Built assets are
+served from ``/assets/`` in the best encoding the browser accepts, with a
+year-long immutable Cache-Control: a changed file gets a new name, so
+browsers never need to ask about the old one again. Without a build,
+``static_url`` falls back to the plain ``/static/`` URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+URL_PREFIX = '/assets/'
+
+# Images and fonts are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.ico', '.html'}
+
+# Encodings served, best first, with their file suffixes.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CACHE_CONTROL = f"public, max-age={365 * 24 * 60 * 60}, immutable"
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+# Manifests read so far, by assets folder.
+_manifests = {}
+
+
+def fingerprinted(path, content):
+    """`path` with a hash of `content` before its extension."""
+
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{digest}{extension}"
+
+
+def source_files(source, out):
+    """Paths of the files under `source`, relative to it, leaving out
+    `out`.
+
+    Stylesheets come last, so the files they refer to are named first.
+    """
+
+    paths = []
+    for directory, subdirectories, filenames in os.walk(source):
+        subdirectories[:] = [name for name in subdirectories
+                             if os.path.join(directory, name) != out]
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(directory, filename), source)
+            paths.append(path.replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def compress(path, content):
+    """Write the encoded variants of `content` worth keeping next to
+    `path`. Returns their encodings."""
+
+    variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content, quality=11)
+
+    written = []
+    for encoding, suffix in ENCODINGS:
+        data = variants.get(encoding)
+        if data is not None and len(data) < len(content):
+            with open(path + suffix, 'wb') as file:
+                file.write(data)
+            written.append(encoding)
+
+    return written
+
+
+def build_assets(source, out, echo=lambda path, name: None):
+    """Build fingerprinted, compressed copies of `source`'s files in `out`.
+
+    Earlier builds are left in place, so pages still linking to them keep
+    working. Returns the manifest; `echo` is called with each file and its
+    new name.
+    """
+
+    assets = {}
+    encoded = {}
+
+    def asset_url(match):
+        quote, path = match.groups()
+        name = assets.get(path)
+        if name is None:
+            return match.group(0)
+        return f"url({quote}{URL_PREFIX}{name}{quote})"
+
+    for path in source_files(source, out):
+        with open(os.path.join(source, path), 'rb') as file:
+            content = file.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL.sub(asset_url,
+                                  content.decode('utf-8')).encode('utf-8')
+
+        name = fingerprinted(path, content)
+        target = os.path.join(out, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as file:
+            file.write(content)
+
+        assets[path] = name
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            encodings = compress(target, content)
+            if encodings:
+                encoded[name] = encodings
+        echo(path, name)
+
+    manifest = {'assets': assets, 'encoded': encoded}
+    with open(os.path.join(out, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+
+    _manifests.pop(out, None)
+    return manifest
+
+
+def load_manifest(folder):
+    """The manifest of the build in `folder`, empty if there isn't one."""
+
+    if folder not in _manifests:
+        try:
+            with open(os.path.join(folder, MANIFEST)) as file:
+                _manifests[folder] = json.load(file)
+        except FileNotFoundError:
+            _manifests[folder] = {'assets': {}, 'encoded': {}}
+
+    return _manifests[folder]
+
+
+def static_url(filename):
+    """URL for the static file `filename`, fingerprinted if it's built."""
+
+    manifest = load_manifest(current_app.config['ASSETS_FOLDER'])
+    name = manifest['assets'].get(filename)
+    if name is None:
+        return url_for('static', filename=filename)
+
+    return URL_PREFIX + name
+
+
+def send_asset(name):
+    """Respond with a built asset, in the best encoding accepted."""
+
+    folder = current_app.config['ASSETS_FOLDER']
+    encodings = load_manifest(folder)['encoded'].get(name, [])
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            response = send_from_directory(folder, name + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(folder, name, mimetype=mimetype)
+
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -0,0 +1,366 @@
+"""Route-level benchmarks.
+
+``flask benchmark`` drives a set of scenarios (the main pages, search and a
+few writes) through two drivers:
+
+- ``client``: the Flask test client, one request at a time, in process.
+  This measures the views and their queries alone.
+- ``http``: a local threaded HTTP server, hit by several client threads at
+  once. This adds the server, sockets and contention.
+
+For each scenario and driver it reports latency percentiles, requests per
+second and queries per request, read from the ``Server-Timing`` header
+that `query_stats` adds. Streamed pages send their headers before they
+query, so the ``client`` driver reads their stats from `query_stats`
+directly and the ``http`` driver reports none. Results are saved as JSON
+so runs can be compared across commits (``--compare``).
+
+``--dataset 1k`` first replaces the database's contents with a generated
+dataset of that profile (see ``generator/create_csvs.py``).
+"""
+
+import glob
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.client import HTTPConnection
+from itertools import cycle
+from math import ceil
+from urllib.parse import urlencode
+
+from werkzeug.serving import make_server
+
+from explain import sample_routes
+from loader import load
+from models import db, query_stats, User, Message, Follows, Likes
+
+# A scenario's requests are (method, url, form data) and are sent in
+# turn, so writes can alternate between doing and undoing something.
+Scenario = namedtuple('Scenario', 'name requests')
+
+DRIVERS = ('client', 'http')
+
+SERVER_TIMING_DB = re.compile(r'db;dur=([\d.]+);desc="(\d+) queries"')
+
+BENCHMARK_TEXT = "Benchmark warble"
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+
+def seed_dataset(profile, seed=0):
+    """Replace the database's contents with a generated dataset."""
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, GENERATOR, '--profile', profile,
+                        '--seed', str(seed), '--out', directory],
+                       check=True, stdout=subprocess.DEVNULL)
+        load(sorted(glob.glob(os.path.join(directory, '*'))))
+
+
+def scenarios(writes=True):
+    """The scenarios to run, using real ids from the database.
+
+    Returns the scenarios and the id of the user to run them as.
+    """
+
+    urls, user_id = sample_routes()
+    if user_id is None:
+        raise ValueError("The database has no users to benchmark with")
+
+    found = [Scenario(f"GET {url}", [('GET', url, None)]) for url in urls]
+
+    if not writes:
+        return found, user_id
+
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id))
+    stranger = (User
+                .query
+                .filter(User.id != user_id, ~User.id.in_(followed))
+                .order_by(User.id)
+                .first())
+    liked = (db.session
+             .query(Likes.message_id)
+             .filter(Likes.user_id == user_id))
+    message = (Message
+               .query
+               .filter(~Message.id.in_(liked))
+               .order_by(Message.id.desc())
+               .first())
+
+    found.append(Scenario("POST /messages/new", [
+        ('POST', "/messages/new", {'text': BENCHMARK_TEXT})]))
+    if message:
+        found.append(Scenario("POST like, unlike", [
+            ('POST', f"/users/add_like/{message.id}", None),
+            ('POST', f"/users/remove_like/{message.id}", None)]))
+    if stranger:
+        found.append(Scenario("POST follow, unfollow", [
+            ('POST', f"/users/follow/{stranger.id}", None),
+            ('POST', f"/users/stop-following/{stranger.id}", None)]))
+
+    return found, user_id
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    rank = max(ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+class Samples:
+    """Thread-safe timings of one scenario under one driver."""
+
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.db_ms = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, status, server_timing):
+        with self._lock:
+            self.latencies.append(seconds * 1000)
+            if status >= 400:
+                self.errors += 1
+
+            timing = SERVER_TIMING_DB.search(server_timing or '')
+            if timing:
+                self.db_ms.append(float(timing.group(1)))
+                self.queries.append(int(timing.group(2)))
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def mean(values):
+            return round(sum(values) / len(values), 2) if values else None
+
+        return dict(
+            requests=len(latencies),
+            errors=self.errors,
+            rps=round(len(latencies) / elapsed, 1) if elapsed else None,
+            p50_ms=round(percentile(latencies, 0.50), 2),
+            p95_ms=round(percentile(latencies, 0.95), 2),
+            p99_ms=round(percentile(latencies, 0.99), 2),
+            mean_ms=mean(latencies),
+            queries=mean(self.queries),
+            db_ms=mean(self.db_ms),
+        )
+
+
+def run_client(app, scenario, user_id, requests):
+    """Send `requests` requests through the test client, one at a time."""
+
+    from app import CURR_USER_KEY  # app imports this module
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = user_id
+
+    samples = Samples()
+    sends = cycle(scenario.requests)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, url, data = next(sends)
+        sent = time.perf_counter()
+        response = client.open(url, method=method, data=data,
+                               headers={'Accept': 'application/json'}
+                               if method == 'POST' else {})
+        # Streamed pages render as they are read.
+        response.get_data()
+        response.close()
+        samples.record(time.perf_counter() - sent, response.status_code,
+                       response.headers.get('Server-Timing') or
+                       query_stats.last.server_timing())
+
+    return samples, time.perf_counter() - started
+
+
+class LocalServer:
+    """The app served by a threaded HTTP server on a free local port."""
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        # One log line per request would swamp the results.
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def session_cookie(app, user_id):
+    """A signed session cookie logging in as `user_id`."""
+
+    from app import CURR_USER_KEY  # app imports this module
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    name = app.config['SESSION_COOKIE_NAME']
+    return f"{name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+
+
+def run_http(app, server, scenario, user_id, requests, workers):
+    """Send `requests` requests over HTTP from `workers` threads at once."""
+
+    cookie = session_cookie(app, user_id)
+    samples = Samples()
+    sends = cycle(scenario.requests)
+    lock = threading.Lock()
+
+    def send():
+        with lock:
+            method, url, data = next(sends)
+
+        headers = {'Cookie': cookie}
+        body = None
+        if method == 'POST':
+            headers['Accept'] = 'application/json'
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(data or {})
+
+        connection = HTTPConnection('127.0.0.1', server.port, timeout=60)
+        try:
+            sent = time.perf_counter()
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            samples.record(time.perf_counter() - sent, response.status,
+                           response.getheader('Server-Timing'))
+        finally:
+            connection.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(send) for _ in range(requests)]:
+            future.result()
+
+    return samples, time.perf_counter() - started
+
+
+def clean_up(app, user_id):
+    """Delete the messages the benchmark posted, through the app."""
+
+    from app import CURR_USER_KEY  # app imports this module
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session[CURR_USER_KEY] = user_id
+
+    with app.app_context():
+        posted = [message_id for (message_id,) in
+                  db.session
+                  .query(Message.id)
+                  .filter(Message.user_id == user_id,
+                          Message.text == BENCHMARK_TEXT)]
+
+    for message_id in posted:
+        client.post(f"/messages/{message_id}/delete")
+
+
+def run_benchmark(app, requests=100, workers=4, drivers=DRIVERS,
+                  writes=True, warmup=5, progress=lambda result: None):
+    """Run every scenario under each driver. Returns a list of results.
+
+    `app` should have CSRF protection off so the write scenarios can post
+    forms. `progress` is called with each result as it is ready.
+    """
+
+    with app.app_context():
+        found, user_id = scenarios(writes)
+
+    results = []
+
+    def finish(driver, scenario, samples, elapsed):
+        result = dict(driver=driver, scenario=scenario.name,
+                      **samples.summary(elapsed))
+        results.append(result)
+        progress(result)
+
+    try:
+        if 'client' in drivers:
+            for scenario in found:
+                run_client(app, scenario, user_id, warmup)
+                finish('client', scenario,
+                       *run_client(app, scenario, user_id, requests))
+
+        if 'http' in drivers:
+            with LocalServer(app) as server:
+                for scenario in found:
+                    run_http(app, server, scenario, user_id, warmup,
+                             workers)
+                    finish('http', scenario,
+                           *run_http(app, server, scenario, user_id,
+                                     requests, workers))
+    finally:
+        if writes:
+            clean_up(app, user_id)
+
+    return results
+
+
+def describe_run(app, **settings):
+    """Metadata saved alongside results: commit, database, data size."""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(GENERATOR),
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    with app.app_context():
+        rows = {model.__tablename__: model.query.count()
+                for model in (User, Message, Follows, Likes)}
+        database = db.engine.dialect.name
+
+    return dict(commit=commit,
+                started=datetime.utcnow().isoformat(timespec='seconds'),
+                python=platform.python_version(),
+                database=database,
+                rows=rows,
+                **settings)
+
+
+def compare(previous, current):
+    """Lines comparing two runs' results, scenario by scenario."""
+
+    before = {(result['driver'], result['scenario']): result
+              for result in previous['results']}
+
+    def change(old, new):
+        if not old or new is None:
+            return "     n/a"
+        return f"{(new - old) / old:+8.1%}"
+
+    lines = []
+    for result in current['results']:
+        old = before.get((result['driver'], result['scenario']))
+        if old is None:
+            continue
+        lines.append(
+            f"{result['driver']:<6} {result['scenario'][:44]:<44} "
+            f"p50 {change(old['p50_ms'], result['p50_ms'])}  "
+            f"p95 {change(old['p95_ms'], result['p95_ms'])}  "
+            f"rps {change(old['rps'], result['rps'])}")
+    return lines
@@ -0,0 +1,63 @@
+"""Small in-process caches."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """Thread-safe mapping that keeps at most `maxsize` entries.
+
+    The least recently used entry is evicted first. With `ttl` (seconds),
+    entries also expire that long after they were stored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting old entries if full."""
+
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove `key`, returning its value if it was cached."""
+
+        with self._lock:
+            value, _ = self._entries.pop(key, (default, None))
+            return value
+
+    def clear(self):
+        """Remove every entry."""
+
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,84 @@
+"""Conditional GETs for pages.
+
+Pages are per user and change all the time, so browsers may not reuse
+them without asking (``Cache-Control: private, no-cache``). Asking is
+cheap, though: routes build a validator from a few values that change
+whenever their page would (the newest message id, the cursor, users'
+``stats_version`` and ``profile_version``), and `check` answers a request
+whose copy still matches with a bodiless 304 before the page's own
+queries run.
+
+Some changes are too scattered to track cheaply: other users' likes, and
+edits or deletions by the authors on a timeline. ETags also change every
+``ETAG_LIFETIME`` seconds, so such changes show within that long.
+
+Pages don't send Last-Modified. Even a message's page, whose message never
+changes, shows its author and a follow button, which have no timestamp of
+their own; an If-Modified-Since answered from the message's timestamp
+alone would keep showing them stale.
+"""
+
+import hashlib
+from time import time
+
+from flask import current_app, g, request, session
+
+
+def page_etag(*parts):
+    """An ETag for a page whose content is determined by `parts`."""
+
+    window = int(time() // current_app.config['ETAG_LIFETIME'])
+    raw = '|'.join(str(part) for part in (window,) + parts)
+    return hashlib.blake2b(raw.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def viewer_version(counters=True):
+    """Validator parts for the logged-in user, who is in every page's
+    navigation.
+
+    With `counters`, which loads the full user, they also cover the
+    user's counters and follows, which most pages show.
+    """
+
+    if not g.user:
+        return (None,)
+
+    if not counters:
+        return (g.user.id, g.user.username, g.user.image_url)
+
+    user = g.user.model
+    return (user.id, user.stats_version, user.profile_version)
+
+
+def check(etag):
+    """Validate the request against the page's current ETag.
+
+    Returns a 304 response if the client's copy is current; otherwise
+    None, and the response gets the ETag. Call it before running the
+    page's expensive queries.
+    """
+
+    # Flashed messages show once, so a page showing them can't be reused.
+    if '_flashes' in session:
+        return None
+
+    g.etag = etag
+
+    if request.if_none_match.contains(etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def add_cache_headers(response):
+    """Make browsers revalidate, giving them the page's ETag."""
+
+    # Fingerprinted assets are cached for good; see assets.
+    if 'immutable' not in response.headers.get('Cache-Control', ''):
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+    etag = g.pop('etag', None)
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+
+    return response
@@ -0,0 +1,133 @@
+"""Denormalized per-user counters.
+
+``User`` carries ``messages_count``, ``following_count``, ``followers_count``
+and ``likes_count`` so stats can be rendered without loading every related
+row. The write paths adjust them in the same transaction as the rows they
+count; `recount` rebuilds them from scratch when they drift (bulk loads,
+manual edits). Every change also bumps ``stats_version``.
+
+``Message.like_count`` is kept the same way, except that likes and unlikes
+update it write-behind (see `like_counts`); `recount_likes` rebuilds it.
+"""
+
+from models import db, User, Message, Follows, Likes
+
+
+def increment(user_ids, **deltas):
+    """Add `deltas` to counters for `user_ids` with a single UPDATE.
+
+    `user_ids` may be one id, a list of ids or a query selecting ids; e.g.
+    ``increment(user.id, following_count=1)``.
+    """
+
+    if isinstance(user_ids, int):
+        matching = User.id == user_ids
+    else:
+        matching = User.id.in_(user_ids)
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+    values[User.stats_version] = User.stats_version + 1
+
+    User.query.filter(matching).update(values, synchronize_session=False)
+
+
+def forget_message(message):
+    """Adjust counters for a message that is about to be deleted."""
+
+    increment(message.user_id, messages_count=-1)
+    increment(db.session
+              .query(Likes.user_id)
+              .filter(Likes.message_id == message.id),
+              likes_count=-1)
+
+
+def forget_user(user_id):
+    """Adjust other users' counters for a user who is about to be deleted."""
+
+    increment(db.session
+              .query(Follows.user_being_followed_id)
+              .filter(Follows.user_following_id == user_id),
+              followers_count=-1)
+    increment(db.session
+              .query(Follows.user_following_id)
+              .filter(Follows.user_being_followed_id == user_id),
+              following_count=-1)
+
+    # Their likes are about to cascade away.
+    (Message
+     .query
+     .filter(Message.id.in_(db.session
+                            .query(Likes.message_id)
+                            .filter(Likes.user_id == user_id)))
+     .update({Message.like_count: Message.like_count - 1},
+             synchronize_session=False))
+
+    # Likers of this user's messages may have liked several of them.
+    their_likes = (db.session
+                   .query(Likes.user_id)
+                   .join(Message, Message.id == Likes.message_id)
+                   .filter(Message.user_id == user_id))
+    liked_by_user = (db.session
+                     .query(db.func.count(Likes.message_id))
+                     .join(Message, Message.id == Likes.message_id)
+                     .filter(Message.user_id == user_id,
+                             Likes.user_id == User.id)
+                     .correlate(User)
+                     .as_scalar())
+
+    (User
+     .query
+     .filter(User.id.in_(their_likes))
+     .update({User.likes_count: User.likes_count - liked_by_user,
+              User.stats_version: User.stats_version + 1},
+             synchronize_session=False))
+
+
+def recount(user_ids=None):
+    """Recompute every counter from the underlying rows in one UPDATE.
+
+    Applies to all users, or only those in `user_ids`.
+    """
+
+    def count(column, *criteria):
+        return (db.session
+                .query(db.func.count(column))
+                .filter(*criteria)
+                .correlate(User)
+                .as_scalar())
+
+    values = {
+        User.messages_count: count(Message.id, Message.user_id == User.id),
+        User.following_count: count(Follows.user_being_followed_id,
+                                    Follows.user_following_id == User.id),
+        User.followers_count: count(Follows.user_following_id,
+                                    Follows.user_being_followed_id == User.id),
+        User.likes_count: count(Likes.message_id, Likes.user_id == User.id),
+        User.stats_version: User.stats_version + 1,
+    }
+
+    query = User.query
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+
+    query.update(values, synchronize_session=False)
+
+
+def recount_likes(message_ids=None):
+    """Recompute every message's like count in one UPDATE.
+
+    Applies to all messages, or only those in `message_ids`.
+    """
+
+    likes = (db.session
+             .query(db.func.count(Likes.user_id))
+             .filter(Likes.message_id == Message.id)
+             .correlate(Message)
+             .as_scalar())
+
+    query = Message.query
+    if message_ids is not None:
+        query = query.filter(Message.id.in_(message_ids))
+
+    query.update({Message.like_count: likes}, synchronize_session=False)
@@ -0,0 +1,171 @@
+"""Report which indexes the queries behind each route use.
+
+`index_report` requests a set of sample routes through the test client,
+captures every SELECT they send, and asks the database for each one's plan
+(``EXPLAIN`` on Postgres, ``EXPLAIN QUERY PLAN`` on SQLite). For every
+statement it lists the indexes the plan reads and the tables it scans in
+full. ``flask explain-indexes`` prints the report.
+
+Small development databases make full scans look cheapest to the planner;
+`prefer_indexes` discourages them (Postgres only) to show which indexes
+the queries *can* use.
+"""
+
+import re
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from models import db, User, Message
+from query_stats import statement_shape
+
+StatementPlan = namedtuple('StatementPlan', 'statement indexes scans')
+
+# e.g. "SEARCH messages USING INDEX ix_messages_user_feed (user_id=?)"
+SQLITE_PLAN_STEP = re.compile(
+    r"^(?P<op>SCAN|SEARCH) (?:TABLE )?(?P<table>\w+)"
+    r"(?: AS \w+)?"
+    r"(?: USING (?:COVERING )?INDEX (?P<index>\w+)"
+    r"| USING (?P<pk>(?:INTEGER )?PRIMARY KEY))?")
+
+
+def sample_routes():
+    """URLs covering the app's main pages, using real ids from the database.
+
+    Returns the URLs and the id of the user to view them as.
+    """
+
+    user = (User
+            .query
+            .order_by(User.following_count.desc(), User.id)
+            .first())
+    message = Message.query.order_by(Message.id.desc()).first()
+
+    if user is None:
+        return ["/", "/users"], None
+
+    urls = [
+        "/",
+        f"/users/{user.id}",
+        f"/users/{user.id}/following",
+        f"/users/{user.id}/followers",
+        f"/users/{user.id}/likes",
+        "/users",
+        f"/users?q={user.username[:3]}",
+    ]
+
+    if message:
+        word = max(message.text.split() or ['warble'], key=len)
+        urls += [f"/messages/{message.id}",
+                 f"/messages/search?q={word.strip('.,!?')}"]
+
+    return urls, user.id
+
+
+def capture_selects(app, url, user_id=None):
+    """GET `url` and return the (statement, parameters) of each SELECT."""
+
+    from app import CURR_USER_KEY  # app imports this module
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        client = app.test_client()
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = user_id
+        response = client.get(url)
+        # Streamed pages query as they are read.
+        response.get_data()
+        response.close()
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    return captured
+
+
+def postgres_plan(cursor, statement, parameters):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+    plan = cursor.fetchone()[0][0]['Plan']
+
+    indexes, scans = set(), set()
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop()
+        if 'Index Name' in node:
+            indexes.add(node['Index Name'])
+        if node['Node Type'] == 'Seq Scan':
+            scans.add(node['Relation Name'])
+        nodes.extend(node.get('Plans', []))
+
+    return indexes, scans
+
+
+def sqlite_plan(cursor, statement, parameters):
+    cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+
+    indexes, scans = set(), set()
+    for row in cursor.fetchall():
+        step = SQLITE_PLAN_STEP.match(row[-1])
+        if not step:
+            continue
+        if step.group('index'):
+            indexes.add(step.group('index'))
+        elif step.group('pk'):
+            indexes.add(f"{step.group('table')} primary key")
+        elif step.group('op') == 'SCAN':
+            scans.add(step.group('table'))
+
+    return indexes, scans
+
+
+def explain(engine, statements, prefer_indexes=False):
+    """Plan each (statement, parameters) pair. Returns `StatementPlan`s."""
+
+    plan = {'postgresql': postgres_plan,
+            'sqlite': sqlite_plan}.get(engine.dialect.name)
+    if plan is None:
+        raise NotImplementedError(
+            f"Can't read query plans from {engine.dialect.name}")
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if prefer_indexes and engine.dialect.name == 'postgresql':
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+        plans = []
+        for statement, parameters in statements:
+            indexes, scans = plan(cursor, statement, parameters)
+            plans.append(StatementPlan(statement_shape(statement),
+                                       sorted(indexes), sorted(scans)))
+        return plans
+
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def index_report(app, urls=None, user_id=None, prefer_indexes=False):
+    """Map each URL to the plans of the SELECTs it issues.
+
+    Defaults to `sample_routes`, viewed as its sample user.
+    """
+
+    with app.app_context():
+        sample_urls, sample_user_id = sample_routes()
+
+    urls = urls or sample_urls
+    if user_id is None:
+        user_id = sample_user_id
+
+    engine = db.get_engine(app)
+    return {url: explain(engine, capture_selects(app, url, user_id),
+                         prefer_indexes)
+            for url in urls}
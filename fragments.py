@@ -0,0 +1,44 @@
+"""Rendered message list items, cached between requests.
+
+Every viewer sees the same HTML for a message in a list (its author,
+date and text) except for the like button. `message_fragment` renders that
+shared part once and keeps it in a per-process LRU cache, and page
+templates add each viewer's like button around it.
+
+Entries are keyed by message id and remember the author's
+``profile_version``, which `update_profile` bumps; an entry rendered
+before the author last changed their name or picture is a miss. Deleting
+a message must call `forget_message_fragment`.
+"""
+
+from flask import current_app
+from markupsafe import Markup
+
+from cache import LRUCache
+from thumbnails import thumb_url
+
+FRAGMENT_TEMPLATE = 'messages/item.html'
+
+fragment_cache = LRUCache(maxsize=20000)
+
+
+def message_fragment(message):
+    """The viewer-independent HTML of `message`'s list item."""
+
+    version = message.user.profile_version
+    cached = fragment_cache.get(message.id)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    # Rendered straight from the environment: the fragment only reads the
+    # message, so it skips the context processors a page render runs.
+    template = current_app.jinja_env.get_template(FRAGMENT_TEMPLATE)
+    html = Markup(template.render(msg=message, thumb_url=thumb_url))
+    fragment_cache.set(message.id, (version, html))
+    return html
+
+
+def forget_message_fragment(message_id):
+    """Drop the cached fragment for a deleted message."""
+
+    fragment_cache.pop(message_id)
@@ -1,30 +1,64 @@
-"""Generate CSVs of random data for Warbler.
+"""Generate random data for Warbler.
 
 Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+files in this directory. Run it to build bigger datasets, e.g. for
+benchmarks:
+
+    python generator/create_csvs.py --profile 100k --out /tmp/warbler-100k
+    flask load /tmp/warbler-100k/*
+
+Output is deterministic for a given --seed and size, however many
+--workers share the work. Users are generated in fixed-size shards, each
+with its own random stream, and each shard writes its own
+``users.part-NNNN``, ``messages.part-NNNN`` and ``follows.part-NNNN`` files
+a row at a time, so memory use doesn't grow with the dataset.
+
+How many followers each user has, and how many messages each posts,
+follow power laws: a few users are followed by (or post) a great deal and
+most hardly at all. Nothing is fetched over the network.
 """
 
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+
+from helpers import (coprime_stride, heavy_tailed_count, random_datetime,
+                     random_text, scatter, zipf_rank, WORDS)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password',
+                     'bio', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Dataset sizes: (users, messages, follows).
+PROFILES = {
+    '1k': (1_000, 20_000, 30_000),
+    '100k': (100_000, 2_000_000, 3_000_000),
+    '10m': (10_000_000, 200_000_000, 300_000_000),
+}
 
-fake = Faker()
+SHARD_SIZE = 10_000
 
-# Generate random profile image URLs to use for users
+# Follower counts are Zipf-distributed with this exponent, e.g. the most
+# followed user has ~2x the followers of the second.
+POPULARITY_EXPONENT = 1.1
+# The share of follows drawn that way; the rest are of anyone at random.
+POPULAR_SHARE = 0.8
+
+# Messages are spread over the two years up to this (fixed, so the output
+# doesn't depend on when it was generated).
+END = datetime(2021, 1, 1)
+START = END - timedelta(days=730)
+
+# "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +66,135 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+class PartWriter:
+    """Write rows to one part file as CSV or NDJSON."""
+
+    def __init__(self, directory, table, shard, fieldnames, fmt):
+        path = os.path.join(directory, f"{table}.part-{shard:04d}.{fmt}")
+        self.file = open(path, 'w', newline='')
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(self.file, fieldnames=fieldnames)
+            self.csv.writeheader()
+        else:
+            self.csv = None
+
+    def write(self, row):
+        if self.csv:
+            self.csv.writerow(row)
+        else:
+            self.file.write(json.dumps(row, default=str) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def generate_shard(shard, options):
+    """Write one shard's users, and their messages and follows.
+
+    Returns the number of (users, messages, follows) written.
+    """
+
+    users, messages, follows = options['sizes']
+    rng = random.Random(f"{options['seed']}:{shard}")
+    first = shard * SHARD_SIZE + 1
+    last = min(first + SHARD_SIZE - 1, users)
+
+    # The same strides in every shard, so popularity ranks map to the same
+    # users everywhere.
+    stride = coprime_stride(users, users // 3 + 1)
+
+    writers = {table: PartWriter(options['out'], table, shard, headers,
+                                 options['format'])
+               for table, headers in [('users', USERS_CSV_HEADERS),
+                                      ('messages', MESSAGES_CSV_HEADERS),
+                                      ('follows', FOLLOWS_CSV_HEADERS)]}
+    written = [0, 0, 0]
+
+    try:
+        for user_id in range(first, last + 1):
+            writers['users'].write(dict(
+                id=user_id,
+                email=f"user{user_id}@example.com",
+                username=f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}",
+                image_url=rng.choice(image_urls),
+                password=PASSWORD,
+                bio=random_text(rng, 80),
+                location=rng.choice(WORDS).capitalize() + "ville",
+            ))
+            written[0] += 1
+
+            for _ in range(heavy_tailed_count(rng, messages / users,
+                                              cap=messages)):
+                writers['messages'].write(dict(
+                    text=random_text(rng, MAX_WARBLER_LENGTH),
+                    timestamp=random_datetime(rng, START, END),
+                    user_id=user_id,
+                ))
+                written[1] += 1
+
+            # Who this user follows: distinct, never themselves, and
+            # mostly drawn towards the popular. The uniform draws keep
+            # users who follow thousands from exhausting the popular few.
+            count = heavy_tailed_count(rng, follows / users,
+                                       cap=(users - 1) // 2)
+            followed = set()
+            while len(followed) < count:
+                if rng.random() < POPULAR_SHARE:
+                    rank = zipf_rank(rng, users, POPULARITY_EXPONENT)
+                    followed_id = scatter(rank, users, stride)
+                else:
+                    followed_id = rng.randint(1, users)
+                if followed_id != user_id:
+                    followed.add(followed_id)
+
+            for followed_id in sorted(followed):
+                writers['follows'].write(dict(
+                    user_being_followed_id=followed_id,
+                    user_following_id=user_id,
+                ))
+            written[2] += len(followed)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return written
+
+
+@click.command()
+@click.option('--profile', type=click.Choice(sorted(PROFILES)), default='1k',
+              show_default=True, help="Dataset size.")
+@click.option('--users', type=int, help="Override the profile's user count.")
+@click.option('--messages', type=int, help="Override its message count.")
+@click.option('--follows', type=int, help="Override its follow count.")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--workers', type=int, default=os.cpu_count(),
+              show_default=True, help="Processes generating shards.")
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']),
+              default='csv', show_default=True)
+@click.option('--out', type=click.Path(file_okay=False), required=True,
+              help="Directory to write part files to.")
+def main(profile, users, messages, follows, seed, workers, fmt, out):
+    """Write a synthetic Warbler dataset as part files for `flask load`."""
+
+    default_users, default_messages, default_follows = PROFILES[profile]
+    sizes = (users or default_users,
+             messages if messages is not None else default_messages,
+             follows if follows is not None else default_follows)
+
+    os.makedirs(out, exist_ok=True)
+    options = dict(sizes=sizes, seed=seed, format=fmt, out=out)
+    shards = range((sizes[0] + SHARD_SIZE - 1) // SHARD_SIZE)
+
+    totals = [0, 0, 0]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        done = pool.map(generate_shard, shards, [options] * len(shards))
+        for shard, written in zip(shards, done):
+            totals = [total + count for total, count in zip(totals, written)]
+            click.echo(f"Shard {shard + 1}/{len(shards)}: "
+                       f"{totals[0]:,} users, {totals[1]:,} messages, "
+                       f"{totals[2]:,} follows")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,111 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
-from datetime import datetime
-from random import uniform
+Everything takes its randomness from a `random.Random` passed in, so a
+seeded generator always produces the same data.
+"""
 
+from datetime import timedelta
+from math import gcd
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+WORDS = """
+    able about account across act add address agree air allow almost
+    already animal answer arm around art ask away back bad bag ball bank
+    bar base beat beautiful become bed begin behind believe best better
+    big bill bird black blue board boat body book born box boy break bring
+    brother build business buy call camera campaign card care carry case
+    cat catch center chair chance change charge check child choice city
+    claim class clear close coach coffee cold color come common computer
+    cover cup cut dark data day deal deep design dinner dog door dream
+    drive drop early east easy eat edge effort energy enjoy enough enter
+    evening event exactly face fact fall family far fast father fear feel
+    field fight film find fine fire first fish floor fly follow food foot
+    forest forget free friend front fruit full fun game garden gas girl
+    glass goal gold good great green ground group grow guess guy hair half
+    hand happy hard hat head hear heart heat heavy help high hill history
+    hold home hope horse hot hotel hour house huge idea image inside iron
+    island job join joke jump keep key kid kind kitchen know lake land
+    large late laugh lead learn leave left letter light line list listen
+    little live local long look lose loud love low lunch machine magic
+    main make map market matter meal meet memory mind miss moment money
+    month moon morning mother mountain move movie music name nature near
+    need never new news nice night noise north note now ocean office often
+    old open order paper park party pass past pay peace pick picture piece
+    place plan plant play pretty price problem pull push quick quiet race
+    radio rain reach read ready real red remember rest rich ride right
+    river road rock room round run safe salt sand save say school sea
+    season seat second see sell send serve shake share ship shoe shop short
+    show side sign simple sing sister sit size sky sleep slow small smile
+    snow soft song soon sound south space speak special sport spring star
+    start stay step stone stop store story street strong study style sugar
+    summer sun table take talk tall taste team tell test thank thing think
+    ticket time tiny today tomorrow top town train travel tree trip true
+    try turn type under until visit voice wait walk wall want warm wash
+    watch water wave way weather week west wheel white wide wild wind
+    window winter wish wonder wood word work world write yard year yellow
+    young
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def zipf_rank(rng, n, exponent):
+    """A rank in 1..n, rank r drawn with probability about r ** -exponent.
+
+    Inverts the continuous power law's CDF, so it takes constant time and
+    memory however large `n` is. `exponent` must not be 1.
+    """
+
+    span = (n + 1) ** (1 - exponent) - 1
+    rank = int((1 + rng.random() * span) ** (1 / (1 - exponent)))
+    return min(max(rank, 1), n)
+
+
+def scatter(rank, n, stride):
+    """Map rank 1..n to an id 1..n, spreading neighbouring ranks apart.
+
+    Keeps the most popular users from simply being the lowest ids.
+    """
+
+    return (rank * stride) % n + 1
+
+
+def coprime_stride(n, start):
+    """The first number from `start` up that shares no factor with `n`,
+    so `scatter` is a one-to-one mapping."""
+
+    stride = start
+    while gcd(stride, n) != 1:
+        stride += 1
+    return stride
+
+
+def heavy_tailed_count(rng, mean, cap, alpha=2.0):
+    """A count with about the given `mean` and a Pareto tail, at most `cap`.
+
+    Most draws are small and a few are huge, like real follow and posting
+    counts.
+    """
+
+    scale = mean * (alpha - 1) / alpha
+    return min(int(scale * rng.paretovariate(alpha)), cap)
+
+
+def random_datetime(rng, start, end):
+    """A datetime between `start` and `end`."""
+
+    return start + timedelta(seconds=rng.uniform(0, (end - start)
+                                                 .total_seconds()))
+
+
+def random_text(rng, max_length):
+    """A few random words, at most `max_length` characters long."""
+
+    words = []
+    length = -1
+    target = rng.randint(20, max_length - 1)
+    while True:
+        word = rng.choice(WORDS)
+        if length + 1 + len(word) > target:
+            break
+        words.append(word)
+        length += 1 + len(word)
+
+    return ' '.join(words).capitalize() + '.'
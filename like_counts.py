@@ -0,0 +1,148 @@
+"""Per-message like counts, written behind.
+
+Updating ``messages.like_count`` inside every like and unlike would make
+all likes of a popular message wait on that one row's lock. Instead the
+views `record` each +1 or -1 here, in process, and `flush` applies what
+has built up, a few hundred messages per UPDATE, on a connection of its own.
+The app flushes after a request once deltas have waited
+``LIKE_COUNT_FLUSH_INTERVAL`` seconds or ``LIKE_COUNT_FLUSH_SIZE`` messages
+have them, and again when the process exits.
+
+`like_count` adds this process's pending deltas to a message's stored
+count, so people see their own likes straight away. Deltas pending when a
+process dies are lost; ``flask recount-likes`` rebuilds the counts.
+"""
+
+import atexit
+import weakref
+from collections import defaultdict
+from threading import Lock
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import case
+
+from models import db, Message
+
+
+class LikeCountBuffer:
+    """Thread-safe pending like count deltas, by message id."""
+
+    def __init__(self):
+        self._deltas = defaultdict(int)
+        self._since = None
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, message_id, delta):
+        with self._lock:
+            if self._since is None:
+                self._since = monotonic()
+            self._deltas[message_id] += delta
+
+    def pending(self, message_id):
+        """The delta not yet written for `message_id`."""
+
+        return self._deltas.get(message_id, 0)
+
+    def due(self, interval, size):
+        """Have deltas waited `interval` seconds, or piled up for `size`
+        messages?"""
+
+        since = self._since
+        return since is not None and (len(self._deltas) >= size or
+                                      monotonic() - since >= interval)
+
+    def take(self):
+        """Remove and return every pending delta."""
+
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(int)
+            self._since = None
+            return deltas
+
+    def clear(self):
+        self.take()
+
+
+pending_likes = LikeCountBuffer()
+
+# The app that last recorded a delta, to flush through at exit. A weak
+# reference, so apps made and dropped (e.g. by tests) can go.
+_recorded_by = None
+
+
+def record(message_id, delta):
+    """Note a like (+1) or unlike (-1) of `message_id`."""
+
+    global _recorded_by
+
+    _recorded_by = weakref.ref(current_app._get_current_object())
+    pending_likes.add(message_id, delta)
+
+
+def like_count(message):
+    """`message`'s like count, including deltas not yet written."""
+
+    return message.like_count + pending_likes.pending(message.id)
+
+
+def flush(engine=None, batch_size=500):
+    """Write pending deltas in one transaction. Returns how many messages
+    were updated.
+
+    Each UPDATE covers up to `batch_size` messages, adding each one's delta
+    through a CASE on its id. If the flush fails the deltas are kept for
+    the next one.
+    """
+
+    deltas = pending_likes.take()
+    message_ids = sorted(message_id for message_id, delta in deltas.items()
+                         if delta)
+    if not message_ids:
+        return 0
+
+    messages = Message.__table__
+    try:
+        with (engine or db.engine).begin() as connection:
+            # Rows are locked in id order, so flushes from other processes
+            # can't deadlock with this one.
+            for start in range(0, len(message_ids), batch_size):
+                batch = message_ids[start:start + batch_size]
+                delta = case([(messages.c.id == message_id,
+                               deltas[message_id])
+                              for message_id in batch])
+                connection.execute(
+                    messages
+                    .update()
+                    .where(messages.c.id.in_(batch))
+                    .values(like_count=messages.c.like_count + delta))
+    except Exception:
+        for message_id, delta in deltas.items():
+            pending_likes.add(message_id, delta)
+        raise
+
+    return len(message_ids)
+
+
+def flush_if_due(config):
+    """`flush` if the app's flush interval or size has been reached."""
+
+    if pending_likes.due(config['LIKE_COUNT_FLUSH_INTERVAL'],
+                         config['LIKE_COUNT_FLUSH_SIZE']):
+        flush()
+
+
+def flush_at_exit():
+    """Write pending deltas before the process exits, through the app that
+    recorded them."""
+
+    app = _recorded_by() if _recorded_by else None
+    if app is not None and len(pending_likes):
+        with app.app_context():
+            flush()
+
+
+atexit.register(flush_at_exit)
@@ -0,0 +1,38 @@
+"""Which messages a user has liked, cached per user.
+
+Timelines only need the liked state of the messages on the page, so the
+lookup asks the database about those ids alone and remembers the answers
+per user. The like/unlike views call `forget_liked` so the cache never
+outlives a change made through this process; the TTL bounds staleness
+from changes made through other worker processes.
+"""
+
+from cache import LRUCache
+from models import Likes
+
+liked_cache = LRUCache(maxsize=10000, ttl=60)
+
+
+def liked_message_ids(user_id, message_ids):
+    """Which of `message_ids` has `user_id` liked? Returns a set."""
+
+    message_ids = list(message_ids)
+    known = liked_cache.get(user_id)
+    if known is None:
+        known = {}
+        liked_cache.set(user_id, known)
+
+    unknown = [message_id for message_id in message_ids
+               if message_id not in known]
+    if unknown:
+        liked = Likes.liked_ids(user_id, unknown)
+        for message_id in unknown:
+            known[message_id] = message_id in liked
+
+    return {message_id for message_id in message_ids if known[message_id]}
+
+
+def forget_liked(user_id):
+    """Drop cached liked state for `user_id` after a like or unlike."""
+
+    liked_cache.pop(user_id)
@@ -0,0 +1,372 @@
+"""Stream CSV or NDJSON files into the database.
+
+``flask load users.csv messages.csv follows.csv`` reads each file a chunk
+of rows at a time and writes the chunk with ``COPY ... FROM STDIN`` on
+Postgres (one batched INSERT elsewhere), committing after every chunk. A
+file's table is the start of its name, so ``messages.csv`` and
+``messages.part-0003.ndjson`` both load into ``messages``; files load
+parents first so foreign keys hold.
+
+By default the load replaces every table, and secondary indexes are
+dropped while rows stream in and rebuilt afterwards. With `append` the
+rows are added to a live database and its indexes are left alone, and only
+the counters of the users and messages the new rows touch are recounted.
+Either way the derived data the app keeps (counters, timelines, the search
+index) is brought up to date at the end.
+
+Messages without an id get one made from their timestamp, under the worker
+id reserved for the loader, so they can't collide with ids the app makes.
+Within a load, messages sharing a millisecond take consecutive sequence
+numbers; when appending, each chunk is checked against the ids already in
+the database, as an earlier load may have used the same ones.
+"""
+
+import csv
+import io
+import json
+import time
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain, islice
+from pathlib import Path
+
+from sqlalchemy import Boolean, DateTime, Integer, select, text
+
+from counters import recount, recount_likes
+from message_search import reindex_messages
+from migrations import stamp
+from models import db
+from snowflake import LOADER_WORKER_ID, MAX_SEQUENCE, SEQUENCE_BITS, id_at
+from timeline import fan_out_pending, rebuild_timelines
+
+# Parents before children.
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+CHUNK_SIZE = 10000
+
+# Columns naming the users and messages whose counters a row changes.
+COUNTED = {
+    'messages': {'user_id': 'users', 'id': 'messages'},
+    'follows': {'user_being_followed_id': 'users',
+                'user_following_id': 'users'},
+    'likes': {'user_id': 'users', 'message_id': 'messages'},
+}
+
+
+def table_for(path):
+    """The table a file loads into, from its name."""
+
+    name = Path(path).name.split('.')[0]
+    if name not in TABLES:
+        raise ValueError(f"Can't tell which table {path} is for; "
+                         f"name it after one of {', '.join(TABLES)}")
+    return db.metadata.tables[name]
+
+
+def read_rows(path):
+    """Yield a file's rows as dicts, one at a time."""
+
+    with open(path, newline='') as file:
+        if Path(path).suffix in ('.ndjson', '.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+class MessageIds:
+    """Snowflake ids for one load's messages, made from their timestamps
+    under `LOADER_WORKER_ID`."""
+
+    def __init__(self):
+        # Next sequence number, by millisecond.
+        self.sequences = defaultdict(int)
+
+    def __call__(self, timestamp):
+        moment = id_at(timestamp)
+        sequence = self.sequences[moment]
+        if sequence > MAX_SEQUENCE:
+            raise ValueError(f"More than {MAX_SEQUENCE + 1} messages at "
+                             f"{timestamp}; can't give them all ids")
+
+        self.sequences[moment] = sequence + 1
+        return moment | LOADER_WORKER_ID << SEQUENCE_BITS | sequence
+
+
+def parse(column, value):
+    """Convert a value read from a file to `column`'s Python type."""
+
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(column.type, Boolean):
+        return value.lower() in ('t', 'true', '1', 'yes')
+    if isinstance(column.type, Integer):
+        return int(value)
+    return value
+
+
+class RowLayout:
+    """How rows of one file map onto their table's columns.
+
+    Columns missing from the file, or empty in a row, get their Python-side
+    default if they have one; the database fills in the rest.
+    """
+
+    def __init__(self, table, keys, message_ids):
+        self.table = table
+        self.message_ids = message_ids
+        self.defaults = {column.name: column.default
+                         for column in table.columns
+                         if column.default is not None and
+                         column.server_default is None}
+        self.columns = [column for column in table.columns
+                        if column.name in keys or
+                        column.name in self.defaults]
+
+    def default(self, name, values):
+        # Order messages by when they were written, not when they loaded.
+        if self.table.name == 'messages' and name == 'id':
+            return self.message_ids(values['timestamp'])
+
+        default = self.defaults[name]
+        return default.arg(None) if default.is_callable else default.arg
+
+    def values(self, row):
+        values = {column.name: parse(column, row.get(column.name))
+                  for column in self.columns}
+
+        missing = [name for name, value in values.items()
+                   if value is None and name in self.defaults]
+        # Ids last: a message's is made from its timestamp.
+        for name in sorted(missing, key=lambda name: name == 'id'):
+            values[name] = self.default(name, values)
+
+        return tuple(values.values())
+
+
+def copy_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def copy_chunk(raw_connection, layout, chunk):
+    """COPY one chunk of rows in, and commit."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for values in chunk:
+        writer.writerow([copy_value(value) for value in values])
+    buffer.seek(0)
+
+    columns = ', '.join(column.name for column in layout.columns)
+    cursor = raw_connection.cursor()
+    cursor.copy_expert(f"COPY {layout.table.name} ({columns}) "
+                       f"FROM STDIN WITH (FORMAT csv)", buffer)
+    raw_connection.commit()
+
+
+def insert_chunk(engine, layout, chunk):
+    """INSERT one chunk of rows with a single executemany, and commit."""
+
+    names = [column.name for column in layout.columns]
+    with engine.begin() as connection:
+        connection.execute(layout.table.insert(),
+                           [dict(zip(names, values)) for values in chunk])
+
+
+def check_message_ids(engine, layout, chunk):
+    """Raise ValueError if any of a chunk of messages' ids is taken."""
+
+    position = [column.name for column in layout.columns].index('id')
+    ids = [values[position] for values in chunk]
+
+    with engine.connect() as connection:
+        taken = connection.execute(
+            select([layout.table.c.id])
+            .where(layout.table.c.id.in_(ids))
+            .limit(1)).scalar()
+
+    if taken is not None:
+        raise ValueError(f"Message id {taken} is already in the database, "
+                         f"e.g. from an earlier load of messages at the same "
+                         f"times; the rows before it were loaded")
+
+
+def touched_ids(table, layout, chunk, touched):
+    """Add the ids of users and messages whose counters `chunk` changes to
+    `touched`."""
+
+    names = [column.name for column in layout.columns]
+    for name, kind in COUNTED.get(table.name, {}).items():
+        if name in names:
+            position = names.index(name)
+            touched[kind].update(values[position] for values in chunk)
+
+
+def recount_touched(touched, batch_size=CHUNK_SIZE):
+    """Recount the counters of the users and messages in `touched`."""
+
+    for kind, recount_ids in (('users', recount), ('messages', recount_likes)):
+        ids = sorted(touched[kind])
+        for start in range(0, len(ids), batch_size):
+            recount_ids(ids[start:start + batch_size])
+
+
+def secondary_indexes(connection, table):
+    """(name, definition) of each index on `table` not backing a key."""
+
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text(
+            "SELECT index_class.relname, pg_get_indexdef(index_class.oid) "
+            "FROM pg_index "
+            "JOIN pg_class index_class "
+            "  ON index_class.oid = pg_index.indexrelid "
+            "JOIN pg_class table_class "
+            "  ON table_class.oid = pg_index.indrelid "
+            "WHERE table_class.relname = :table AND NOT EXISTS ("
+            "  SELECT 1 FROM pg_constraint "
+            "  WHERE pg_constraint.conindid = pg_index.indexrelid)"),
+            table=table.name)
+
+    elif connection.dialect.name == 'sqlite':
+        # Key indexes are made implicitly and have no SQL.
+        rows = connection.execute(text(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = :table "
+            "AND sql IS NOT NULL"),
+            table=table.name)
+
+    else:
+        return []
+
+    return [tuple(row) for row in rows]
+
+
+def drop_indexes(engine, tables):
+    """Drop the secondary indexes of `tables`. Returns their definitions."""
+
+    with engine.begin() as connection:
+        dropped = [index for table in tables
+                   for index in secondary_indexes(connection, table)]
+        for name, _ in dropped:
+            connection.execute(text(f"DROP INDEX {name}"))
+
+    return dropped
+
+
+def restore_indexes(engine, indexes):
+    with engine.begin() as connection:
+        for _, definition in indexes:
+            connection.execute(text(definition))
+
+
+def reset_sequences(engine, tables):
+    """Move serial id sequences past ids that were loaded explicitly."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as connection:
+        for table in tables:
+            if list(table.primary_key.columns.keys()) != ['id']:
+                continue
+            # No-op for tables without a sequence, e.g. messages.
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}"))
+
+
+def load(paths, append=False, defer_indexes=None, chunk_size=CHUNK_SIZE,
+         progress=lambda table, rows, rate: None):
+    """Load CSV/NDJSON files into the tables they're named after.
+
+    Replaces all data unless `append`. `defer_indexes` (default: unless
+    appending) drops secondary indexes until the rows are in. `progress`
+    is called after each chunk with the table name, rows loaded into it
+    so far and rows per second. Returns the rows loaded per table.
+    """
+
+    sources = sorted(((table_for(path), path) for path in paths),
+                     key=lambda source: TABLES.index(source[0].name))
+    tables = list({table.name: table for table, _ in sources}.values())
+    if defer_indexes is None:
+        defer_indexes = not append
+
+    engine = db.engine
+    if not append:
+        db.drop_all()
+        db.create_all()
+        stamp()
+        db.session.commit()
+
+    deferred = drop_indexes(engine, tables) if defer_indexes else []
+
+    use_copy = engine.dialect.name == 'postgresql'
+    raw_connection = engine.raw_connection() if use_copy else None
+    loaded = defaultdict(int)
+    touched = defaultdict(set)
+    message_ids = MessageIds()
+    started = time.monotonic()
+
+    try:
+        for table, path in sources:
+            rows = read_rows(path)
+            first = next(rows, None)
+            if first is None:
+                continue
+
+            layout = RowLayout(table, first.keys(), message_ids)
+            rows = (layout.values(row) for row in chain([first], rows))
+
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                if append:
+                    if table.name == 'messages':
+                        check_message_ids(engine, layout, chunk)
+                    touched_ids(table, layout, chunk, touched)
+
+                if use_copy:
+                    copy_chunk(raw_connection, layout, chunk)
+                else:
+                    insert_chunk(engine, layout, chunk)
+
+                loaded[table.name] += len(chunk)
+                elapsed = time.monotonic() - started
+                progress(table.name, loaded[table.name],
+                         sum(loaded.values()) / max(elapsed, 1e-6))
+    finally:
+        if raw_connection is not None:
+            raw_connection.close()
+        # Even if a chunk failed: the database is live.
+        restore_indexes(engine, deferred)
+
+    reset_sequences(engine, tables)
+
+    # New follows bring older messages into timelines, which fan-out
+    # doesn't; only new messages can be fanned out incrementally.
+    if append and 'follows' not in loaded:
+        fan_out_pending()
+    else:
+        rebuild_timelines()
+    reindex_messages(only_missing=append)
+    if append:
+        recount_touched(touched)
+    else:
+        recount()
+        recount_likes()
+    db.session.commit()
+
+    return dict(loaded)
@@ -0,0 +1,149 @@
+"""Backfill snowflake ids for messages created before they existed.
+
+Older messages have small serial ids that don't sort by time. The backfill
+gives each one an id made from its timestamp (see `snowflake`), repoints
+its likes, and rebuilds the timelines and search index, which are keyed by
+message id. Rows are moved set-wise through a temporary old-to-new id map,
+so the work is a handful of statements however many messages there are.
+
+This is migration 0006's body, so it is written against the schema of that
+migration in plain SQL, not the models, which keep changing.
+"""
+
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+
+from models import db
+
+# Serial ids never reach this; snowflakes made after 2010-01-01 00:00:01
+# are all above it.
+LEGACY_ID_LIMIT = 2 ** 31
+
+# The snowflake layout ids are stored in.
+SNOWFLAKE_EPOCH = datetime(2010, 1, 1)
+TIMESTAMP_SHIFT = 22
+
+# Widen message id columns to 64 bits. (SQLite integers already are.)
+POSTGRES_SCHEMA_CHANGES = [
+    "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT",
+    "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT",
+    "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT",
+    "ALTER TABLE timeline_entries ALTER COLUMN message_id TYPE BIGINT",
+]
+
+# Rebuild every home timeline, leaving heavy authors' messages to be
+# pulled when timelines are read.
+REBUILD_TIMELINES = [
+    "DELETE FROM timeline_entries",
+    "UPDATE messages SET fanned_out = user_id NOT IN ("
+    "  SELECT user_being_followed_id FROM follows"
+    "  GROUP BY user_being_followed_id HAVING count(*) > :fanout_limit)",
+    "INSERT INTO timeline_entries (user_id, message_id, author_id) "
+    "SELECT follows.user_following_id, messages.id, messages.user_id "
+    "FROM messages "
+    "JOIN follows ON follows.user_being_followed_id = messages.user_id "
+    "WHERE messages.fanned_out "
+    "AND follows.user_following_id != messages.user_id",
+    "INSERT INTO timeline_entries (user_id, message_id, author_id) "
+    "SELECT user_id, id, user_id FROM messages WHERE fanned_out",
+]
+
+REINDEX = {
+    'postgresql': "UPDATE messages "
+                  "SET search_vector = to_tsvector('english', text)",
+    'sqlite': "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+}
+
+id_map = db.Table(
+    'message_id_map', db.MetaData(),
+    db.Column('old_id', db.BigInteger, primary_key=True),
+    db.Column('new_id', db.BigInteger, nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+
+def id_at(timestamp):
+    """The smallest snowflake id made at `timestamp`."""
+
+    ms = (timestamp - SNOWFLAKE_EPOCH) // timedelta(milliseconds=1)
+    return max(ms, 0) << TIMESTAMP_SHIFT
+
+
+def new_ids(rows):
+    """Assign increasing ids to (id, timestamp) rows in timestamp order.
+
+    Each id is made from the row's timestamp; rows sharing a millisecond
+    take the following ids so no two collide.
+    """
+
+    previous = 0
+    for old_id, timestamp in rows:
+        new_id = max(id_at(timestamp), previous + 1)
+        yield old_id, new_id
+        previous = new_id
+
+
+def rebuild_timelines(connection):
+    for statement in REBUILD_TIMELINES:
+        connection.execute(
+            text(statement),
+            fanout_limit=current_app.config['TIMELINE_FANOUT_LIMIT'])
+
+
+def backfill_message_ids(batch_size=10000):
+    """Give every legacy message a snowflake id. Returns how many moved."""
+
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+
+    if dialect == 'postgresql':
+        for statement in POSTGRES_SCHEMA_CHANGES:
+            connection.execute(text(statement))
+
+    id_map.create(bind=connection, checkfirst=True)
+
+    legacy = (connection
+              .execution_options(stream_results=True)
+              .execute(text("SELECT id, timestamp FROM messages "
+                            "WHERE id < :limit ORDER BY timestamp, id"),
+                       limit=LEGACY_ID_LIMIT))
+
+    moved = 0
+    batch = []
+    for old_id, new_id in new_ids(legacy):
+        batch.append({'old_id': old_id, 'new_id': new_id})
+        if len(batch) == batch_size:
+            connection.execute(id_map.insert(), batch)
+            moved += len(batch)
+            batch = []
+
+    if batch:
+        connection.execute(id_map.insert(), batch)
+        moved += len(batch)
+
+    if moved:
+        # Copy each message under its new id, move its likes across, then
+        # delete the original (timeline entries cascade or are rebuilt).
+        connection.execute(text(
+            "INSERT INTO messages (id, text, timestamp, user_id, fanned_out) "
+            "SELECT message_id_map.new_id, text, timestamp, user_id, false "
+            "FROM messages "
+            "JOIN message_id_map ON message_id_map.old_id = messages.id"))
+        connection.execute(text(
+            "UPDATE likes SET message_id = ("
+            "  SELECT new_id FROM message_id_map "
+            "  WHERE old_id = likes.message_id) "
+            "WHERE message_id IN (SELECT old_id FROM message_id_map)"))
+        connection.execute(text(
+            "DELETE FROM messages "
+            "WHERE id IN (SELECT old_id FROM message_id_map)"))
+
+        if dialect in REINDEX:
+            connection.execute(text(REINDEX[dialect]))
+
+    rebuild_timelines(connection)
+    id_map.drop(bind=connection)
+
+    return moved
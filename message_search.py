@@ -0,0 +1,213 @@
+"""Full-text search over messages.
+
+On Postgres, ``messages`` gets a ``search_vector`` tsvector column with a GIN
+index; on SQLite, an external-content FTS5 table ``messages_fts`` indexes
+the message text. Neither is mapped on `Message`, so they never add to the
+rows loaded elsewhere.
+
+The index is maintained as messages are written: call `index_message` after
+a new message is flushed and `unindex_message` before one is deleted.
+`reindex_messages` rebuilds it after bulk loads.
+
+Results are ranked by relevance (``ts_rank_cd`` or ``bm25``), newest first
+among equals, and paged with a (score, id) cursor. Other databases fall
+back to an unindexed LIKE that ranks shorter messages higher.
+"""
+
+from datetime import datetime, timezone
+
+from sqlalchemy import DDL, Float, and_, event, literal_column, text, tuple_
+from sqlalchemy.sql import column, table
+
+from models import db, Message
+from pagination import decode_key, encode_key
+from snowflake import id_at, timestamp_of
+
+TEXT_SEARCH_CONFIG = 'english'
+
+# The last moment a message id can stand for.
+LATEST_TIME = timestamp_of((1 << 63) - 1)
+
+POSTGRES_DDL = [
+    DDL("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_messages_search "
+        "ON messages USING gin (search_vector)"),
+]
+
+SQLITE_DDL = [
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+        "USING fts5(text, content='messages', content_rowid='id', "
+        "tokenize='porter')"),
+]
+
+for ddl in POSTGRES_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 ddl.execute_if(dialect='postgresql'))
+
+for ddl in SQLITE_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 ddl.execute_if(dialect='sqlite'))
+
+event.listen(Message.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts")
+             .execute_if(dialect='sqlite'))
+
+messages_fts = table('messages_fts', column('rowid'))
+
+
+def dialect():
+    """Name of the database dialect in use, e.g. ``'postgresql'``."""
+
+    return db.session.get_bind().dialect.name
+
+
+def index_message(message):
+    """Add a newly-flushed message to the search index."""
+
+    if dialect() == 'postgresql':
+        db.session.execute(
+            text("UPDATE messages "
+                 "SET search_vector = to_tsvector(:config, text) "
+                 "WHERE id = :id"),
+            {'config': TEXT_SEARCH_CONFIG, 'id': message.id})
+
+    elif dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (rowid, text) VALUES (:id, :text)"),
+            {'id': message.id, 'text': message.text})
+
+
+def unindex_message(message):
+    """Remove a message that is about to be deleted from the search index.
+
+    Postgres drops the index entries along with the row.
+    """
+
+    if dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (messages_fts, rowid, text) "
+                 "VALUES ('delete', :id, :text)"),
+            {'id': message.id, 'text': message.text})
+
+
+def reindex_messages(only_missing=False):
+    """Rebuild the search index for every message.
+
+    With `only_missing`, Postgres indexes just the messages that aren't
+    yet, e.g. after a bulk load; SQLite rebuilds its whole index anyway.
+    """
+
+    if dialect() == 'postgresql':
+        where = " WHERE search_vector IS NULL" if only_missing else ""
+        db.session.execute(
+            text("UPDATE messages "
+                 "SET search_vector = to_tsvector(:config, text)" + where),
+            {'config': TEXT_SEARCH_CONFIG})
+
+    elif dialect() == 'sqlite':
+        db.session.execute(
+            text("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+def parse_time(value):
+    """Parse an ISO 8601 date or datetime from a query string, if given,
+    as a naive UTC datetime.
+
+    Raises ValueError if it is malformed or later than any message id.
+    """
+
+    if not value:
+        return None
+
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        try:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            raise ValueError(f"Out of range: {value}")
+
+    if moment > LATEST_TIME:
+        raise ValueError(f"Out of range: {value}")
+    return moment
+
+
+def encode_rank_cursor(score, id):
+    """Encode a result's (score, id) ranking as an opaque cursor."""
+
+    return encode_key(score, id)
+
+
+def decode_rank_cursor(cursor):
+    """Decode a cursor made by `encode_rank_cursor`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    return decode_key(cursor, float, int)
+
+
+def matching(terms):
+    """A query for messages matching every word in `terms`, with a score
+    column where higher is better."""
+
+    if dialect() == 'postgresql':
+        vector = literal_column('messages.search_vector')
+        tsquery = db.func.plainto_tsquery(TEXT_SEARCH_CONFIG, terms)
+        # ts_rank_cd() is a real; compare cursors at double precision.
+        score = db.cast(db.func.ts_rank_cd(vector, tsquery), Float)
+
+        return (db.session
+                .query(Message, score)
+                .filter(vector.op('@@')(tsquery))), score
+
+    if dialect() == 'sqlite':
+        # Quote each word so FTS5 query syntax in user input is inert.
+        phrase = ' '.join('"{}"'.format(word.replace('"', '""'))
+                          for word in terms.split())
+        score = -literal_column('bm25(messages_fts)')
+
+        return (db.session
+                .query(Message, score)
+                .join(messages_fts, messages_fts.c.rowid == Message.id)
+                .filter(literal_column('messages_fts').op('MATCH')(phrase))
+                ), score
+
+    lowered = db.func.lower(Message.text)
+    score = -db.func.length(Message.text)
+    words = [lowered.contains(word, autoescape=True)
+             for word in terms.lower().split()]
+
+    return db.session.query(Message, score).filter(and_(*words)), score
+
+
+def search_messages(terms, since=None, until=None, after=None, limit=100):
+    """One page of messages matching `terms`, most relevant first.
+
+    `since` and `until` bound when the messages were posted (inclusive and
+    exclusive); as ids sort by time, these are ranges on the primary key.
+    `after` is a decoded cursor; returns the messages and the cursor for
+    the next page (None on the last page).
+    """
+
+    query, score = matching(terms)
+    query = query.options(Message.with_authors())
+
+    if since:
+        query = query.filter(Message.id >= id_at(since))
+    if until:
+        query = query.filter(Message.id < id_at(until))
+    if after:
+        query = query.filter(tuple_(score, Message.id) < after)
+
+    rows = (query
+            .order_by(score.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        message, score = rows[-1]
+        return ([message for message, _ in rows],
+                encode_rank_cursor(score, message.id))
+
+    return [message for message, _ in rows], None
@@ -0,0 +1,393 @@
+"""Versioned schema migrations.
+
+`db.create_all()` only creates missing tables, so databases made by earlier
+versions of Warbler lack columns and indexes added since. Each `Migration`
+here brings an existing database forward one step; ``schema_migrations``
+records which have been applied. ``flask db-upgrade`` applies the pending
+ones in order and ``flask db-status`` lists them. ``flask create-db`` builds
+a new database from the models, which are always current, and marks every
+migration as applied.
+
+A migration's `upgrade` runs in a transaction. Its indexes are built after
+that commits, one at a time, with ``CREATE INDEX CONCURRENTLY`` on Postgres
+so reads and writes continue while they build. Every step is written so
+that re-running it is harmless: an interrupted upgrade can simply be run
+again.
+
+Migration bodies are plain SQL against the schema of their own time. They
+never go through the models or the helpers that use them, which describe
+the current schema: a migration written that way breaks as soon as a later
+one changes a table it touches.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from message_ids import backfill_message_ids
+from models import db
+
+schema_migrations = db.Table(
+    'schema_migrations', db.metadata,
+    db.Column('version', db.String(64), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              default=datetime.utcnow),
+)
+
+# An index to build. `columns` are SQL expressions, e.g. "id DESC";
+# `using` is an index method, `dialect` limits it to one database and
+# `where` makes it a partial index.
+IndexSpec = namedtuple('IndexSpec',
+                       'name table columns unique using dialect where')
+IndexSpec.__new__.__defaults__ = (False, None, None, None)
+
+
+class Migration:
+    """One versioned step: a transactional `upgrade` and/or `indexes`.
+
+    `indexes` is a list of `IndexSpec`, or a callable taking a connection
+    and returning one.
+    """
+
+    def __init__(self, version, description, upgrade=None, indexes=()):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.indexes = indexes
+
+    def __repr__(self):
+        return f"<Migration {self.version}: {self.description}>"
+
+    def index_specs(self, connection):
+        if callable(self.indexes):
+            return self.indexes(connection)
+        return self.indexes
+
+
+def dialect():
+    """Name of the database dialect in use, e.g. ``'postgresql'``."""
+
+    return db.session.get_bind().dialect.name
+
+
+def execute(*statements):
+    """Run each SQL statement in the migration's transaction."""
+
+    for statement in statements:
+        db.session.execute(text(statement))
+
+
+def trigrams_available(connection):
+    """Can pg_trgm be installed in `connection`'s database?"""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return connection.execute(text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar() is not None
+
+
+def add_column(table, name, definition):
+    """Add column `name` to `table` unless it already exists."""
+
+    connection = db.session.connection()
+    columns = {column['name']
+               for column in inspect(connection).get_columns(table)}
+
+    if name not in columns:
+        connection.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+
+
+def drop_column(table, name):
+    """Drop column `name` from `table` if it exists."""
+
+    connection = db.session.connection()
+    columns = {column['name']
+               for column in inspect(connection).get_columns(table)}
+
+    if name in columns:
+        connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {name}"))
+
+
+def create_index(engine, index):
+    """Build `index` if it doesn't exist yet, without blocking writes where
+    the database allows."""
+
+    if index.dialect and engine.dialect.name != index.dialect:
+        return
+
+    unique = 'UNIQUE ' if index.unique else ''
+    using = f' USING {index.using}' if index.using else ''
+    columns = ', '.join(index.columns)
+    where = f' WHERE {index.where}' if index.where else ''
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY can't run inside a transaction block.
+            connection = connection.execution_options(
+                isolation_level='AUTOCOMMIT')
+
+            # A failed concurrent build leaves an invalid index behind,
+            # which IF NOT EXISTS would mistake for a finished one.
+            invalid = connection.execute(text(
+                "SELECT 1 FROM pg_index "
+                "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"),
+                name=index.name).scalar()
+            if invalid:
+                connection.execute(
+                    text(f"DROP INDEX CONCURRENTLY {index.name}"))
+
+            concurrently = 'CONCURRENTLY '
+        else:
+            concurrently = ''
+
+        connection.execute(text(
+            f"CREATE {unique}INDEX {concurrently}IF NOT EXISTS {index.name} "
+            f"ON {index.table}{using} ({columns}){where}"))
+
+
+##############################################################################
+# Migrations, oldest first. Never edit or reorder one that has shipped; add
+# a new one instead.
+
+
+def create_missing_tables():
+    # Tables added since the original four, as they were when this shipped.
+    execute(
+        "CREATE TABLE IF NOT EXISTS timeline_entries ("
+        " user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,"
+        " message_id BIGINT NOT NULL"
+        "  REFERENCES messages (id) ON DELETE CASCADE,"
+        " author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,"
+        " PRIMARY KEY (user_id, message_id))")
+
+
+def add_user_counters():
+    for name in ('messages_count', 'following_count', 'followers_count',
+                 'likes_count'):
+        add_column('users', name, "INTEGER NOT NULL DEFAULT 0")
+
+    execute(
+        "UPDATE users SET "
+        "messages_count = (SELECT count(*) FROM messages "
+        "                  WHERE messages.user_id = users.id), "
+        "following_count = (SELECT count(*) FROM follows "
+        "                   WHERE follows.user_following_id = users.id), "
+        "followers_count = (SELECT count(*) FROM follows "
+        "                   WHERE follows.user_being_followed_id = users.id), "
+        "likes_count = (SELECT count(*) FROM likes "
+        "               WHERE likes.user_id = users.id)")
+
+
+def add_timeline_fanout():
+    # Until timelines are rebuilt (0006), messages that aren't fanned out
+    # are pulled into home timelines when they are read.
+    add_column('messages', 'fanned_out', "BOOLEAN NOT NULL DEFAULT false")
+
+
+def add_message_search():
+    if dialect() == 'postgresql':
+        execute(
+            "ALTER TABLE messages "
+            "ADD COLUMN IF NOT EXISTS search_vector tsvector",
+            "UPDATE messages "
+            "SET search_vector = to_tsvector('english', text)")
+
+    elif dialect() == 'sqlite':
+        execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts "
+            "USING fts5(text, content='messages', content_rowid='id', "
+            "tokenize='porter')",
+            "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def adopt_snowflake_ids():
+    # Feeds order by id now; the timestamp-ordered indexes go.
+    execute("DROP INDEX IF EXISTS ix_timeline_entries_feed",
+            "DROP INDEX IF EXISTS ix_messages_user_feed")
+    drop_column('timeline_entries', 'timestamp')
+
+    backfill_message_ids()
+
+
+def add_username_trigrams():
+    if trigrams_available(db.session.connection()):
+        execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+def username_trigram_index(connection):
+    if not trigrams_available(connection):
+        return []
+
+    return [IndexSpec('ix_users_username_trgm', 'users',
+                      ['lower(username) gin_trgm_ops'],
+                      using='gin', dialect='postgresql')]
+
+
+def key_likes_by_user_and_message():
+    # Likes had a serial id and a unique message_id, so each message could
+    # only ever be liked once; (user_id, message_id) becomes the key.
+    connection = db.session.connection()
+    inspector = inspect(connection)
+    columns = {column['name'] for column in inspector.get_columns('likes')}
+
+    if 'id' in columns:
+        connection.execute(text(
+            "DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL"))
+
+        if dialect() == 'postgresql':
+            for constraint in inspector.get_unique_constraints('likes'):
+                connection.execute(text(
+                    f"ALTER TABLE likes DROP CONSTRAINT {constraint['name']}"))
+            connection.execute(text("ALTER TABLE likes DROP COLUMN id"))
+            connection.execute(text(
+                "ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)"))
+        else:
+            # SQLite can't change a table's keys in place.
+            connection.execute(
+                text("ALTER TABLE likes RENAME TO likes_legacy"))
+            connection.execute(text(
+                "CREATE TABLE likes ("
+                " user_id INTEGER NOT NULL"
+                "  REFERENCES users (id) ON DELETE CASCADE,"
+                " message_id BIGINT NOT NULL"
+                "  REFERENCES messages (id) ON DELETE CASCADE,"
+                " PRIMARY KEY (user_id, message_id))"))
+            connection.execute(text(
+                "INSERT OR IGNORE INTO likes (user_id, message_id) "
+                "SELECT user_id, message_id FROM likes_legacy"))
+            connection.execute(text("DROP TABLE likes_legacy"))
+
+    # The primary key covers a user's likes now.
+    connection.execute(text("DROP INDEX IF EXISTS ix_likes_user"))
+
+    add_column('messages', 'like_count', "INTEGER NOT NULL DEFAULT 0")
+    execute(
+        "UPDATE messages SET like_count = ("
+        "  SELECT count(*) FROM likes WHERE likes.message_id = messages.id)")
+
+
+def add_profile_versions():
+    add_column('users', 'profile_version', "INTEGER NOT NULL DEFAULT 0")
+
+
+def add_stats_versions():
+    add_column('users', 'stats_version', "INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    Migration('0001', "Create tables added since the database was made",
+              upgrade=create_missing_tables),
+    Migration('0002', "Denormalized user counters",
+              upgrade=add_user_counters),
+    Migration('0003', "Fan-out flag on messages",
+              upgrade=add_timeline_fanout),
+    Migration('0004', "Full-text message search",
+              upgrade=add_message_search,
+              indexes=[IndexSpec('ix_messages_search', 'messages',
+                                 ['search_vector'],
+                                 using='gin', dialect='postgresql')]),
+    Migration('0005', "Trigram username search",
+              upgrade=add_username_trigrams,
+              indexes=username_trigram_index),
+    Migration('0006', "Snowflake message ids",
+              upgrade=adopt_snowflake_ids,
+              indexes=[IndexSpec('ix_messages_user_feed', 'messages',
+                                 ['user_id', 'id'])]),
+    Migration('0007', "Indexes for follow, like and timeline lookups",
+              indexes=[
+                  IndexSpec('ix_follows_following', 'follows',
+                            ['user_following_id', 'user_being_followed_id']),
+                  IndexSpec('ix_likes_user', 'likes',
+                            ['user_id', 'message_id']),
+                  IndexSpec('ix_timeline_entries_author', 'timeline_entries',
+                            ['author_id', 'user_id']),
+                  IndexSpec('ix_timeline_entries_message', 'timeline_entries',
+                            ['message_id']),
+              ]),
+    Migration('0008', "Likes keyed by user and message, with like counts",
+              upgrade=key_likes_by_user_and_message,
+              indexes=[
+                  IndexSpec('ix_likes_message', 'likes', ['message_id']),
+                  IndexSpec('ix_messages_like_count', 'messages',
+                            ['like_count']),
+              ]),
+    Migration('0009', "Profile versions for cached message fragments",
+              upgrade=add_profile_versions),
+    Migration('0010', "Stats versions for page validators",
+              upgrade=add_stats_versions),
+    Migration('0011', "Partial index of messages pulled into timelines",
+              indexes=[
+                  IndexSpec('ix_messages_pulled', 'messages',
+                            ['user_id', 'id'], dialect='postgresql',
+                            where="NOT fanned_out"),
+                  IndexSpec('ix_messages_pulled', 'messages',
+                            ['user_id', 'id'], dialect='sqlite',
+                            where="fanned_out = 0"),
+              ]),
+]
+
+
+##############################################################################
+# Applying migrations
+
+
+def applied_versions():
+    """Versions recorded as applied, with when."""
+
+    schema_migrations.create(bind=db.session.connection(), checkfirst=True)
+    rows = db.session.execute(schema_migrations.select())
+    return {row.version: row.applied_at for row in rows}
+
+
+def pending_migrations():
+    """Migrations not yet applied, oldest first."""
+
+    applied = applied_versions()
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied]
+
+
+def record(migration):
+    db.session.execute(schema_migrations.insert(),
+                       {'version': migration.version})
+
+
+def upgrade(echo=lambda migration: None):
+    """Apply every pending migration in order. Returns those applied.
+
+    `echo` is called with each migration as it starts.
+    """
+
+    pending = pending_migrations()
+    db.session.commit()
+
+    for migration in pending:
+        echo(migration)
+
+        if migration.upgrade:
+            migration.upgrade()
+        indexes = migration.index_specs(db.session.connection())
+        # Concurrent builds wait out every open transaction, ours included.
+        db.session.commit()
+
+        engine = db.get_engine()
+        for index in indexes:
+            create_index(engine, index)
+
+        record(migration)
+        db.session.commit()
+
+    return pending
+
+
+def stamp():
+    """Mark every migration as applied, e.g. for a database just created
+    from the models."""
+
+    for migration in pending_migrations():
+        record(migration)
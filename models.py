@@ -4,9 +4,45 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+
+from query_stats import QueryStats
+from snowflake import next_id
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
+query_stats = QueryStats()
+
+
+def insert_or_ignore(table, **values):
+    """Insert one row into `table` unless it duplicates an existing key.
+
+    Uses the database's native insert-or-ignore where there is one, so no
+    read is needed first. Returns True if the row was inserted.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        insert = (postgresql
+                  .insert(table)
+                  .values(**values)
+                  .on_conflict_do_nothing())
+
+    elif dialect == 'sqlite':
+        insert = table.insert().prefix_with('OR IGNORE').values(**values)
+
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert().values(**values))
+        except IntegrityError:
+            return False
+        return True
+
+    return db.session.execute(insert).rowcount > 0
 
 
 class Follows(db.Model):
@@ -26,28 +62,118 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user; this serves the other
+    # direction ("who does X follow?").
+    __table_args__ = (
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`.
+
+        Issues a single insert-or-ignore, so following twice is harmless.
+        Returns True if a new follow was created.
+        """
+
+        return insert_or_ignore(cls.__table__,
+                                user_being_followed_id=followed_id,
+                                user_following_id=follower_id)
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Stop `follower_id` following `followed_id`.
+
+        Returns True if a follow was removed.
+        """
+
+        removed = (cls
+                   .query
+                   .filter_by(user_being_followed_id=followed_id,
+                              user_following_id=follower_id)
+                   .delete(synchronize_session=False))
+        return removed > 0
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? Returns a set."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        followed = (db.session
+                    .query(cls.user_being_followed_id)
+                    .filter(cls.user_following_id == follower_id,
+                            cls.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in followed}
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
-
+    # Each user can like each message once; the (user_id, message_id)
+    # primary key doubles as the index for a user's likes.
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_message', 'message_id'),
     )
 
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id`.
+
+        Liking twice is harmless. Returns True if a new like was created.
+        """
+
+        return insert_or_ignore(cls.__table__,
+                                user_id=user_id,
+                                message_id=message_id)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Remove `user_id`'s like of `message_id`.
+
+        Returns True if a like was removed.
+        """
+
+        removed = (cls
+                   .query
+                   .filter_by(user_id=user_id, message_id=message_id)
+                   .delete(synchronize_session=False))
+        return removed > 0
+
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked?
+
+        Fetches only ids, and only for the given messages; returns a set.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        liked = (db.session
+                 .query(cls.message_id)
+                 .filter(cls.user_id == user_id,
+                         cls.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in liked}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +220,55 @@ class User(db.Model):
         nullable=False
     )
 
+    # Denormalized counts of related rows, kept in step by counters.py so
+    # stats don't require loading every related row.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    # Bumped along with any of the counters above; pages showing them use
+    # it in their validators (see conditional).
+    stats_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
+    # Bumped whenever the user edits their profile, invalidating message
+    # fragments rendered with the old name and picture; see fragments.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -115,22 +290,58 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # The columns user cards (following, followers) display.
+    CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @classmethod
+    def followed_by(cls, user_id):
+        """Query for the users `user_id` follows, loading card columns.
+
+        Page it on ``Follows.user_being_followed_id``, which
+        ix_follows_following serves in order.
+        """
+
+        return (cls
+                .query
+                .options(load_only(*cls.CARD_COLUMNS))
+                .join(Follows, Follows.user_being_followed_id == cls.id)
+                .filter(Follows.user_following_id == user_id))
+
+    @classmethod
+    def followers_of(cls, user_id):
+        """Query for the followers of `user_id`, loading card columns.
+
+        Page it on ``Follows.user_following_id``, which the primary key
+        serves in order.
+        """
+
+        return (cls
+                .query
+                .options(load_only(*cls.CARD_COLUMNS))
+                .join(Follows, Follows.user_following_id == cls.id)
+                .filter(Follows.user_being_followed_id == user_id))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self.id in other_user.following_ids([self.id])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answers for a whole page of users with one indexed query and
+        returns a set of ids.
+        """
+
+        return Follows.followed_among(self.id, user_ids)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -172,14 +383,45 @@ class User(db.Model):
         return False
 
 
+class FollowState:
+    """Which users `user_id` follows, looked up a batch of ids at a time.
+
+    Views prime it with every user id on a page so templates can ask about
+    each card without a query apiece. Anonymous users (no `user_id`)
+    follow nobody.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.checked = set()
+        self.followed = set()
+
+    def prime(self, user_ids):
+        """Look up follow state for any of `user_ids` not already known."""
+
+        unchecked = set(user_ids) - self.checked
+        if unchecked and self.user_id:
+            self.followed |= Follows.followed_among(self.user_id, unchecked)
+        self.checked |= unchecked
+
+    def is_following(self, user_id):
+        """Does this state's user follow `user_id`?"""
+
+        self.prime([user_id])
+        return user_id in self.followed
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # Snowflake ids sort by creation time, so feeds order by primary key.
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -190,7 +432,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,7 +441,72 @@ class Message(db.Model):
         nullable=False,
     )
 
-    user = db.relationship('User')
+    fanned_out = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Written behind in batches; see like_counts.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Message lists render every author, so load them in one batched
+    # SELECT ... WHERE id IN (...) rather than one query per message.
+    user = db.relationship('User', lazy='selectin')
+
+    __table_args__ = (
+        db.Index('ix_messages_user_feed', 'user_id', 'id'),
+        db.Index('ix_messages_like_count', 'like_count'),
+        # Just the messages home timelines pull at read time; see timeline.
+        db.Index('ix_messages_pulled', 'user_id', 'id',
+                 postgresql_where=db.text('NOT fanned_out'),
+                 sqlite_where=db.text('fanned_out = 0')),
+    )
+
+    # The author columns message list templates actually read.
+    AUTHOR_COLUMNS = ('id', 'username', 'image_url', 'profile_version')
+
+    @classmethod
+    def with_authors(cls):
+        """Loader option batch-loading just the authors' displayed columns."""
+
+        return selectinload(cls.user).load_only(*cls.AUTHOR_COLUMNS)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's materialized home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # The (user_id, message_id) primary key doubles as the feed index.
+    __table_args__ = (
+        db.Index('ix_timeline_entries_author', 'author_id', 'user_id'),
+        db.Index('ix_timeline_entries_message', 'message_id'),
+    )
 
 
 def connect_db(app):
@@ -210,3 +517,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    query_stats.init_app(app)
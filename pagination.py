@@ -0,0 +1,158 @@
+"""Keyset ("cursor") pagination for message feeds and user lists.
+
+Pages are requested with an opaque ``before`` cursor encoding the id of the
+last row on the previous page. Message ids sort by time, so each page
+is a range scan on the primary key (or an index ending in it) rather than
+an OFFSET, and costs the same no matter how far back a user scrolls.
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from itertools import islice
+
+from models import Message
+
+
+def encode_key(*values):
+    """Encode a sort key as an opaque URL-safe cursor."""
+
+    raw = '|'.join(str(value) for value in values).encode('utf-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_key(cursor, *types):
+    """Decode a cursor made by `encode_key`, converting each part with the
+    matching callable in `types`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        parts = raw.split('|')
+        if len(parts) != len(types):
+            raise ValueError
+
+        return tuple(convert(part) for convert, part in zip(types, parts))
+
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def encode_cursor(id):
+    """Encode a message id position as an opaque URL-safe cursor."""
+
+    return encode_key(id)
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by `encode_cursor` into a message id.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    id, = decode_key(cursor, int)
+    return id
+
+
+def message_cursor(message):
+    """Cursor pointing just past `message`."""
+
+    return encode_cursor(message.id)
+
+
+def keyset(query, key, before=None):
+    """`query` in descending order of `key`, starting just past `before`
+    (a decoded cursor).
+
+    `key` is the column holding each row's id: ``Message.id`` for messages,
+    or e.g. the follows column a follow listing joins on, so the page is a
+    range scan of its index.
+    """
+
+    if before:
+        query = query.filter(key < before)
+
+    return query.order_by(key.desc())
+
+
+def paginate_messages(query, before=None, limit=100):
+    """Return one page of `query`'s messages, newest first.
+
+    `before` is a decoded message id cursor. Returns the messages and the
+    cursor for the next page (None on the last page).
+    """
+
+    messages = (keyset(query, Message.id, before)
+                .limit(limit + 1)
+                .all())
+
+    return page_of(messages, limit)
+
+
+class Pager:
+    """One page of `query`'s rows, fetched as a template iterates over it.
+
+    Rows are read `batch_size` at a time through ``yield_per`` (a
+    server-side cursor on Postgres), so memory use doesn't grow with the
+    page, and a streamed template can send each row as soon as it arrives.
+    `item` turns each row into what is yielded; `on_batch` is called with
+    each batch of items before they are yielded, e.g. to look up follow
+    state for the whole batch in one query.
+
+    Once iteration has run past the end of the page, `next_cursor` holds
+    the cursor for the next page (None on the last page), made from the
+    last row by `cursor`. A pager can be iterated only once.
+    """
+
+    def __init__(self, query, limit, cursor=None, item=None, batch_size=100,
+                 on_batch=None):
+        self.query = query
+        self.limit = limit
+        self.cursor = cursor or message_cursor
+        self.item = item or (lambda row: row)
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.next_cursor = None
+
+    def __iter__(self):
+        rows = iter(self.query
+                    .limit(self.limit + 1)
+                    .yield_per(self.batch_size))
+        served = 0
+
+        try:
+            while served < self.limit:
+                size = min(self.batch_size, self.limit - served)
+                batch = list(islice(rows, size))
+                if not batch:
+                    return
+
+                served += len(batch)
+                last = batch[-1]
+                items = [self.item(row) for row in batch]
+                if self.on_batch:
+                    self.on_batch(items)
+                yield from items
+
+            # The over-fetched row, if any, means there is another page.
+            if next(rows, None) is not None:
+                self.next_cursor = self.cursor(last)
+
+        finally:
+            # Release the server-side cursor if the page ended early.
+            close = getattr(rows, 'close', None)
+            if close:
+                close()
+
+
+def page_of(rows, limit):
+    """Trim an over-fetched list, in descending id order, to a page and
+    its cursor."""
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, message_cursor(rows[-1])
+
+    return rows, None
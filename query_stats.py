@@ -0,0 +1,134 @@
+"""Per-request SQL statistics.
+
+`QueryStats` counts the statements each request sends to the database and
+the time spent in them, reports both in a ``Server-Timing`` response
+header (except on streamed responses, whose headers go out first), and
+logs a warning when a single statement shape repeats more than
+``QUERY_STATS_REPEAT_THRESHOLD`` times in one request (the signature of an
+N+1 query).
+"""
+
+import re
+from collections import Counter
+from time import perf_counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Bound parameters (psycopg2 and qmark styles) and bare numbers.
+PARAMETERS = re.compile(r"%\(\w+\)s|\?|\b\d+\b")
+# A run of parameters, e.g. an expanded IN (...) list.
+PARAMETER_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def statement_shape(statement):
+    """`statement` with its parameters and whitespace normalized.
+
+    Statements that differ only in their values share a shape.
+    """
+
+    shape = PARAMETERS.sub('?', statement)
+    shape = PARAMETER_LISTS.sub('?', shape)
+    return ' '.join(shape.split())
+
+
+class RequestQueries:
+    """The statements issued while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        """Record one statement that took `duration` seconds."""
+
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """Statement shapes issued more than `threshold` times, with counts."""
+
+        return [(shape, count) for shape, count in self.shapes.most_common()
+                if count > threshold]
+
+    def server_timing(self):
+        """This request's database usage as a Server-Timing metric."""
+
+        return (f'db;dur={self.duration * 1000:.2f};'
+                f'desc="{self.count} queries"')
+
+
+class QueryStats:
+    """Flask extension collecting `RequestQueries` for every request.
+
+    The stats of the most recently finished request are kept on `last`,
+    which is handy for tests and benchmarks.
+    """
+
+    listening = False
+
+    def __init__(self, app=None):
+        self.last = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_STATS_REPEAT_THRESHOLD', 10)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.finish_stream)
+
+        if not QueryStats.listening:
+            event.listen(Engine, 'before_cursor_execute', before_execute)
+            event.listen(Engine, 'after_cursor_execute', after_execute)
+            QueryStats.listening = True
+
+    def start_request(self):
+        g.request_queries = RequestQueries()
+
+    def finish_request(self, response):
+        # A streamed response's queries mostly run after its headers are
+        # sent, so it gets no header; `finish_stream` records its stats.
+        if response.is_streamed or 'request_queries' not in g:
+            return response
+
+        queries = g.pop('request_queries')
+        self.record(queries)
+
+        timing = response.headers.get('Server-Timing')
+        response.headers['Server-Timing'] = (
+            f"{timing}, {queries.server_timing()}" if timing
+            else queries.server_timing())
+
+        return response
+
+    def finish_stream(self, exc):
+        queries = g.pop('request_queries', None)
+        if queries is not None:
+            self.record(queries)
+
+    def record(self, queries):
+        self.last = queries
+
+        threshold = current_app.config['QUERY_STATS_REPEAT_THRESHOLD']
+        for shape, count in queries.repeated(threshold):
+            current_app.logger.warning(
+                "Possible N+1 query on %s: %d x %s",
+                request.path, count, shape)
+
+
+def before_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_start'].pop()
+
+    if has_request_context() and 'request_queries' in g:
+        g.request_queries.record(statement, perf_counter() - started)
@@ -0,0 +1,138 @@
+"""Username search.
+
+Searches are case-insensitive substring matches, ranked with prefix matches
+first, then by similarity to the search term, then newest user first.
+
+On Postgres with the ``pg_trgm`` extension, matching uses a trigram GIN index
+on ``lower(username)``, so a leading-wildcard LIKE stays an index scan at
+millions of users, and similarity is the trigram similarity. Elsewhere the
+same query runs without the index, and similarity falls back to name length:
+among names containing the term, shorter names are the closer matches.
+
+Results are paged with an opaque cursor holding the (prefix, similarity, id)
+ranking of the last user on the previous page.
+"""
+
+from sqlalchemy import DDL, Float, case, event, tuple_
+
+from models import db, User
+from pagination import decode_key, encode_key, Pager
+
+TRIGRAM_EXTENSION = DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+TRIGRAM_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+    "ON users USING gin (lower(username) gin_trgm_ops)")
+
+# Whether each engine's database has pg_trgm installed.
+_trigram_support = {}
+
+
+def trigrams_available(ddl, target, bind, **kw):
+    """Can pg_trgm be installed in `bind`'s database?"""
+
+    if bind.dialect.name != 'postgresql':
+        return False
+
+    return bind.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar() is not None
+
+
+for ddl in (TRIGRAM_EXTENSION, TRIGRAM_INDEX):
+    event.listen(User.__table__, 'after_create',
+                 ddl.execute_if(callable_=trigrams_available))
+
+
+def has_trigrams():
+    """Is pg_trgm installed in the current database?"""
+
+    engine = db.get_engine()
+
+    if engine not in _trigram_support:
+        _trigram_support[engine] = (
+            engine.dialect.name == 'postgresql' and
+            engine.execute(
+                "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+            ).scalar() is not None)
+
+    return _trigram_support[engine]
+
+
+def escape_like(term):
+    """`term` with LIKE wildcards escaped, for use with ``escape='\\'``."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def encode_search_cursor(prefix, score, id):
+    """Encode a user's ranking as an opaque URL-safe cursor."""
+
+    return encode_key(prefix, score, id)
+
+
+def decode_search_cursor(cursor):
+    """Decode a cursor made by `encode_search_cursor`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    return decode_key(cursor, int, float, int)
+
+
+def search_users(term=None, after=None, limit=100):
+    """One page of users whose username contains `term`, best match first.
+
+    Without a `term`, lists every user, newest first. `after` is a decoded
+    cursor; returns the users and the cursor for the next page (None on the
+    last page).
+    """
+
+    pager = search_pager(term, after=after, limit=limit)
+    users = list(pager)
+    return users, pager.next_cursor
+
+
+def search_pager(term=None, after=None, limit=100, **options):
+    """A `Pager` over the page `search_users` would return, for streaming.
+
+    `options` are passed on to the pager.
+    """
+
+    term = (term or '').strip().lower()
+
+    if not term:
+        query = User.query
+        if after:
+            query = query.filter(User.id < after[2])
+
+        return Pager(query.order_by(User.id.desc()), limit,
+                     cursor=lambda user: encode_search_cursor(0, 0, user.id),
+                     **options)
+
+    username = db.func.lower(User.username)
+    pattern = escape_like(term)
+
+    prefix = case([(username.like(f"{pattern}%", escape='\\'), 1)], else_=0)
+    if has_trigrams():
+        # similarity() is a real; compare cursors at double precision.
+        score = db.cast(db.func.similarity(username, term), Float)
+    else:
+        score = -db.func.length(User.username)
+
+    query = (db.session
+             .query(User, prefix, score)
+             .filter(username.like(f"%{pattern}%", escape='\\')))
+
+    if after:
+        query = query.filter(tuple_(prefix, score, User.id) < after)
+
+    return Pager(query.order_by(prefix.desc(), score.desc(), User.id.desc()),
+                 limit,
+                 cursor=lambda row: encode_search_cursor(row[1], row[2],
+                                                         row[0].id),
+                 item=lambda row: row[0],
+                 **options)
@@ -1,20 +1,14 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
-
-
-db.drop_all()
-db.create_all()
-
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+from app import app
+from loader import load
+
+SEED_FILES = [
+    'generator/users.csv',
+    'generator/messages.csv',
+    'generator/follows.csv',
+]
+
+with app.app_context():
+    load(SEED_FILES,
+         progress=lambda table, rows, rate: print(f"{table}: {rows:,} rows"))
@@ -0,0 +1,66 @@
+"""The logged-in user, cached between requests.
+
+Every request needs the current user, but most only read a handful of
+fields. `load_current_user` keeps a small snapshot of those fields in a
+per-process cache, so pages that just show the user's name and avatar skip
+the database entirely. Anything else (counters, or a route that changes the
+user) loads the full ``User`` on first use.
+
+Write paths that change snapshot fields must call `forget_current_user`.
+"""
+
+from cache import LRUCache
+from models import db, User
+
+# The fields templates read on every page.
+SNAPSHOT_COLUMNS = ('id', 'username', 'image_url', 'header_image_url')
+
+user_cache = LRUCache(maxsize=10000, ttl=300)
+
+
+class CurrentUser:
+    """A cached snapshot of a user, backed by the full model on demand."""
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+        self._model = None
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def model(self):
+        """The full ``User`` row, loaded the first time it is needed."""
+
+        if self._model is None:
+            self._model = User.query.get(self.id)
+        return self._model
+
+    def __getattr__(self, name):
+        # Only called for attributes the snapshot doesn't have.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+def load_current_user(user_id):
+    """The `CurrentUser` for `user_id`, or None if there is no such user."""
+
+    snapshot = user_cache.get(user_id)
+
+    if snapshot is None:
+        columns = [getattr(User, name) for name in SNAPSHOT_COLUMNS]
+        row = db.session.query(*columns).filter(User.id == user_id).first()
+        if row is None:
+            return None
+
+        snapshot = dict(zip(SNAPSHOT_COLUMNS, row))
+        user_cache.set(user_id, snapshot)
+
+    return CurrentUser(snapshot)
+
+
+def forget_current_user(user_id):
+    """Drop the cached snapshot for `user_id` after it changes."""
+
+    user_cache.pop(user_id)
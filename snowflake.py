@@ -0,0 +1,155 @@
+"""Time-ordered 64-bit ids ("snowflakes").
+
+An id packs, from the most significant bit down:
+
+- 41 bits of milliseconds since `EPOCH` (good for ~69 years),
+- 10 bits of worker id, so processes never hand out the same id,
+- 12 bits of sequence number within the millisecond.
+
+Ids therefore sort by creation time, and ordering by primary key is ordering
+by time. Each process takes its worker id from ``SNOWFLAKE_WORKER_ID`` when
+it makes its first id; give every process writing to the same database a
+different one. A forked process starts over, so a server that preloads the
+app and forks workers must set it in each worker, e.g. in a post-fork
+hook: a value inherited across a fork is refused, as the parent and its
+siblings have it too. Only in debug or testing mode may it be left unset,
+and one is made from the pid instead. The highest worker id,
+`LOADER_WORKER_ID`, is reserved for messages the bulk loader writes.
+"""
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from flask import current_app, has_app_context
+
+EPOCH = datetime(2010, 1, 1)
+
+TIMESTAMP_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# Ids made by `loader` rather than by a running process.
+LOADER_WORKER_ID = MAX_WORKER
+
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class SnowflakeGenerator:
+    """Thread-safe generator of increasing snowflake ids for one worker."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER:
+            raise ValueError(f"Worker id must be 0-{MAX_WORKER}: {worker_id}")
+
+        self.worker_id = worker_id
+        self.last_ms = -1
+        self.sequence = 0
+        self._lock = Lock()
+
+    def next_id(self):
+        """A new id, greater than every id this generator made before."""
+
+        with self._lock:
+            now = current_ms()
+
+            # Never go back in time, even if the clock does.
+            if now <= self.last_ms:
+                now = self.last_ms
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # Used up this millisecond; borrow the next one.
+                    now += 1
+            else:
+                self.sequence = 0
+
+            self.last_ms = now
+            return ((now - EPOCH_MS) << TIMESTAMP_SHIFT |
+                    self.worker_id << SEQUENCE_BITS |
+                    self.sequence)
+
+
+def current_ms():
+    """Milliseconds since the Unix epoch."""
+
+    return time.time_ns() // 1_000_000
+
+
+def id_at(timestamp):
+    """The smallest id that could be made at `timestamp`, a naive UTC or
+    an aware datetime. Useful as a bound in range queries on ids."""
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    ms = (timestamp - EPOCH) // timedelta(milliseconds=1)
+    return max(ms, 0) << TIMESTAMP_SHIFT
+
+
+def timestamp_of(id):
+    """When `id` was made, as a naive UTC datetime."""
+
+    return EPOCH + timedelta(milliseconds=id >> TIMESTAMP_SHIFT)
+
+
+# This process's generator, made with its first id.
+generator = None
+_generator_lock = Lock()
+
+# SNOWFLAKE_WORKER_ID as this process was forked with it, if it was.
+_inherited_worker_id = None
+
+
+def worker_id():
+    """This process's worker id.
+
+    Raises RuntimeError if none is set where one is required.
+    """
+
+    value = os.environ.get('SNOWFLAKE_WORKER_ID')
+
+    if value is not None and value != _inherited_worker_id:
+        if int(value) == LOADER_WORKER_ID:
+            raise RuntimeError(f"SNOWFLAKE_WORKER_ID={value} is reserved "
+                               f"for the bulk loader")
+        return int(value)
+
+    if has_app_context() and (current_app.debug or current_app.testing):
+        return os.getpid() % LOADER_WORKER_ID
+
+    if value is not None:
+        raise RuntimeError(
+            f"SNOWFLAKE_WORKER_ID={value} was inherited from the parent "
+            f"process; set a different one in each forked process")
+
+    raise RuntimeError(
+        f"Set SNOWFLAKE_WORKER_ID (0-{LOADER_WORKER_ID - 1}), different for "
+        f"every process writing messages")
+
+
+def _forked():
+    global generator, _inherited_worker_id
+
+    generator = None
+    _inherited_worker_id = os.environ.get('SNOWFLAKE_WORKER_ID')
+
+
+os.register_at_fork(after_in_child=_forked)
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    global generator
+
+    if generator is None:
+        with _generator_lock:
+            if generator is None:
+                generator = SnowflakeGenerator(worker_id())
+
+    return generator.next_id()
@@ -1,27 +1,43 @@
+// Like/unlike requests ask for JSON so the server answers with the new
+// like state instead of redirecting and rendering a whole page.
+const LIKE_REQUEST_CONFIG = { headers: { Accept: "application/json" } };
+
+// Message ids are 64-bit, so they are read as strings: JavaScript numbers
+// can't hold them exactly.
 $("#messages").on("click", ".followed", removeFollow);
 $("#messages").on("click", ".not-followed", addFollow);
 
+function updateLikesCount(res) {
+  $("#likes-count").text(res.data.likes);
+}
+
+function updateLikeCount(button, res) {
+  $(button).find(".like-count").text(res.data.like_count);
+}
+
 async function removeFollow(evt) {
-  console.log("remove");
-  msgId = $(this).data("id");
-  res = await axios.post(`/users/remove_like/${msgId}`);
+  msgId = $(this).attr("data-id");
+  res = await axios.post(`/users/remove_like/${msgId}`, null, LIKE_REQUEST_CONFIG);
   $(this).removeClass("followed btn-primary");
   $(this).addClass("not-followed btn-secondary");
+  updateLikeCount(this, res);
+  updateLikesCount(res);
 }
 
 async function addFollow(evt) {
-  console.log("add");
-  msgId = $(this).data("id");
-  res = await axios.post(`/users/add_like/${msgId}`);
+  msgId = $(this).attr("data-id");
+  res = await axios.post(`/users/add_like/${msgId}`, null, LIKE_REQUEST_CONFIG);
   $(this).removeClass("not-followed btn-secondary");
   $(this).addClass("followed btn-primary");
+  updateLikeCount(this, res);
+  updateLikesCount(res);
 }
 
 $("#liked-messages").on("click", ".followed", deleteFollow);
 
 async function deleteFollow(evt) {
-  console.log("remove");
-  msgId = $(this).data("id");
-  res = await axios.post(`/users/remove_like/${msgId}`);
+  msgId = $(this).attr("data-id");
+  res = await axios.post(`/users/remove_like/${msgId}`, null, LIKE_REQUEST_CONFIG);
   $(this).remove();
+  updateLikesCount(res);
 }
@@ -0,0 +1,68 @@
+"""Helpers for asserting how many SQL statements a block of code issues."""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, query_stats
+
+
+class QueryCounter:
+    """Records every statement sent to the database while listening."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements issued inside the block."""
+
+    counter = QueryCounter()
+    engine = db.get_engine()
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+class QueryCountMixin:
+    """TestCase mixin adding query count assertions."""
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        """Fail if the block issues more than `limit` SQL statements."""
+
+        with count_queries() as counter:
+            yield counter
+
+        self.assertLessEqual(
+            counter.count, limit,
+            f"{counter.count} queries issued, expected at most {limit}:\n" +
+            "\n".join(counter.statements))
+
+    def assertQueryBudget(self, client, url, budget):
+        """GET `url` and fail if the request issued more than `budget`
+        statements, as counted by the `query_stats` extension."""
+
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200, url)
+        # Streamed pages only finish querying once they have been read.
+        res.get_data()
+        res.close()
+
+        queries = query_stats.last
+        self.assertLessEqual(
+            queries.count, budget,
+            f"{url} issued {queries.count} queries, budget is {budget}:\n" +
+            "\n".join(queries.shapes))
+        return res
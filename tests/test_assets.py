@@ -0,0 +1,125 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+from app import app
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase, skipIf
+
+import assets
+from assets import build_assets, static_url
+
+STYLESHEET = b'body { background-image: url("/static/images/bg.png"); }\n'
+SCRIPT = b"console.log('warble');\n" * 20
+
+
+class AssetBuildTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.source = self.dir.name
+        self.out = os.path.join(self.source, 'dist')
+
+        for path, content in [('script.js', SCRIPT),
+                              ('stylesheets/style.css', STYLESHEET),
+                              ('images/bg.png', b'\x89PNG not really')]:
+            path = os.path.join(self.source, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(content)
+
+        self.folder = app.config['ASSETS_FOLDER']
+        app.config['ASSETS_FOLDER'] = self.out
+        self.manifest = build_assets(self.source, self.out)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['ASSETS_FOLDER'] = self.folder
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def read(self, name):
+        with open(os.path.join(self.out, name), 'rb') as file:
+            return file.read()
+
+    def get(self, url, **headers):
+        res = self.client.get(url, headers=headers)
+        data = res.get_data()
+        res.close()
+        return res, data
+
+    def test_manifest(self):
+        """Every file gets a content-hashed name, recorded in the manifest."""
+
+        names = self.manifest['assets']
+        self.assertRegex(names['script.js'], r'^script\.[0-9a-f]{12}\.js$')
+        self.assertRegex(names['images/bg.png'],
+                         r'^images/bg\.[0-9a-f]{12}\.png$')
+        self.assertEqual(self.read(names['script.js']), SCRIPT)
+
+        with open(os.path.join(self.out, 'manifest.json')) as file:
+            self.assertEqual(json.load(file), self.manifest)
+
+        # The same content builds to the same names.
+        self.assertEqual(build_assets(self.source, self.out)['assets'], names)
+
+    def test_stylesheet_urls(self):
+        """Stylesheets refer to the fingerprinted files."""
+
+        names = self.manifest['assets']
+        css = self.read(names['stylesheets/style.css']).decode('utf-8')
+        self.assertIn(f'url("/assets/{names["images/bg.png"]}")', css)
+
+    def test_compressed_variants(self):
+        """Text files get smaller gzip (and brotli) variants; images don't."""
+
+        name = self.manifest['assets']['script.js']
+        self.assertEqual(gzip.decompress(self.read(name + '.gz')), SCRIPT)
+        self.assertIn('gzip', self.manifest['encoded'][name])
+        self.assertNotIn(self.manifest['assets']['images/bg.png'],
+                         self.manifest['encoded'])
+
+    @skipIf(assets.brotli is None, "brotli is not installed")
+    def test_brotli_variant(self):
+        name = self.manifest['assets']['script.js']
+        self.assertEqual(assets.brotli.decompress(self.read(name + '.br')),
+                         SCRIPT)
+
+    def test_static_url(self):
+        with app.test_request_context():
+            self.assertEqual(static_url('script.js'),
+                             f"/assets/{self.manifest['assets']['script.js']}")
+            self.assertEqual(static_url('unbuilt.js'), "/static/unbuilt.js")
+
+    def test_serve_encoded(self):
+        """Assets are served in the best encoding accepted, for good."""
+
+        url = f"/assets/{self.manifest['assets']['script.js']}"
+
+        res, data = self.get(url, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(data), SCRIPT)
+        self.assertIn('javascript', res.mimetype)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(res.headers['Cache-Control'],
+                         "public, max-age=31536000, immutable")
+
+        res, data = self.get(url)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(data, SCRIPT)
+
+        res, data = self.get("/assets/script.000000000000.js")
+        self.assertEqual(res.status_code, 404)
+
+    def test_pages_stay_revalidated(self):
+        res, data = self.get("/login")
+        self.assertEqual(res.headers['Cache-Control'], 'private, no-cache')
+        self.assertIn(f"/assets/{self.manifest['assets']['script.js']}",
+                      data.decode('utf-8'))
@@ -0,0 +1,95 @@
+"""Route benchmark tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_benchmark.py
+
+from app import app, create_app
+import os
+from unittest import TestCase
+
+from benchmark import compare, percentile, run_benchmark, BENCHMARK_TEXT
+from likes import liked_cache
+from fragments import fragment_cache
+from session_user import user_cache
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+
+class PercentileTestCase(TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+
+
+class BenchmarkTestCase(TestCase):
+    """Test running the benchmark scenarios."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        liked_cache.clear()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+            'WTF_CSRF_ENABLED': False,
+        })
+
+        with self.app.app_context():
+            for id in (1, 2, 3):
+                user = User.signup(username=f"user{id}",
+                                   email=f"{id}@gmail.com",
+                                   password="password", image_url=None)
+                user.id = id
+            db.session.commit()
+            db.session.add(Follows(user_following_id=1,
+                                   user_being_followed_id=2))
+            db.session.add(Message(text="Hello there", user_id=2))
+            db.session.commit()
+
+    def test_run(self):
+        """Every scenario runs under both drivers, without errors."""
+
+        results = run_benchmark(self.app, requests=4, workers=2, warmup=1)
+
+        scenarios = {(result['driver'], result['scenario'])
+                     for result in results}
+        self.assertIn(('client', "GET /"), scenarios)
+        self.assertIn(('http', "GET /users/1/following"), scenarios)
+        self.assertIn(('http', "POST follow, unfollow"), scenarios)
+
+        for result in results:
+            self.assertEqual(result['requests'], 4)
+            self.assertEqual(result['errors'], 0, result['scenario'])
+            if result['driver'] == 'client':
+                self.assertGreater(result['queries'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+        # Posted messages are cleaned up.
+        with self.app.app_context():
+            self.assertEqual(
+                Message.query.filter_by(text=BENCHMARK_TEXT).count(), 0)
+            self.assertEqual(User.query.get(1).messages_count, 0)
+
+    def test_compare(self):
+        previous = {'results': [dict(driver='client', scenario="GET /",
+                                     p50_ms=10, p95_ms=20, rps=100)]}
+        current = {'results': [dict(driver='client', scenario="GET /",
+                                    p50_ms=5, p95_ms=20, rps=200),
+                               dict(driver='http', scenario="GET /",
+                                    p50_ms=5, p95_ms=20, rps=200)]}
+
+        lines = compare(previous, current)
+
+        self.assertEqual(len(lines), 1)
+        self.assertIn("p50   -50.0%", lines[0])
+        self.assertIn("rps  +100.0%", lines[0])
@@ -0,0 +1,45 @@
+"""In-process cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+from time import sleep
+from unittest import TestCase
+
+from cache import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the LRU cache."""
+
+    def test_get_set(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("b", 0), 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=0.01)
+        cache.set("a", 1)
+        sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+    def test_pop(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
@@ -0,0 +1,163 @@
+"""Conditional GET tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_conditional.py
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from datetime import datetime
+from fragments import fragment_cache
+from likes import liked_cache
+from like_counts import pending_likes
+from session_user import user_cache
+from models import db, query_stats, User, Message, Follows
+from timeline import rebuild_timelines
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ConditionalGetTestCase(TestCase):
+    """Pages answer repeat requests with 304 Not Modified until they
+    change."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        liked_cache.clear()
+        user_cache.clear()
+        fragment_cache.clear()
+        pending_likes.clear()
+
+        for id in (1000, 2000):
+            user = User.signup(username=f"user{id}",
+                               email=f"{id}@test.com",
+                               password="password", image_url=None)
+            user.id = id
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=2000,
+                               user_following_id=1000))
+        db.session.add(Message(id=20000, text="Hello", user_id=2000,
+                               timestamp=datetime(2020, 5, 17, 12, 30)))
+        db.session.commit()
+
+        with app.app_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        self.reader = self.client_for(1000)
+        self.author = self.client_for(2000)
+
+        # Keep ETags from rolling over in the middle of a test.
+        app.config['ETAG_LIFETIME'] = 24 * 60 * 60
+
+    def tearDown(self):
+        app.config['ETAG_LIFETIME'] = 60
+        db.session.rollback()
+        return super().tearDown()
+
+    def client_for(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def revalidate(self, client, url, etag):
+        return client.get(url, headers={'If-None-Match': etag})
+
+    def test_cache_control(self):
+        res = self.reader.get("/")
+
+        self.assertEqual(res.headers['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Pragma', res.headers)
+        self.assertIsNotNone(res.headers.get('ETag'))
+
+    def test_home_not_modified(self):
+        """A repeat request gets a 304, without loading the timeline."""
+
+        etag = self.reader.get("/").headers['ETag']
+
+        res = self.revalidate(self.reader, "/", etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_data(), b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertLessEqual(query_stats.last.count, 2)
+
+    def test_home_changes(self):
+        """New messages on the timeline and the reader's own likes change
+        the page."""
+
+        etag = self.reader.get("/").headers['ETag']
+
+        self.author.post("/messages/new", data={'text': "Again"})
+        res = self.revalidate(self.reader, "/", etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("Again", res.get_data(as_text=True))
+
+        etag = res.headers['ETag']
+        self.reader.post("/users/add_like/20000")
+        res = self.revalidate(self.reader, "/", etag)
+        self.assertEqual(res.status_code, 200)
+
+    def test_profile_changes(self):
+        """A user's profile changes when they post, delete or edit it."""
+
+        url = "/users/2000"
+        etag = self.reader.get(url).headers['ETag']
+        self.assertEqual(self.revalidate(self.reader, url, etag).status_code,
+                         304)
+
+        self.author.post("/messages/20000/delete")
+        res = self.revalidate(self.reader, url, etag)
+        self.assertEqual(res.status_code, 200)
+
+        etag = res.headers['ETag']
+        self.author.post("/users/profile", data={
+            "username": "renamed", "email": "2000@test.com",
+            "password": "password"})
+        res = self.revalidate(self.reader, url, etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("@renamed", res.get_data(as_text=True))
+
+    def test_message_not_by_date(self):
+        """The message page is validated by ETag only: the follow button
+        and author can change long after the message was posted."""
+
+        res = self.reader.get("/messages/20000")
+        self.assertIsNone(res.last_modified)
+
+        self.reader.post("/users/stop-following/2000")
+        res = self.reader.get("/messages/20000", headers={
+            'If-Modified-Since': "Sun, 17 May 2020 12:30:00 GMT"})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('action="/users/follow/2000"',
+                      res.get_data(as_text=True))
+
+    def test_message_follow_button(self):
+        """Unfollowing the author changes the message page."""
+
+        etag = self.reader.get("/messages/20000").headers['ETag']
+
+        self.reader.post("/users/stop-following/2000")
+        res = self.revalidate(self.reader, "/messages/20000", etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('action="/users/follow/2000"',
+                      res.get_data(as_text=True))
+
+    def test_flashed_messages(self):
+        """Pages showing a flashed message aren't validated."""
+
+        with self.reader.session_transaction() as sess:
+            sess['_flashes'] = [('danger', "Something happened")]
+
+        res = self.reader.get("/users/2000")
+        self.assertIn("Something happened", res.get_data(as_text=True))
+        self.assertIsNone(res.headers.get('ETag'))
@@ -0,0 +1,92 @@
+"""Synthetic dataset generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+from app import app
+import csv
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from loader import load
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+GENERATOR = os.path.join(os.path.dirname(__file__), '..', 'generator',
+                         'create_csvs.py')
+
+
+def generate(out, *args):
+    subprocess.run([sys.executable, GENERATOR, '--out', out,
+                    '--users', '50', '--messages', '300', '--follows', '400',
+                    *args],
+                   check=True, stdout=subprocess.DEVNULL)
+    return sorted(glob.glob(os.path.join(out, '*')))
+
+
+def read(path):
+    with open(path, newline='') as file:
+        return list(csv.DictReader(file))
+
+
+class GeneratorTestCase(TestCase):
+    """Test generating datasets."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def test_deterministic(self):
+        """The same seed gives the same data, however many workers."""
+
+        first = generate(os.path.join(self.dir.name, 'a'), '--workers', '1')
+        second = generate(os.path.join(self.dir.name, 'b'), '--workers', '2')
+
+        self.assertEqual([os.path.basename(path) for path in first],
+                         ['follows.part-0000.csv', 'messages.part-0000.csv',
+                          'users.part-0000.csv'])
+        for a, b in zip(first, second):
+            with open(a) as file_a, open(b) as file_b:
+                self.assertEqual(file_a.read(), file_b.read())
+
+        other = generate(os.path.join(self.dir.name, 'c'), '--seed', '1')
+        with open(first[1]) as file_a, open(other[1]) as file_b:
+            self.assertNotEqual(file_a.read(), file_b.read())
+
+    def test_valid_rows(self):
+        """Follows are distinct and never of oneself; warbles fit."""
+
+        follows, messages, users = generate(self.dir.name)
+
+        pairs = [(row['user_being_followed_id'], row['user_following_id'])
+                 for row in read(follows)]
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertFalse([pair for pair in pairs if pair[0] == pair[1]])
+
+        self.assertTrue(all(len(row['text']) <= 140
+                            for row in read(messages)))
+        self.assertEqual(len(read(users)), 50)
+
+    def test_loads(self):
+        """The output loads as it is."""
+
+        paths = generate(self.dir.name, '--format', 'ndjson')
+
+        with app.app_context():
+            load(paths)
+
+            self.assertEqual(User.query.count(), 50)
+            self.assertGreater(Message.query.count(), 0)
+            self.assertGreater(Follows.query.count(), 0)
@@ -0,0 +1,183 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+from app import app
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from loader import load, secondary_indexes
+from message_search import search_messages
+from models import db, User, Message, Follows, TimelineEntry
+from snowflake import LOADER_WORKER_ID, MAX_WORKER, SEQUENCE_BITS
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+USERS = """email,username,password,image_url
+one@gmail.com,user1,HASH,
+two@gmail.com,user2,HASH,/static/images/two.png
+"""
+
+MESSAGES = [
+    {"text": "Second warble", "timestamp": "2019-01-02 09:00:00",
+     "user_id": 2},
+    {"text": "First warble", "timestamp": "2019-01-01 09:00:00",
+     "user_id": 2},
+    {"text": "My own warble", "timestamp": "2019-01-03 09:00:00",
+     "user_id": 1},
+]
+
+FOLLOWS = """user_being_followed_id,user_following_id
+2,1
+"""
+
+
+class LoaderTestCase(TestCase):
+    """Test streaming files into the database."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.users = self.write('users.csv', USERS)
+        self.messages = self.write(
+            'messages.part-0001.ndjson',
+            ''.join(json.dumps(message) + '\n' for message in MESSAGES))
+        self.follows = self.write('follows.csv', FOLLOWS)
+
+    def tearDown(self):
+        db.session.rollback()
+        self.dir.cleanup()
+        self.ctx.pop()
+        return super().tearDown()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_load(self):
+        """Rows are loaded, ordered by timestamp and counted."""
+
+        progress = []
+        loaded = load([self.follows, self.messages, self.users],
+                      chunk_size=2,
+                      progress=lambda *report: progress.append(report[:2]))
+
+        self.assertEqual(loaded, {'users': 2, 'messages': 3, 'follows': 1})
+        self.assertEqual(progress, [('users', 2), ('messages', 2),
+                                    ('messages', 3), ('follows', 1)])
+
+        user1, user2 = User.query.order_by(User.id).all()
+        self.assertEqual(user1.image_url, "/static/images/default-pic.png")
+        self.assertEqual(user2.image_url, "/static/images/two.png")
+        self.assertEqual(user2.messages_count, 2)
+        self.assertEqual(user1.following_count, 1)
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([message.text for message in messages],
+                         ["First warble", "Second warble", "My own warble"])
+        self.assertEqual(messages[0].timestamp, datetime(2019, 1, 1, 9))
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=user1.id).count(), 3)
+        self.assertEqual(len(search_messages("first")[0]), 1)
+
+        # Deferred indexes are rebuilt, and new users get fresh ids.
+        with db.engine.connect() as connection:
+            indexes = dict(secondary_indexes(connection, Message.__table__))
+        self.assertIn('ix_messages_user_feed', indexes)
+        self.assertIn('WHERE', indexes['ix_messages_pulled'])
+        User.signup(username="user3", email="three@gmail.com",
+                    password="password", image_url=None)
+        db.session.commit()
+
+    def test_append(self):
+        """Appending keeps existing rows and indexes new ones."""
+
+        load([self.users, self.follows])
+        load([self.messages], append=True)
+
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertTrue(all(message.fanned_out
+                            for message in Message.query.all()))
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 3)
+        self.assertEqual(len(search_messages("second")[0]), 1)
+
+    def test_same_millisecond(self):
+        """Messages at the same time get different ids, under the loader's
+        worker id, and a later load reusing them is refused."""
+
+        same_time = self.write('messages.ndjson', ''.join(
+            json.dumps({"text": f"Warble {number}",
+                        "timestamp": "2019-01-01 09:00:00",
+                        "user_id": 2}) + '\n'
+            for number in range(3)))
+
+        load([self.users, same_time])
+        ids = [id for (id,) in db.session.query(Message.id)]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertTrue(all(id >> SEQUENCE_BITS & MAX_WORKER ==
+                            LOADER_WORKER_ID for id in ids))
+
+        with self.assertRaises(ValueError):
+            load([same_time], append=True)
+        self.assertEqual(Message.query.count(), 3)
+
+    def test_failed_load_restores_indexes(self):
+        """Deferred indexes are rebuilt even if the load fails."""
+
+        load([self.users, self.messages])
+
+        with self.assertRaises(ValueError):
+            load([self.messages], append=True, defer_indexes=True)
+
+        with db.engine.connect() as connection:
+            indexes = dict(secondary_indexes(connection, Message.__table__))
+        self.assertIn('ix_messages_user_feed', indexes)
+        self.assertIn('ix_messages_pulled', indexes)
+
+    def test_append_recounts_touched(self):
+        """Appending recounts only the users and messages it touches."""
+
+        load([self.users, self.messages])
+        user1, user2 = User.query.order_by(User.id).all()
+        user1.messages_count = 10
+        db.session.commit()
+
+        load([self.follows], append=True)
+
+        db.session.expire_all()
+        self.assertEqual((user1.messages_count, user1.following_count),
+                         (1, 1))
+        self.assertEqual(user2.followers_count, 1)
+
+        user1.messages_count = 10
+        user2.messages_count = 10
+        db.session.commit()
+        more = self.write('messages.more.ndjson', json.dumps(
+            {"text": "Third", "timestamp": "2019-01-04 09:00:00",
+             "user_id": 2}) + '\n')
+
+        load([more], append=True)
+
+        db.session.expire_all()
+        self.assertEqual(user2.messages_count, 3)
+        # Not touched, so left as it was.
+        self.assertEqual(user1.messages_count, 10)
+
+    def test_unknown_table(self):
+        path = self.write('posts.csv', "text\nHello\n")
+        with self.assertRaises(ValueError):
+            load([path], append=True)
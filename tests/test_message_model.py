@@ -3,10 +3,12 @@ import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows, Likes
+from likes import liked_cache, liked_message_ids, forget_liked
 from sqlalchemy import exc
 
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
 
 db.create_all()
 
@@ -36,11 +38,11 @@ class MessageModelTestCase(TestCase):
         self.user1 = User.query.get(self.user_id)
 
         like = Likes(user_id=self.user1.id, message_id=self.message_id)
-        like.id = 2000
-        self.like_id = like.id
+        self.like_key = (like.user_id, like.message_id)
         db.session.add(like)
         db.session.commit()
 
+        liked_cache.clear()
         self.client = app.test_client()
 
     def tearDown(self):
@@ -65,7 +67,32 @@ class MessageModelTestCase(TestCase):
     def test_like_model(self):
         """ test basic like model"""
 
-        like = Likes.query.get(self.like_id)
+        like = Likes.query.get(self.like_key)
         self.assertEqual(like.user_id, self.user_id)
         self.assertEqual(like.message_id, self.message_id)
         self.assertEqual(len(self.user1.likes), 1)
+
+    def test_liked_ids(self):
+        """liked ids are looked up only for the given messages"""
+
+        self.assertEqual(
+            Likes.liked_ids(self.user_id, [self.message_id, 9999]),
+            {self.message_id})
+        self.assertEqual(Likes.liked_ids(self.user_id, []), set())
+
+    def test_liked_message_ids_cache(self):
+        """liked state is cached per user until forgotten"""
+
+        self.assertEqual(
+            liked_message_ids(self.user_id, [self.message_id]),
+            {self.message_id})
+
+        Likes.query.delete()
+        db.session.commit()
+        self.assertEqual(
+            liked_message_ids(self.user_id, [self.message_id]),
+            {self.message_id})
+
+        forget_liked(self.user_id)
+        self.assertEqual(
+            liked_message_ids(self.user_id, [self.message_id]), set())
@@ -9,7 +9,14 @@ from app import app, CURR_USER_KEY
 import os
 from unittest import TestCase
 
+from likes import liked_cache
+from fragments import fragment_cache
+from session_user import user_cache
+from datetime import datetime
+
 from models import db, connect_db, Message, User
+from message_search import reindex_messages
+from snowflake import id_at
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,6 +24,7 @@ from models import db, connect_db, Message, User
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
 
 
 # Now we can import app
@@ -41,6 +49,9 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        liked_cache.clear()
+        user_cache.clear()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -156,3 +167,81 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(res.status_code, 200)
             html = res.get_data(as_text=True)
             self.assertIn("Access unauthorized.", html)
+
+    def search(self, query, **headers):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            return c.get(f"/messages/search?{query}", headers=headers)
+
+    def test_search_indexes_new_messages(self):
+        """messages added and deleted through the app are searchable at once"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            c.post("/messages/new", data={"text": "Warblers are singing"})
+
+        html = self.search("q=warbler").get_data(as_text=True)
+        self.assertIn("Warblers are singing", html)
+
+        msg = Message.query.one()
+        with self.client as c:
+            c.post(f"/messages/{msg.id}/delete")
+
+        html = self.search("q=warbler").get_data(as_text=True)
+        self.assertIn("Sorry, no messages found", html)
+
+    def test_search_json(self):
+        """search results are ranked and paginated as JSON"""
+        for id, text in [(2000, "birds birds birds"), (2001, "birds and bees"),
+                         (2002, "only bees")]:
+            db.session.add(Message(id=id, text=text, user_id=self.testuser_id))
+        db.session.commit()
+        reindex_messages()
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        try:
+            res = self.search("q=bird", Accept="application/json")
+            page = res.get_json()
+            self.assertEqual([m["id"] for m in page["messages"]], ["2000"])
+            self.assertEqual(page["messages"][0]["user"]["username"], "testuser")
+
+            res = self.search(f"q=bird&after={page['next_cursor']}",
+                              Accept="application/json")
+            page = res.get_json()
+            self.assertEqual([m["id"] for m in page["messages"]], ["2001"])
+            self.assertIsNone(page["next_cursor"])
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_search_time_bounds(self):
+        """since and until limit results to when messages were posted"""
+        for day in [1, 10, 20]:
+            posted = datetime(2020, 1, day)
+            db.session.add(Message(id=id_at(posted), text="Hello",
+                                   user_id=self.testuser_id, timestamp=posted))
+        db.session.commit()
+        reindex_messages()
+        db.session.commit()
+
+        res = self.search("q=hello&since=2020-01-05&until=2020-01-20",
+                          Accept="application/json")
+        self.assertEqual([m["id"] for m in res.get_json()["messages"]],
+                         [str(id_at(datetime(2020, 1, 10)))])
+
+        # Times with an offset are compared in UTC.
+        res = self.search("q=hello&since=2020-01-10T00:00:00%2B02:00",
+                          Accept="application/json")
+        self.assertEqual(len(res.get_json()["messages"]), 2)
+        res = self.search("q=hello&since=2020-01-10T00:00:00%2B00:00",
+                          Accept="application/json")
+        self.assertEqual(len(res.get_json()["messages"]), 2)
+        res = self.search("q=hello&since=2020-01-10T00:00:00-02:00",
+                          Accept="application/json")
+        self.assertEqual(len(res.get_json()["messages"]), 1)
+
+        for bad in ("yesterday", "9999-01-01",
+                    "0001-01-01T00:00:00%2B01:00"):
+            res = self.search(f"q=hello&since={bad}")
+            self.assertEqual(res.status_code, 400, bad)
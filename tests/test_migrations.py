@@ -0,0 +1,213 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+from app import app
+import os
+import warnings
+from unittest import TestCase
+
+from sqlalchemy import inspect
+from sqlalchemy.exc import SAWarning
+
+from explain import index_report
+from message_ids import LEGACY_ID_LIMIT
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from migrations import (MIGRATIONS, schema_migrations, pending_migrations,
+                        stamp, upgrade)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+# The schema Warbler's models made before migrations existed.
+BASELINE_SCHEMA = [
+    "CREATE TABLE users ("
+    " id SERIAL PRIMARY KEY,"
+    " email TEXT NOT NULL UNIQUE,"
+    " username TEXT NOT NULL UNIQUE,"
+    " image_url TEXT,"
+    " header_image_url TEXT,"
+    " bio TEXT,"
+    " location TEXT,"
+    " password TEXT NOT NULL)",
+    "CREATE TABLE follows ("
+    " user_being_followed_id INTEGER REFERENCES users ON DELETE CASCADE,"
+    " user_following_id INTEGER REFERENCES users ON DELETE CASCADE,"
+    " PRIMARY KEY (user_being_followed_id, user_following_id))",
+    "CREATE TABLE messages ("
+    " id SERIAL PRIMARY KEY,"
+    " text VARCHAR(140) NOT NULL,"
+    " timestamp TIMESTAMP NOT NULL,"
+    " user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE)",
+    "CREATE TABLE likes ("
+    " id SERIAL PRIMARY KEY,"
+    " user_id INTEGER REFERENCES users ON DELETE CASCADE,"
+    " message_id INTEGER UNIQUE REFERENCES messages ON DELETE CASCADE)",
+]
+
+
+class MigrationTestCase(TestCase):
+    """Test bringing existing databases up to date."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        stamp()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        return super().tearDown()
+
+    def forget(self, version):
+        """Pretend migration `version` was never applied."""
+
+        db.session.execute(schema_migrations.delete()
+                           .where(schema_migrations.c.version == version))
+        db.session.commit()
+
+    def index_names(self, table):
+        # Reflection can't read partial indexes' WHERE; names are enough.
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', "Predicate of partial index",
+                                    SAWarning)
+            return {index['name']
+                    for index in inspect(db.engine).get_indexes(table)}
+
+    def schema(self):
+        """Each table's columns, with their types and nullability, and
+        indexes."""
+
+        inspector = inspect(db.engine)
+        return {table: ({(column['name'], str(column['type']),
+                          column['nullable'])
+                         for column in inspector.get_columns(table)},
+                        self.index_names(table))
+                for table in inspector.get_table_names()}
+
+    def test_new_database_is_current(self):
+        """create-db marks every migration as applied."""
+
+        self.assertEqual(pending_migrations(), [])
+        self.assertEqual(upgrade(), [])
+
+    def test_upgrade_from_baseline(self):
+        """A database made before migrations is brought fully up to date."""
+
+        db.session.commit()
+        db.drop_all()
+        for statement in BASELINE_SCHEMA:
+            db.session.execute(statement)
+        db.session.execute(
+            "INSERT INTO users (id, email, username, password) VALUES "
+            "(1, '1@gmail.com', 'user1', 'x'), "
+            "(2, '2@gmail.com', 'user2', 'x')")
+        db.session.execute("INSERT INTO follows VALUES (2, 1)")
+        db.session.execute(
+            "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+            "(1, 'Hello', '2020-05-17 12:30', 2)")
+        db.session.execute(
+            "INSERT INTO likes (user_id, message_id) VALUES (1, 1)")
+        db.session.commit()
+
+        self.assertEqual(len(upgrade()), len(MIGRATIONS))
+
+        message = Message.query.one()
+        self.assertGreaterEqual(message.id, LEGACY_ID_LIMIT)
+        self.assertEqual(message.like_count, 1)
+        self.assertEqual(
+            [(user.messages_count, user.following_count,
+              user.followers_count, user.likes_count)
+             for user in User.query.order_by(User.id)],
+            [(0, 1, 0, 1), (1, 0, 1, 0)])
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=1).one().message_id,
+            message.id)
+
+        # The result is what a new database gets.
+        upgraded = self.schema()
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(upgraded, self.schema())
+
+    def test_upgrade_builds_missing_index(self):
+        """Pending migrations build their indexes."""
+
+        db.session.execute("DROP INDEX ix_follows_following")
+        db.session.commit()
+        self.forget('0007')
+
+        applied = upgrade()
+
+        self.assertEqual([migration.version for migration in applied],
+                         ['0007'])
+        self.assertIn('ix_follows_following', self.index_names('follows'))
+        self.assertEqual(pending_migrations(), [])
+
+    def test_upgrade_rekeys_likes(self):
+        """Likes with a unique message_id are rekeyed and counted."""
+
+        for id in (1, 2):
+            user = User.signup(username=f"user{id}", email=f"{id}@gmail.com",
+                               password="password", image_url=None)
+            user.id = id
+        db.session.add(Message(id=10, text="Hello", user_id=2))
+        db.session.flush()
+        db.session.execute("DROP TABLE likes")
+        db.session.execute(
+            "CREATE TABLE likes ("
+            " id SERIAL PRIMARY KEY,"
+            " user_id INTEGER REFERENCES users ON DELETE CASCADE,"
+            " message_id BIGINT UNIQUE REFERENCES messages ON DELETE CASCADE)")
+        db.session.execute("ALTER TABLE messages DROP COLUMN like_count")
+        db.session.execute(
+            "INSERT INTO likes (user_id, message_id) VALUES (1, 10)")
+        db.session.commit()
+        self.forget('0008')
+
+        upgrade()
+
+        self.assertTrue(Likes.add(2, 10))
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(Message.query.get(10).like_count, 1)
+        self.assertIn('ix_likes_message', self.index_names('likes'))
+
+    def test_upgrades_are_rerunnable(self):
+        """Re-running every migration on a current database is harmless."""
+
+        for migration in MIGRATIONS:
+            self.forget(migration.version)
+
+        self.assertEqual(len(upgrade()), len(MIGRATIONS))
+        self.assertEqual(pending_migrations(), [])
+
+    def test_index_report(self):
+        """The report names the indexes a route's queries use."""
+
+        for id in (1, 2):
+            user = User.signup(username=f"user{id}", email=f"{id}@gmail.com",
+                               password="password", image_url=None)
+            user.id = id
+        db.session.commit()
+        db.session.add(Follows(user_following_id=1, user_being_followed_id=2))
+        db.session.add(Message(text="Hello", user_id=2))
+        db.session.commit()
+
+        report = index_report(app, urls=["/users/2", "/users/1/following"],
+                              user_id=1, prefer_indexes=True)
+
+        used = {url: {index for plan in plans for index in plan.indexes}
+                for url, plans in report.items()}
+        self.assertIn('ix_messages_user_feed', used["/users/2"])
+        self.assertIn('ix_follows_following', used["/users/1/following"])
@@ -0,0 +1,151 @@
+"""Query count tests for message list pages."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_counts.py
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from likes import liked_cache
+from fragments import fragment_cache
+from session_user import user_cache, load_current_user
+from models import db, User, Message, Follows, Likes
+from query_counter import QueryCountMixin
+from query_stats import RequestQueries, statement_shape
+from timeline import rebuild_timelines
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Most statements each page may issue, for the data set up below.
+QUERY_BUDGETS = {
+    "/": 6,
+    "/users/2000": 4,
+    "/users/1000/likes": 3,
+    "/users/1000/following": 3,
+    "/users/2000/followers": 5,
+    "/messages/20000": 2,
+}
+
+
+class QueryCountTestCase(QueryCountMixin, TestCase):
+    """Message list pages cost a fixed number of queries however many
+    messages and authors they show."""
+
+    def setUp(self):
+        """Create a reader following several authors with a few messages."""
+
+        db.drop_all()
+        db.create_all()
+        liked_cache.clear()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        reader.id = 1000
+        self.reader_id = reader.id
+
+        for author_id in range(2000, 2005):
+            author = User.signup(username=f"author{author_id}",
+                                 email=f"author{author_id}@test.com",
+                                 password="password", image_url=None)
+            author.id = author_id
+        db.session.commit()
+
+        for author_id in range(2000, 2005):
+            db.session.add(Follows(user_being_followed_id=author_id,
+                                   user_following_id=self.reader_id))
+            for n in range(4):
+                db.session.add(Message(id=author_id * 10 + n,
+                                       text=f"Message {n}",
+                                       user_id=author_id))
+        db.session.commit()
+
+        for message_id in (20000, 20010, 20020):
+            db.session.add(Likes(user_id=self.reader_id,
+                                 message_id=message_id))
+        db.session.commit()
+
+        with app.app_context():
+            rebuild_timelines()
+            db.session.commit()
+
+            # Budgets are for a logged-in user whose session is cached.
+            load_current_user(self.reader_id)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_query_budgets(self):
+        """Each route stays within its declared query budget."""
+
+        for url, budget in QUERY_BUDGETS.items():
+            with self.subTest(url=url):
+                self.assertQueryBudget(self.client, url, budget)
+
+    def test_budget_independent_of_page_size(self):
+        """Doubling the messages shown doesn't add queries."""
+
+        for n in range(4, 8):
+            db.session.add(Message(id=20000 + n, text=f"Message {n}",
+                                   user_id=2000))
+        db.session.commit()
+        with app.app_context():
+            rebuild_timelines()
+            db.session.commit()
+
+        self.assertQueryBudget(self.client, "/", QUERY_BUDGETS["/"])
+
+    def test_session_user_cache_miss(self):
+        """Only a cold session user costs an extra query."""
+
+        user_cache.clear()
+        self.assertQueryBudget(self.client, "/messages/20000",
+                               QUERY_BUDGETS["/messages/20000"] + 1)
+        self.assertQueryBudget(self.client, "/messages/20000",
+                               QUERY_BUDGETS["/messages/20000"])
+
+    def test_server_timing_header(self):
+        """Responses report their database time and query count."""
+
+        res = self.client.get("/")
+        self.assertRegex(res.headers["Server-Timing"],
+                         r'db;dur=[\d.]+;desc="\d+ queries"')
+
+
+class StatementShapeTestCase(TestCase):
+    """Test how statements are grouped when looking for N+1 queries."""
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT * FROM users\n  WHERE id = %(param_1)s"),
+            "SELECT * FROM users WHERE id = ?")
+
+    def test_in_lists_share_a_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT 1 WHERE id IN (%(id_1)s, %(id_2)s)"),
+            statement_shape("SELECT 1 WHERE id IN (%(id_1)s)"))
+
+    def test_repeated(self):
+        queries = RequestQueries()
+        for n in range(3):
+            queries.record(f"SELECT * FROM users WHERE id = {n}", 0.001)
+        queries.record("SELECT * FROM messages", 0.001)
+
+        self.assertEqual(queries.count, 4)
+        self.assertEqual(queries.repeated(2),
+                         [("SELECT * FROM users WHERE id = ?", 3)])
+        self.assertEqual(queries.repeated(3), [])
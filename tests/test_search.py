@@ -0,0 +1,104 @@
+"""Username search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+from app import app
+import os
+from unittest import TestCase
+
+from models import db, User
+from search import (decode_search_cursor, encode_search_cursor, escape_like,
+                    search_users)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SearchTestCase(TestCase):
+    """Test ranked, paginated username search."""
+
+    def setUp(self):
+        """Add users with overlapping names."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        for id, username in enumerate(["bobcat", "Bob", "jimbob", "bobby",
+                                       "alice", "under_score"], start=1):
+            user = User.signup(username=username,
+                               email=f"{username}@gmail.com",
+                               password="password", image_url=None)
+            user.id = id
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        return super().tearDown()
+
+    def usernames(self, users):
+        return [user.username for user in users]
+
+    def test_case_insensitive(self):
+        """Matches ignore case in both the term and the names."""
+
+        users, _ = search_users("BOB")
+        self.assertEqual(set(self.usernames(users)),
+                         {"bobcat", "Bob", "jimbob", "bobby"})
+
+    def test_prefix_matches_rank_first(self):
+        """Prefix matches outrank other matches; closer names rank higher."""
+
+        users, _ = search_users("bob")
+        self.assertEqual(self.usernames(users)[0], "Bob")
+        self.assertEqual(self.usernames(users)[-1], "jimbob")
+
+    def test_wildcards_are_literal(self):
+        """LIKE wildcards in the term only match themselves."""
+
+        users, _ = search_users("_")
+        self.assertEqual(self.usernames(users), ["under_score"])
+        self.assertEqual(escape_like("50%_\\"), "50\\%\\_\\\\")
+
+    def test_pagination(self):
+        """Following cursors walks every match exactly once, in rank order."""
+
+        everything, _ = search_users("b")
+
+        seen = []
+        after = None
+        while True:
+            users, cursor = search_users("b", after=after, limit=2)
+            seen.extend(users)
+            if cursor is None:
+                break
+            after = decode_search_cursor(cursor)
+
+        self.assertEqual(seen, everything)
+
+    def test_list_all(self):
+        """Without a term, every user is listed newest first."""
+
+        users, cursor = search_users(None, limit=4)
+        self.assertEqual([user.id for user in users], [6, 5, 4, 3])
+
+        users, cursor = search_users("", after=decode_search_cursor(cursor))
+        self.assertEqual([user.id for user in users], [2, 1])
+        self.assertIsNone(cursor)
+
+    def test_cursor_round_trip(self):
+        cursor = encode_search_cursor(1, 0.4285714328289032, 42)
+        self.assertEqual(decode_search_cursor(cursor),
+                         (1, 0.4285714328289032, 42))
+
+        with self.assertRaises(ValueError):
+            decode_search_cursor("not a cursor")
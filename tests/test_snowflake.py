@@ -0,0 +1,180 @@
+"""Snowflake message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+from app import app
+import os
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from message_ids import backfill_message_ids
+from snowflake import (SnowflakeGenerator, EPOCH_MS, LOADER_WORKER_ID,
+                       MAX_SEQUENCE, MAX_WORKER, SEQUENCE_BITS, id_at,
+                       next_id, timestamp_of)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+
+class SnowflakeTestCase(TestCase):
+    """Test id generation."""
+
+    def test_layout(self):
+        """Ids pack the time, worker and sequence number."""
+
+        generator = SnowflakeGenerator(worker_id=5)
+        with patch('snowflake.current_ms', return_value=EPOCH_MS + 1000):
+            first = generator.next_id()
+            second = generator.next_id()
+
+        self.assertEqual(first, 1000 << 22 | 5 << 12)
+        self.assertEqual(second, first + 1)
+        self.assertEqual(timestamp_of(first), datetime(2010, 1, 1, 0, 0, 1))
+
+    def test_increasing(self):
+        """Ids keep increasing even if the clock stalls or goes back."""
+
+        generator = SnowflakeGenerator(worker_id=0)
+        with patch('snowflake.current_ms', return_value=EPOCH_MS + 10):
+            ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        with patch('snowflake.current_ms', return_value=EPOCH_MS):
+            ids.append(generator.next_id())
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(timestamp_of(ids[-1]), timestamp_of(ids[-2]))
+
+    def test_id_at(self):
+        moment = datetime(2020, 6, 1, 12, 30)
+        self.assertEqual(timestamp_of(id_at(moment)), moment)
+        self.assertLess(id_at(moment), id_at(datetime(2020, 6, 1, 12, 31)))
+
+        # Aware datetimes are converted to UTC.
+        eastern = timezone(timedelta(hours=-5))
+        self.assertEqual(id_at(datetime(2020, 6, 1, 7, 30, tzinfo=eastern)),
+                         id_at(moment))
+
+    def test_bad_worker(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(worker_id=1024)
+
+
+def worker_of(id):
+    return id >> SEQUENCE_BITS & MAX_WORKER
+
+
+class ForkTestCase(TestCase):
+    """Test that forked processes don't reuse their parent's worker id."""
+
+    def in_child(self, setup):
+        """Fork, run `setup` and make an id in the child. Returns the
+        child's pid and the id's worker, or None if it had none."""
+
+        read, write = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            result = b''
+            try:
+                setup()
+                result = str(worker_of(next_id())).encode('ascii')
+            except RuntimeError:
+                pass
+            finally:
+                os.write(write, result)
+                os._exit(0)
+
+        os.close(write)
+        os.waitpid(pid, 0)
+        with os.fdopen(read, 'rb') as pipe:
+            result = pipe.read()
+
+        return pid, int(result) if result else None
+
+    def test_worker_per_process(self):
+        self.assertEqual(worker_of(next_id()), 1)
+
+        def own_worker_id():
+            os.environ['SNOWFLAKE_WORKER_ID'] = "2"
+
+        _, worker = self.in_child(own_worker_id)
+        self.assertEqual(worker, 2)
+        self.assertEqual(worker_of(next_id()), 1)
+
+    def test_inherited_worker_id_refused(self):
+        """A forked process must not use the worker id it inherited."""
+
+        next_id()
+        _, worker = self.in_child(lambda: None)
+        self.assertIsNone(worker)
+
+    def test_testing_falls_back_to_pid(self):
+        def testing():
+            app.testing = True
+            app.app_context().push()
+
+        pid, worker = self.in_child(testing)
+        self.assertEqual(worker, pid % LOADER_WORKER_ID)
+
+    def test_loader_worker_id_reserved(self):
+        def loader_worker_id():
+            os.environ['SNOWFLAKE_WORKER_ID'] = str(LOADER_WORKER_ID)
+
+        _, worker = self.in_child(loader_worker_id)
+        self.assertIsNone(worker)
+
+
+class BackfillTestCase(TestCase):
+    """Test renumbering messages with serial ids."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        for id in (1, 2):
+            user = User.signup(username=f"user{id}", email=f"{id}@gmail.com",
+                               password="password", image_url=None)
+            user.id = id
+        db.session.commit()
+
+        db.session.add(Follows(user_following_id=1, user_being_followed_id=2))
+        for id, day in [(1, 3), (2, 1), (3, 1)]:
+            db.session.add(Message(id=id, text=f"Message {id}", user_id=2,
+                                   timestamp=datetime(2019, 1, day)))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=1, message_id=1))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        return super().tearDown()
+
+    def test_backfill(self):
+        """Messages get time-ordered ids and keep their likes."""
+
+        self.assertEqual(backfill_message_ids(batch_size=2), 3)
+        db.session.commit()
+
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual([msg.text for msg in messages],
+                         ["Message 2", "Message 3", "Message 1"])
+        self.assertEqual(messages[0].id, id_at(datetime(2019, 1, 1)))
+        self.assertEqual(messages[1].id, messages[0].id + 1)
+
+        like = Likes.query.one()
+        self.assertEqual(like.message_id, messages[2].id)
+
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 3)
+
+        # Already renumbered messages are left alone.
+        self.assertEqual(backfill_message_ids(), 0)
@@ -0,0 +1,266 @@
+"""Thumbnail proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_thumbnails.py
+
+from app import app
+import io
+import os
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+import thumbnails
+from thumbnails import ThumbnailCache, thumb_url
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ThumbnailTestCase(TestCase):
+    """Test fetching, resizing and caching users' pictures.
+
+    Pictures are fetched from files standing in for other sites.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.dir.name, 'origin')
+        os.makedirs(self.origin)
+
+        self.config = {key: app.config[key] for key in
+                       ('IMAGE_CACHE_FOLDER', 'IMAGE_PROXY_SCHEMES')}
+        app.config['IMAGE_CACHE_FOLDER'] = os.path.join(self.dir.name,
+                                                        'cache')
+        app.config['IMAGE_PROXY_SCHEMES'] = ('file',)
+
+        thumbnails.failed.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        thumbnails._caches.clear()
+        self.dir.cleanup()
+        return super().tearDown()
+
+    def origin_server(self):
+        """Serve a picture on 127.0.0.1; returns its port and the Host
+        headers of the requests it gets."""
+
+        picture = io.BytesIO()
+        Image.new('RGB', (200, 200), 'red').save(picture, 'PNG')
+        hosts = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hosts.append(self.headers['Host'])
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.end_headers()
+                self.wfile.write(picture.getvalue())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1], hosts
+
+    def resolving(self, *answers):
+        """Patch DNS to give each answer in turn, then the last for good,
+        and treat 127.0.0.2 as a public address."""
+
+        answers = list(answers)
+
+        def getaddrinfo(host, port, *args, **kwargs):
+            address = answers.pop(0) if len(answers) > 1 else answers[0]
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     (address, port))]
+
+        app.config['IMAGE_PROXY_SCHEMES'] = ('http',)
+        public = patch.object(thumbnails, 'public_address',
+                              lambda address: address == '127.0.0.2')
+        public.start()
+        self.addCleanup(public.stop)
+        resolver = patch('socket.getaddrinfo', getaddrinfo)
+        resolver.start()
+        self.addCleanup(resolver.stop)
+
+    def picture(self, name, size=(800, 600), mode='RGB'):
+        """Make a picture at the origin and return its URL."""
+
+        path = os.path.join(self.origin, name)
+        Image.new(mode, size, 'red').save(path)
+        return f"file://{path}"
+
+    def url_for(self, url, size):
+        with app.test_request_context():
+            return thumb_url(url, size)
+
+    def get(self, url):
+        res = self.client.get(url)
+        data = res.get_data()
+        res.close()
+        return res, data
+
+    def test_resized(self):
+        """Pictures are cropped to their slot and served for good."""
+
+        res, data = self.get(self.url_for(self.picture('me.png'), 'card'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'image/jpeg')
+        self.assertEqual(res.headers['Cache-Control'], CACHE_CONTROL)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (140, 140))
+
+        url = self.url_for(self.picture('header.png'), 'card-hero')
+        res, data = self.get(url)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (720, 260))
+
+    def test_not_enlarged(self):
+        """Small pictures keep their size, cropped to the slot's shape."""
+
+        url = self.url_for(self.picture('small.png', (60, 30), 'RGBA'),
+                           'avatar')
+        res, data = self.get(url)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (30, 30))
+
+    def test_fetched_once(self):
+        """Thumbnails are served from the cache once made."""
+
+        picture = self.picture('me.png')
+        url = self.url_for(picture, 'timeline')
+        _, data = self.get(url)
+
+        os.remove(picture[len('file://'):])
+        res, cached = self.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(cached, data)
+
+    def test_default_pictures(self):
+        """Pictures in our own static folder need no proxying."""
+
+        res, data = self.get(
+            self.url_for("/static/images/default-pic.png", 'nav'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (64, 64))
+
+        with app.test_request_context():
+            self.assertEqual(thumb_url(None, 'card'),
+                             "/static/images/default-pic.png")
+
+    def test_bad_signature(self):
+        """Only URLs the app linked to are fetched."""
+
+        url = self.url_for(self.picture('me.png'), 'card')
+        _, _, signature, token = url.rsplit('/', 3)
+
+        res, _ = self.get(f"/images/card/{'0' * 16}/{token}")
+        self.assertEqual(res.status_code, 404)
+        res, _ = self.get(f"/images/avatar/{signature}/{token}")
+        self.assertEqual(res.status_code, 404)
+        res, _ = self.get(f"/images/huge/{signature}/{token}")
+        self.assertEqual(res.status_code, 404)
+
+    def test_failures(self):
+        """Pictures that can't be fetched or read show the default."""
+
+        broken = os.path.join(self.origin, 'broken.png')
+        with open(broken, 'wb') as file:
+            file.write(b'not a picture')
+
+        for url in (f"file://{broken}",
+                    f"file://{self.origin}/missing.png",
+                    "http://127.0.0.1/me.png"):
+            res, _ = self.get(self.url_for(url, 'hero'))
+            self.assertEqual(res.status_code, 302)
+            self.assertTrue(res.location.endswith(
+                "/static/images/warbler-hero.jpg"))
+
+        # Failures aren't retried for a while.
+        with open(broken, 'wb') as file:
+            Image.new('RGB', (10, 10)).save(file, 'PNG')
+        res, _ = self.get(self.url_for(f"file://{broken}", 'hero'))
+        self.assertEqual(res.status_code, 302)
+
+    def test_private_hosts(self):
+        app.config['IMAGE_PROXY_SCHEMES'] = ('http', 'https')
+        for url in ("http://localhost/me.png", "http://10.0.0.1/me.png",
+                    "https://169.254.169.254/latest", "ftp://example.com/a"):
+            res, _ = self.get(self.url_for(url, 'card'))
+            self.assertEqual(res.status_code, 302, url)
+
+    def test_checked_address_used(self):
+        """Fetches connect to the address checked, under the original
+        host name."""
+
+        port, hosts = self.origin_server()
+        self.resolving('127.0.0.1')
+
+        # Pretend loopback is public just for this fetch.
+        with patch.object(thumbnails, 'public_address', lambda _: True):
+            res, _ = self.get(
+                self.url_for(f"http://pictures.test:{port}/me.png", 'card'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(hosts, [f"pictures.test:{port}"])
+
+    def test_dns_rebinding(self):
+        """A host that resolves to a public address when checked and a
+        private one afterwards is never fetched from the private one."""
+
+        port, hosts = self.origin_server()
+        self.resolving('127.0.0.2', '127.0.0.1')
+
+        res, _ = self.get(
+            self.url_for(f"http://rebind.test:{port}/me.png", 'card'))
+
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(hosts, [])
+
+    def test_evicted_while_serving(self):
+        """A thumbnail evicted after it was found is still served."""
+
+        url = self.url_for(self.picture('me.png'), 'card')
+        _, data = self.get(url)
+        cache = thumbnails._caches[app.config['IMAGE_CACHE_FOLDER']]
+
+        get = cache.get
+
+        def get_then_evict(key):
+            file = get(key)
+            os.remove(cache.path(key))
+            return file
+
+        with patch.object(cache, 'get', get_then_evict):
+            res, served = self.get(url)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(served, data)
+
+    def test_eviction(self):
+        """The least recently served thumbnails go when the cache is
+        full."""
+
+        cache = ThumbnailCache(os.path.join(self.dir.name, 'small'), 1000)
+        first = cache.put('aa01', b'x' * 400)
+        second = cache.put('bb02', b'x' * 400)
+        os.utime(first, (0, 0))
+        os.utime(second, (1, 1))
+
+        # Serving the first makes it the most recent.
+        with cache.get('aa01') as file:
+            self.assertEqual(file.read(), b'x' * 400)
+        cache.put('cc03', b'x' * 400)
+
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertIsNone(cache.get('bb02'))
+        self.assertLessEqual(cache.size, 900)
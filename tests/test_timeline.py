@@ -0,0 +1,166 @@
+"""Home timeline fan-out tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+from app import app, CURR_USER_KEY
+import os
+from unittest import TestCase
+
+from counters import increment
+from models import db, User, Message, Follows, TimelineEntry
+from explain import capture_selects, explain
+from fragments import fragment_cache
+from session_user import user_cache
+from timeline import fan_out, home_timeline, rebuild_timelines
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test materialized home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.clear()
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+        user1 = User.signup(
+            username="user1", email="user1@gmail.com", password="password", image_url=None)
+        user1.id = 1000
+        user2 = User.signup(
+            username="user2", email="user2@gmail.com", password="password", image_url=None)
+        user2.id = 2000
+        self.user1_id = user1.id
+        self.user2_id = user2.id
+        db.session.commit()
+
+        # user1 follows user2
+        follow = Follows(user_being_followed_id=self.user2_id,
+                         user_following_id=self.user1_id)
+        db.session.add(follow)
+        increment(self.user2_id, followers_count=1)
+        increment(self.user1_id, following_count=1)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.ctx.pop()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+        return super().tearDown()
+
+    def post(self, user_id, text, message_id):
+        """Write a message and fan it out the way messages_add does."""
+
+        msg = Message(id=message_id, text=text, user_id=user_id)
+        db.session.add(msg)
+        db.session.flush()
+        fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """New messages land in the author's and followers' timelines."""
+
+        msg = self.post(self.user2_id, "Hello followers", 3000)
+
+        self.assertTrue(msg.fanned_out)
+        owners = {entry.user_id for entry in TimelineEntry.query.all()}
+        self.assertEqual(owners, {self.user1_id, self.user2_id})
+        self.assertEqual(
+            [m.id for m in home_timeline(self.user1_id)[0]], [3000])
+
+    def test_heavy_author_pulled_at_read(self):
+        """Authors over the fan-out limit are merged in at read time."""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        msg = self.post(self.user2_id, "Hello everyone", 3000)
+
+        self.assertFalse(msg.fanned_out)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        self.assertEqual(
+            [m.id for m in home_timeline(self.user1_id)[0]], [3000])
+
+    def test_pull_reads_partial_index(self):
+        """The home page, and its validator, pull messages through
+        ix_messages_pulled rather than scanning messages."""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        self.post(self.user2_id, "Hello everyone", 3000)
+
+        plans = explain(db.engine, capture_selects(app, "/", self.user1_id),
+                        prefer_indexes=True)
+        pulls = [plan for plan in plans
+                 if 'fanned_out' in plan.statement.partition(' WHERE ')[2]]
+
+        self.assertEqual(len(pulls), 2)
+        for plan in pulls:
+            self.assertIn('ix_messages_pulled', plan.indexes)
+            self.assertNotIn('messages', plan.scans)
+
+    def test_add_message_fans_out(self):
+        """Posting through the view fills followers' timelines."""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            c.post("/messages/new", data={"text": "Hello"})
+
+        entry = TimelineEntry.query.filter_by(user_id=self.user1_id).one()
+        self.assertEqual(entry.author_id, self.user2_id)
+
+    def test_follow_backfills_and_unfollow_retracts(self):
+        """Following copies recent messages; unfollowing removes them."""
+
+        self.post(self.user1_id, "From user1", 3000)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            self.assertEqual(
+                [m.id for m in home_timeline(self.user2_id)[0]], [3000])
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            self.assertEqual(home_timeline(self.user2_id), ([], None))
+
+    def test_destroy_message_removes_entries(self):
+        """Deleting a message removes it from every timeline."""
+
+        self.post(self.user2_id, "Short lived", 3000)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            c.post("/messages/3000/delete")
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild_timelines(self):
+        """Rebuilding delivers messages that bypassed fan-out."""
+
+        db.session.add(Message(id=3000, text="Bulk loaded",
+                               user_id=self.user2_id))
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 2)
+        self.assertTrue(Message.query.get(3000).fanned_out)
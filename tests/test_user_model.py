@@ -8,7 +8,8 @@ from app import app
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, FollowState
+from counters import recount
 from sqlalchemy import exc
 
 # BEFORE we import our app, let's set an environmental variable
@@ -17,6 +18,7 @@ from sqlalchemy import exc
 # connected to the database
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
 
 
 # Now we can import app
@@ -95,6 +97,25 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user1.is_following(self.user2))
         self.assertFalse(self.user2.is_following(self.user1))
 
+    def test_following_ids(self):
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_ids([1000, 2000, 9999]), {2000})
+        self.assertEqual(self.user2.following_ids([1000, 2000]), set())
+        self.assertEqual(self.user1.following_ids([]), set())
+
+    def test_follow_state(self):
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        state = FollowState(self.user1.id)
+        state.prime([1000, 2000])
+        self.assertEqual(state.checked, {1000, 2000})
+        self.assertTrue(state.is_following(2000))
+        self.assertFalse(state.is_following(1000))
+        self.assertFalse(FollowState(None).is_following(2000))
+
     def test_user_follows(self):
         self.user1.following.append(self.user2)
         db.session.commit()
@@ -103,6 +124,25 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(self.user2.followers), 1)
         self.assertEqual(len(self.user2.following), 0)
 
+    def test_recount(self):
+        """Recount rebuilds counters from the underlying rows."""
+
+        self.user1.following.append(self.user2)
+        message = Message(id=5000, text="Counted", user_id=self.user2.id)
+        db.session.add(message)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user1.id, message_id=5000))
+        db.session.commit()
+        self.assertEqual(self.user1.following_count, 0)
+
+        recount()
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user1.likes_count, 1)
+        self.assertEqual(self.user2.followers_count, 1)
+        self.assertEqual(self.user2.messages_count, 1)
+
     def test_valid_signup(self):
         user_test = User.signup(
             "user_test", "user_test@gmail.com", "password", None)
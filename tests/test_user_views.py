@@ -1,11 +1,19 @@
 from app import app, CURR_USER_KEY
 import os
+import re
 from unittest import TestCase
 
+from datetime import datetime
+from likes import liked_cache
+from like_counts import pending_likes, flush, flush_at_exit
+from fragments import fragment_cache
+from session_user import user_cache
 from models import db, connect_db, User, Message, Follows, Likes
+from counters import recount, recount_likes
 from sqlalchemy import exc
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['SNOWFLAKE_WORKER_ID'] = "1"
 
 
 db.create_all()
@@ -22,6 +30,10 @@ class TestUserViews(TestCase):
 
         db.drop_all()
         db.create_all()
+        liked_cache.clear()
+        user_cache.clear()
+        fragment_cache.clear()
+        pending_likes.clear()
 
         # add user data
         user = User.signup(
@@ -62,6 +74,51 @@ class TestUserViews(TestCase):
             self.assertIn("<p>@user1</p>", html)
             self.assertIn("<p>@user2</p>", html)
 
+    def test_user_index_streaming(self):
+        """test the users page streams a batch of rows at a time, and
+        renders the same without streaming"""
+
+        app.config['STREAM_BATCH_SIZE'] = 1
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                res = client.get("/users")
+                # Streamed headers go out before the page's queries run.
+                self.assertNotIn('Server-Timing', res.headers)
+                streamed = res.get_data(as_text=True)
+                self.assertIn("<p>@user2</p>", streamed)
+                self.assertNotIn("<p>@user1</p>", streamed)
+                self.assertIn("More users", streamed)
+
+                app.config['STREAM_TEMPLATES'] = False
+                res = client.get("/users")
+                self.assertIn('Server-Timing', res.headers)
+                self.assertEqual(res.get_data(as_text=True), streamed)
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = 100
+            app.config['USERS_PER_PAGE'] = 100
+            app.config['STREAM_TEMPLATES'] = True
+
+    def test_user_index_no_results(self):
+        """test searching for users that don't exist"""
+
+        with app.test_client() as client:
+            res = client.get("/users?q=nobody")
+            self.assertIn("Sorry, no users found",
+                          res.get_data(as_text=True))
+
+    def test_user_index_follow_buttons(self):
+        """test follow buttons on the users page reflect follow state"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            res = client.get("/users")
+            html = res.get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.user2_id}"', html)
+            self.assertIn(f'action="/users/follow/{self.user_id}"', html)
+
     def test_user_search(self):
         """ test users search page"""
 
@@ -71,6 +128,28 @@ class TestUserViews(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("<p>@user1</p>", html)
 
+    def test_user_search_pagination(self):
+        """test users search pages through matches"""
+
+        app.config['USERS_PER_PAGE'] = 1
+        try:
+            with app.test_client() as client:
+                res = client.get("/users?q=USER")
+                html = res.get_data(as_text=True)
+                self.assertIn("<p>@user2</p>", html)
+                self.assertNotIn("<p>@user1</p>", html)
+
+                next_page = re.search(r'href="(/users\?q=USER&after=[^"]+)"', html)
+                res = client.get(next_page.group(1))
+                html = res.get_data(as_text=True)
+                self.assertIn("<p>@user1</p>", html)
+                self.assertNotIn("More users", html)
+
+                res = client.get("/users?q=USER&after=not-a-cursor")
+                self.assertEqual(res.status_code, 400)
+        finally:
+            app.config['USERS_PER_PAGE'] = 100
+
     def test_user_show(self):
         """test user show"""
 
@@ -81,6 +160,39 @@ class TestUserViews(TestCase):
             self.assertIn("Test Message", html)
             self.assertIn("@user2", html)
 
+    def test_user_show_pagination(self):
+        """test paging back through a user's messages"""
+
+        older = Message(id=1500, text="Older Message", user_id=self.user2_id,
+                        timestamp=datetime(2000, 1, 1))
+        db.session.add(older)
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                res = client.get(f'/users/{self.user2_id}')
+                html = res.get_data(as_text=True)
+                self.assertIn("Test Message", html)
+                self.assertNotIn("Older Message", html)
+                self.assertIn("Load older", html)
+
+                cursor = html.split("?before=")[1].split('"')[0]
+                res = client.get(f'/users/{self.user2_id}?before={cursor}')
+                html = res.get_data(as_text=True)
+                self.assertIn("Older Message", html)
+                self.assertNotIn("Test Message", html)
+                self.assertNotIn("Load older", html)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_user_show_bad_cursor(self):
+        """test a malformed pagination cursor"""
+
+        with app.test_client() as client:
+            res = client.get(f'/users/{self.user2_id}?before=nonsense')
+            self.assertEqual(res.status_code, 400)
+
     def test_show_following(self):
         """ test show following """
 
@@ -105,6 +217,38 @@ class TestUserViews(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("<p>@user1</p>", html)
 
+    def test_show_following_pagination(self):
+        """test paging through the users someone follows"""
+
+        user3 = User.signup(username="user3", email="user3@gmail.com",
+                            password="password", image_url=None)
+        user3.id = 3000
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=3000,
+                               user_following_id=self.user_id))
+        db.session.commit()
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_id
+                res = client.get(f'/users/{self.user_id}/following')
+                html = res.get_data(as_text=True)
+                self.assertIn("<p>@user3</p>", html)
+                self.assertNotIn("<p>@user2</p>", html)
+                self.assertIn("Load more", html)
+
+                cursor = html.split("?before=")[1].split('"')[0]
+                res = client.get(
+                    f'/users/{self.user_id}/following?before={cursor}')
+                html = res.get_data(as_text=True)
+                self.assertIn("<p>@user2</p>", html)
+                self.assertNotIn("<p>@user3</p>", html)
+                self.assertNotIn("Load more", html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 100
+
     def test_add_follow(self):
         """test adding a follow"""
 
@@ -117,6 +261,43 @@ class TestUserViews(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("<p>@user1</p>", html)
 
+    def test_follow_counters(self):
+        """test follow and unfollow keep counters in step"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            client.post(f'/users/follow/{self.user_id}')
+            self.assertEqual(User.query.get(self.user2_id).following_count, 1)
+            self.assertEqual(User.query.get(self.user_id).followers_count, 1)
+
+            client.post(f'/users/stop-following/{self.user_id}')
+            self.assertEqual(User.query.get(self.user2_id).following_count, 0)
+            self.assertEqual(User.query.get(self.user_id).followers_count, 0)
+
+    def test_repeat_follow(self):
+        """test following twice is harmless"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            client.post(f'/users/follow/{self.user_id}')
+            res = client.post(f'/users/follow/{self.user_id}')
+            self.assertEqual(res.status_code, 302)
+            self.assertEqual(Follows.query.filter_by(
+                user_following_id=self.user2_id).count(), 1)
+            self.assertEqual(User.query.get(self.user2_id).following_count, 1)
+
+    def test_stop_following_not_followed(self):
+        """test unfollowing someone not followed is harmless"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            res = client.post(f'/users/stop-following/{self.user_id}')
+            self.assertEqual(res.status_code, 302)
+            self.assertEqual(User.query.get(self.user_id).followers_count, 0)
+
     def test_unauthorized_following(self):
         """ test unauthorized following """
         with app.test_client() as client:
@@ -168,6 +349,51 @@ class TestUserViews(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("Boulder", html)
 
+    def test_update_profile_refreshes_message_fragments(self):
+        """Cached message list items pick up the author's profile edits."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            res = client.get(f'/users/{self.user2_id}')
+            self.assertIn("@user2", res.get_data(as_text=True))
+            self.assertIsNotNone(fragment_cache.get(self.message_id))
+
+            client.post('/users/profile', data={
+                "username": "renamed", "email": "user2@gmail.com",
+                "password": "password"})
+            res = client.get(f'/users/{self.user2_id}')
+            html = res.get_data(as_text=True)
+            self.assertIn("@renamed", html)
+            self.assertNotIn("@user2", html)
+
+    def test_delete_message_drops_fragment(self):
+        """Deleting a message drops its cached list item."""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            client.get(f'/users/{self.user2_id}')
+            self.assertIsNotNone(fragment_cache.get(self.message_id))
+
+            client.post(f'/messages/{self.message_id}/delete')
+            self.assertIsNone(fragment_cache.get(self.message_id))
+
+    def test_update_profile_refreshes_session_user(self):
+        """The cached session user picks up profile changes."""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            client.get('/')
+            self.assertEqual(user_cache.get(self.user_id)['username'], "user1")
+
+            client.post('/users/profile', data={
+                "username": "renamed", "email": "user1@gmail.com", "password": "password"})
+            self.assertIsNone(user_cache.get(self.user_id))
+
+            res = client.get('/')
+            self.assertIn("@renamed", res.get_data(as_text=True))
+
     def test_unauthorized_update_profile(self):
         """test show update profile page"""
         with app.test_client() as client:
@@ -188,11 +414,91 @@ class TestUserViews(TestCase):
             self.assertIn("fa fa-thumbs-up", html)
             self.assertEqual(len(Likes.query.all()), 1)
 
+    def test_like_json(self):
+        """test liking a post from script.js"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            res = client.post(f"/users/add_like/{self.message_id}",
+                              headers={"Accept": "application/json"})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json(), {
+                "message_id": str(self.message_id), "liked": True, "likes": 1,
+                "like_count": 1})
+
+            # liking again is harmless
+            res = client.post(f"/users/add_like/{self.message_id}",
+                              headers={"Accept": "application/json"})
+            self.assertEqual(res.get_json()["likes"], 1)
+
+            res = client.post(f"/users/remove_like/{self.message_id}",
+                              headers={"Accept": "application/json"})
+            self.assertEqual(res.get_json(), {
+                "message_id": str(self.message_id), "liked": False, "likes": 0,
+                "like_count": 0})
+            self.assertEqual(Likes.query.count(), 0)
+
+    def test_like_counts(self):
+        """test many users can like a message, and its count is batched"""
+
+        for user_id in (self.user_id, self.user2_id):
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                client.post(f"/users/add_like/{self.message_id}")
+
+        self.assertEqual(Likes.query.count(), 2)
+        # Not written yet, but shown.
+        self.assertEqual(Message.query.get(self.message_id).like_count, 0)
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            html = client.get("/").get_data(as_text=True)
+        self.assertIn('<span class="like-count">2</span>', html)
+
+        self.assertEqual(flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.message_id).like_count, 2)
+        self.assertEqual(len(pending_likes), 0)
+
+    def test_like_counts_flushed_at_exit(self):
+        """test pending like counts are written when the process exits"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            client.post(f"/users/add_like/{self.message_id}")
+
+        flush_at_exit()
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(self.message_id).like_count, 1)
+        self.assertEqual(len(pending_likes), 0)
+
+    def test_like_missing_message(self):
+        """test liking a message that doesn't exist"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            res = client.post("/users/add_like/99999999",
+                              headers={"Accept": "application/json"})
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(res.get_json(), {"error": "Message not found."})
+
+            res = client.post("/users/add_like/99999999")
+            self.assertEqual(res.status_code, 404)
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_unauthorized_like_json(self):
+        """test liking a post from script.js when logged out"""
+        with app.test_client() as client:
+            res = client.post(f"/users/add_like/{self.message_id}",
+                              headers={"Accept": "application/json"})
+            self.assertEqual(res.status_code, 401)
+
     def set_up_likes(self):
         """set up likes"""
         like = Likes(user_id=self.user_id, message_id=self.message_id)
-        like.id = 4000
-        self.like_id = like.id
+        self.like_key = (like.user_id, like.message_id)
         db.session.add(like)
         db.session.commit()
 
@@ -206,7 +512,7 @@ class TestUserViews(TestCase):
                 f"/users/remove_like/{self.message_id}", follow_redirects=True)
             html = res.get_data(as_text=True)
             self.assertEqual(res.status_code, 200)
-            self.assertFalse(Likes.query.get(self.like_id))
+            self.assertFalse(Likes.query.get(self.like_key))
 
     def test_unauthorized_like(self):
         """test liking a post"""
@@ -252,6 +558,25 @@ class TestUserViews(TestCase):
             self.assertEqual(res.status_code, 200)
             self.assertIn("Access unauthorized", html)
 
+    def test_delete_user_counters(self):
+        """test deleting a user adjusts the counters of those they touched"""
+
+        db.session.add(Likes(user_id=self.user_id, message_id=self.message_id))
+        db.session.commit()
+        recount()
+        recount_likes()
+        db.session.commit()
+        self.assertEqual(User.query.get(self.user2_id).followers_count, 1)
+        self.assertEqual(Message.query.get(self.message_id).like_count, 1)
+
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            client.post('/users/delete')
+
+        self.assertEqual(User.query.get(self.user2_id).followers_count, 0)
+        self.assertEqual(Message.query.get(self.message_id).like_count, 0)
+
     def test_delete_user(self):
         """test delete profile """
         with app.test_client() as client:
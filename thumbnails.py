@@ -0,0 +1,369 @@
+"""Thumbnails of users' pictures, served from a local disk cache.
+
+Users' ``image_url`` and ``header_image_url`` can point anywhere, often at
+full-size photos. Templates link to them with ``thumb_url(url, size)``
+instead, where `size` names one of the few slots pictures are shown in.
+That gives a signed ``/images/...`` URL (so the proxy only fetches what the
+app itself linked to), which:
+
+- fetches the original once, with a time and size limit,
+- crops it to the slot's shape and shrinks it to twice the slot's size
+  (for high density screens), never enlarging it,
+- saves it as a JPEG in a disk cache of at most ``IMAGE_CACHE_MAX_BYTES``,
+  dropping the least recently served thumbnails first,
+- and serves it with a year-long immutable Cache-Control; a user who
+  changes their picture changes the URL.
+
+Pictures that can't be fetched or read redirect to the slot's default
+picture, and aren't tried again for a few minutes.
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import urllib.request
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import urlsplit
+
+from flask import abort, current_app, redirect, safe_join, send_file
+from PIL import Image, ImageOps
+
+from assets import CACHE_CONTROL, static_url
+from cache import LRUCache
+
+# Slot name: (width, height, vertical crop position, default picture).
+# Sizes are twice the CSS sizes.
+SIZES = {
+    'nav': (64, 64, 0.5, 'images/default-pic.png'),
+    'timeline': (96, 96, 0.5, 'images/default-pic.png'),
+    'card': (140, 140, 0.5, 'images/default-pic.png'),
+    'avatar': (400, 400, 0.5, 'images/default-pic.png'),
+    # Headers are shown from the top.
+    'card-hero': (720, 260, 0.0, 'images/warbler-hero.jpg'),
+    'hero': (1920, 480, 0.0, 'images/warbler-hero.jpg'),
+}
+
+JPEG_QUALITY = 85
+
+# Originals that couldn't be made into thumbnails recently.
+failed = LRUCache(maxsize=10000, ttl=300)
+
+# Disk caches in use, by folder.
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class ImageError(Exception):
+    """An original picture couldn't be fetched or read."""
+
+
+def encode_url(url):
+    return urlsafe_b64encode(url.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_url(token):
+    padded = token + '=' * (-len(token) % 4)
+    return urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+
+
+def sign(size, url):
+    """Signature proving the app linked to `url` at `size`."""
+
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    message = f"{size}:{url}".encode('utf-8')
+    return hmac.new(key, message, hashlib.sha256).hexdigest()[:16]
+
+
+def thumb_url(url, size):
+    """URL for a thumbnail of the picture at `url` in slot `size`."""
+
+    if not url:
+        return static_url(SIZES[size][3])
+
+    return f"/images/{size}/{sign(size, url)}/{encode_url(url)}"
+
+
+##############################################################################
+# Fetching originals
+
+
+def public_address(address):
+    """Is the IP `address` on the public internet?"""
+
+    return ipaddress.ip_address(address.split('%')[0]).is_global
+
+
+def public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                      source_address=None):
+    """Connect to (host, port) if the host only resolves to public
+    addresses.
+
+    Keeps users from pointing their pictures at the server's own network.
+    The connection is made to the very addresses checked: resolving the
+    host again could give different ones (DNS rebinding).
+    """
+
+    host, port = address
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as error:
+        raise ImageError(f"Can't resolve {host}: {error}")
+
+    if not all(public_address(sockaddr[0])
+               for _, _, _, _, sockaddr in addresses):
+        raise ImageError(f"Host not allowed: {host}")
+
+    error = None
+    for _, _, _, _, sockaddr in addresses:
+        try:
+            return socket.create_connection(sockaddr[:2], timeout,
+                                            source_address)
+        except OSError as failure:
+            error = failure
+    raise error
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    _create_connection = staticmethod(public_connection)
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    # Certificates and SNI still use the host name in the URL.
+    _create_connection = staticmethod(public_connection)
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req,
+                            context=self._context)
+
+
+def check_origin(url):
+    """Raise ImageError unless the proxy may fetch `url`'s scheme."""
+
+    if urlsplit(url).scheme not in current_app.config['IMAGE_PROXY_SCHEMES']:
+        raise ImageError(f"Scheme not allowed: {url}")
+
+
+class CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to schemes the proxy may fetch."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_origin(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url):
+    """The bytes of the picture at `url`."""
+
+    limit = current_app.config['IMAGE_PROXY_MAX_BYTES']
+
+    # The default pictures are ours.
+    if url.startswith('/static/'):
+        path = safe_join(current_app.static_folder, url[len('/static/'):])
+        try:
+            with open(path, 'rb') as file:
+                return file.read(limit + 1)
+        except OSError as error:
+            raise ImageError(str(error))
+
+    check_origin(url)
+    # No proxies: connections must go to the addresses checked.
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}),
+                                         PublicHTTPHandler,
+                                         PublicHTTPSHandler,
+                                         CheckedRedirects)
+    request = urllib.request.Request(url, headers={'User-Agent': 'Warbler'})
+    try:
+        with opener.open(request,
+                         timeout=current_app.config['IMAGE_PROXY_TIMEOUT']
+                         ) as response:
+            data = response.read(limit + 1)
+    except (OSError, ValueError) as error:
+        raise ImageError(str(error))
+
+    if len(data) > limit:
+        raise ImageError(f"Larger than {limit} bytes: {url}")
+    return data
+
+
+def make_thumbnail(data, size):
+    """JPEG bytes of `data`'s picture cropped and shrunk for slot `size`."""
+
+    width, height, top, _ = SIZES[size]
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Lets JPEGs decode at a fraction of their size.
+        image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+
+        # Crop to the slot's shape, then shrink.
+        scale = min(image.width / width, image.height / height)
+        crop_width, crop_height = width * scale, height * scale
+        left = (image.width - crop_width) / 2
+        upper = (image.height - crop_height) * top
+        image = image.crop((round(left), round(upper),
+                            round(left + crop_width),
+                            round(upper + crop_height)))
+        image.thumbnail((width, height), Image.LANCZOS)
+
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True,
+                   progressive=True)
+        return out.getvalue()
+
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError(str(error))
+
+
+##############################################################################
+# The disk cache
+
+
+class ThumbnailCache:
+    """Thumbnails on disk, at most `max_bytes` of them.
+
+    A thumbnail's modification time is when it was last served, so the
+    least recently served go first when the cache is full.
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + '.jpg')
+
+    def get(self, key):
+        """The thumbnail for `key` as an open file, or None if not cached.
+
+        Once open, the file can be read even if it is evicted meanwhile.
+        """
+
+        try:
+            file = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            return None
+
+        os.utime(file.fileno())
+        return file
+
+    def put(self, key, data):
+        """Store a thumbnail, evicting old ones if the cache is full."""
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename, so nothing reads a half-written file.
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(temporary, path)
+
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, _, size in self.files())
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+        return path
+
+    def files(self):
+        """(modified, path, size) of every cached thumbnail."""
+
+        found = []
+        for directory, _, filenames in os.walk(self.folder):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        return found
+
+    def evict(self):
+        """Delete the least recently served thumbnails until the cache is
+        a tenth below its limit, so it isn't scanned on every store."""
+
+        files = sorted(self.files())
+        self.size = sum(size for _, _, size in files)
+
+        for _, path, size in files:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+
+def thumbnail_cache():
+    """The disk cache for the current app."""
+
+    folder = current_app.config['IMAGE_CACHE_FOLDER']
+    with _caches_lock:
+        if folder not in _caches:
+            _caches[folder] = ThumbnailCache(
+                folder, current_app.config['IMAGE_CACHE_MAX_BYTES'])
+        return _caches[folder]
+
+
+def send_thumbnail(size, signature, token):
+    """Respond with the thumbnail a `thumb_url` URL names."""
+
+    try:
+        url = decode_url(token)
+    except (ValueError, UnicodeError):
+        abort(404)
+
+    if size not in SIZES or not hmac.compare_digest(signature,
+                                                    sign(size, url)):
+        abort(404)
+
+    cache = thumbnail_cache()
+    key = hashlib.sha256(f"{size}:{url}".encode('utf-8')).hexdigest()
+    file = cache.get(key)
+
+    if file is None:
+        if failed.get(key):
+            return redirect(static_url(SIZES[size][3]))
+        try:
+            data = make_thumbnail(fetch(url), size)
+        except ImageError as error:
+            current_app.logger.info("No thumbnail of %s: %s", url, error)
+            failed.set(key, True)
+            return redirect(static_url(SIZES[size][3]))
+
+        cache.put(key, data)
+        file = io.BytesIO(data)
+
+    response = send_file(file, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
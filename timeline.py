@@ -0,0 +1,249 @@
+"""Materialized home timelines for Warbler.
+
+New messages are pushed ("fanned out") into the timeline of their author and
+every follower when they are written, so a home page is a single range read
+over ``timeline_entries``.
+
+Authors with more than ``TIMELINE_FANOUT_LIMIT`` followers are skipped at
+write time to avoid write storms; their messages keep ``fanned_out`` false
+and are pulled in when a timeline is read instead.
+"""
+
+from flask import current_app
+from sqlalchemy import and_, exists, literal, or_, select, union_all
+
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import page_of
+
+TIMELINE_LENGTH = 100
+BACKFILL_LIMIT = 800
+
+ENTRY_COLUMNS = ['user_id', 'message_id', 'author_id']
+
+
+def is_heavy_author(user_id):
+    """Does `user_id` have too many followers to fan out on write?
+
+    Reads the denormalized follower count rather than counting follows.
+    """
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return followers > current_app.config['TIMELINE_FANOUT_LIMIT']
+
+
+def fan_out(message):
+    """Deliver a newly-flushed message to its author's and followers' timelines.
+
+    Heavy authors are left to be pulled at read time.
+    """
+
+    if is_heavy_author(message.user_id):
+        return
+
+    followers = (select([Follows.user_following_id,
+                         literal(message.id),
+                         literal(message.user_id)])
+                 .where(Follows.user_being_followed_id == message.user_id)
+                 .where(Follows.user_following_id != message.user_id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(ENTRY_COLUMNS, followers))
+    db.session.add(TimelineEntry(user_id=message.user_id,
+                                 message_id=message.id,
+                                 author_id=message.user_id))
+    message.fanned_out = True
+
+
+def backfill(follower_id, followed_id):
+    """Copy the recent fanned-out messages of a newly followed user."""
+
+    if follower_id == followed_id:
+        return
+
+    already_delivered = exists().where(and_(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.message_id == Message.id))
+
+    recent = (select([literal(follower_id),
+                      Message.id,
+                      Message.user_id])
+              .where(Message.user_id == followed_id)
+              .where(Message.fanned_out.is_(True))
+              .where(~already_delivered)
+              .order_by(Message.id.desc())
+              .limit(BACKFILL_LIMIT))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(ENTRY_COLUMNS, recent))
+
+
+def retract(follower_id, followed_id):
+    """Remove an unfollowed user's messages from the follower's timeline."""
+
+    if follower_id == followed_id:
+        return
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.author_id == followed_id)
+     .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    """Remove a deleted message from every timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def remove_user(user_id):
+    """Remove a deleted user's timeline and their messages in others'."""
+
+    (TimelineEntry
+     .query
+     .filter(or_(TimelineEntry.user_id == user_id,
+                 TimelineEntry.author_id == user_id))
+     .delete(synchronize_session=False))
+
+
+def pulled_messages(user_id):
+    """Criterion for the messages `user_id`'s timeline pulls at read time:
+    not fanned out, by them or a user they follow.
+
+    Written to match the ``ix_messages_pulled`` partial index, which holds
+    only messages that weren't fanned out; an OR or ``IS false`` here would
+    make the database scan every message instead.
+    """
+
+    authors = union_all(
+        select([Follows.user_being_followed_id])
+        .where(Follows.user_following_id == user_id),
+        select([literal(user_id, db.Integer)]))
+
+    return and_(~Message.fanned_out, Message.user_id.in_(authors))
+
+
+def home_timeline(user_id, before=None, limit=TIMELINE_LENGTH):
+    """One page of messages from `user_id` and the users they follow.
+
+    Merges the materialized entries with messages from heavy authors
+    (anything not fanned out), newest first. `before` is a decoded message
+    id cursor; returns the messages and the next cursor.
+    """
+
+    pushed = (Message
+              .query
+              .options(Message.with_authors())
+              .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+              .filter(TimelineEntry.user_id == user_id))
+
+    pulled = (Message
+              .query
+              .options(Message.with_authors())
+              .filter(pulled_messages(user_id)))
+
+    if before:
+        pushed = pushed.filter(TimelineEntry.message_id < before)
+        pulled = pulled.filter(Message.id < before)
+
+    pushed = (pushed
+              .order_by(TimelineEntry.message_id.desc())
+              .limit(limit + 1)
+              .all())
+
+    pulled = (pulled
+              .order_by(Message.id.desc())
+              .limit(limit + 1)
+              .all())
+
+    messages = sorted(pushed + pulled, key=lambda msg: msg.id, reverse=True)
+    return page_of(messages, limit)
+
+
+def newest_message_id(user_id, before=None):
+    """The id of the newest message `home_timeline` would show, or None.
+
+    Takes the same `before` cursor. One statement reading the ends of two
+    indexes, cheap enough to run before deciding whether to render the
+    page at all.
+    """
+
+    pushed = (select([db.func.max(TimelineEntry.message_id).label('id')])
+              .where(TimelineEntry.user_id == user_id))
+    pulled = (select([db.func.max(Message.id).label('id')])
+              .where(pulled_messages(user_id)))
+
+    if before:
+        pushed = pushed.where(TimelineEntry.message_id < before)
+        pulled = pulled.where(Message.id < before)
+
+    newest = union_all(pushed, pulled).alias('newest')
+    return db.session.execute(select([db.func.max(newest.c.id)])).scalar()
+
+
+def heavy_authors():
+    """Query selecting the ids of authors who aren't fanned out."""
+
+    return (db.session
+            .query(Follows.user_being_followed_id)
+            .group_by(Follows.user_being_followed_id)
+            .having(db.func.count() >
+                    current_app.config['TIMELINE_FANOUT_LIMIT']))
+
+
+def deliver(*criteria):
+    """Insert timeline entries for every message matching `criteria`."""
+
+    delivered = (select([Follows.user_following_id,
+                         Message.id,
+                         Message.user_id])
+                 .where(Follows.user_being_followed_id == Message.user_id)
+                 .where(Follows.user_following_id != Message.user_id)
+                 .where(and_(*criteria)))
+
+    own = (select([Message.user_id,
+                   Message.id,
+                   Message.user_id.label('author_id')])
+           .where(and_(*criteria)))
+
+    entries = TimelineEntry.__table__
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, delivered))
+    db.session.execute(entries.insert().from_select(ENTRY_COLUMNS, own))
+
+
+def rebuild_timelines():
+    """Rebuild every materialized timeline from messages and follows.
+
+    Useful after bulk loads, which bypass fan-out.
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+    (Message
+     .query
+     .update({Message.fanned_out: ~Message.user_id.in_(heavy_authors())},
+             synchronize_session=False))
+
+    deliver(Message.fanned_out.is_(True))
+
+
+def fan_out_pending():
+    """Fan out every message that hasn't been, except heavy authors'.
+
+    Cheaper than `rebuild_timelines` after appending a bulk load to a
+    database that already has timelines.
+    """
+
+    pending = (Message.fanned_out.is_(False),
+               ~Message.user_id.in_(heavy_authors()))
+
+    deliver(*pending)
+    (Message
+     .query
+     .filter(*pending)
+     .update({Message.fanned_out: True}, synchronize_session=False))